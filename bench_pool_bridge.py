@@ -0,0 +1,1628 @@
+#!/usr/bin/env python3
+"""
+Pool Bridge benchmarks
+
+Drives an in-process bridge (real PoolHTTPServer + PoolHandler) backed by a
+fake panel, so it runs on the Pi or any Linux box without RS-485 hardware.
+
+Usage:
+  python3 bench_pool_bridge.py sse-load [--clients 30] [--requests 300]
+  python3 bench_pool_bridge.py fanout   [--clients 30] [--changes 200]
+  python3 bench_pool_bridge.py delta-bytes [--changes 1000]
+  python3 bench_pool_bridge.py fields   [--clients 30] [--changes 1000]
+  python3 bench_pool_bridge.py state-rps [--threads 4] [--seconds 5] [--uncached]
+  python3 bench_pool_bridge.py keepalive [--threads 4] [--seconds 5]
+  python3 bench_pool_bridge.py runtime  [--clients 30] [--requests 300]
+  python3 bench_pool_bridge.py metrics  [--clients 30] [--seconds 5]
+  python3 bench_pool_bridge.py ingest   [--capture FILE] [--minutes 60]
+      (needs the real aqualogic package; synthesizes a capture if none given)
+  python3 bench_pool_bridge.py mttr     [--trials 2]   (needs aqualogic too)
+  python3 bench_pool_bridge.py panels   [--requests 300] [--seconds 5]
+  python3 bench_pool_bridge.py startup  [--trials 5] [--bridge OLD_POOL_BRIDGE.py]
+      (needs aqualogic; times exec -> first 200 and first cached state)
+  python3 bench_pool_bridge.py snapshot [--seconds 5]
+  python3 bench_pool_bridge.py rules    [--changes 200]
+  python3 bench_pool_bridge.py binary   [--changes 1000]
+  python3 bench_pool_bridge.py replicas [--clients 90] [--seconds 5]
+  python3 bench_pool_bridge.py backpressure [--requests 300] [--clients 30]
+      [--seconds 20] [--change-rate 20]   (a third of the clients stop reading)
+  python3 bench_pool_bridge.py profile  [--minutes 60] [--top 5]   (needs aqualogic)
+  python3 bench_pool_bridge.py stress   [--clients 50] [--rps 100] [--toggles 10]
+      [--change-rate 5] [--seconds 10] [--runtime asyncio]
+      [--report FILE] [--baseline FILE]   (exits 1 if worse than the baseline report)
+
+  python3 bench_pool_bridge.py serve [--runtime asyncio] [--port 4200] [--panels 1]
+                                     [--replicate URL] [--steady AUX_1,AUX_2]
+      (a standalone fake bridge; prints its port, then serves until killed)
+  python3 bench_pool_bridge.py synth --capture FILE [--minutes 60]
+      (writes a synthetic RS-485 capture for pool_bridge.py --replay)
+"""
+
+import argparse, asyncio, gzip, hashlib, http.client, json, logging, os, platform, random, socket, subprocess, sys, tempfile, threading, time
+from unittest.mock import MagicMock
+
+# The benchmarks never touch the serial port, so fall back to a stand-in
+# when the aqualogic library isn't installed (e.g. on a dev laptop).
+try:
+    import aqualogic.core  # noqa: F401
+    HAVE_AQUALOGIC = True
+except ImportError:
+    HAVE_AQUALOGIC = False
+    _states = MagicMock()
+    for _name in [
+        'FILTER', 'POOL', 'SPA', 'SPILLOVER', 'LIGHTS', 'HEATER_1',
+        'AUX_1', 'AUX_2', 'AUX_3', 'AUX_4', 'AUX_5', 'AUX_6',
+        'VALVE_3', 'VALVE_4', 'HEATER_AUTO_MODE', 'SUPER_CHLORINATE',
+        'FILTER_LOW_SPEED',
+    ]:
+        setattr(_states.States, _name, _name)
+    sys.modules['aqualogic'] = MagicMock()
+    sys.modules['aqualogic.core'] = MagicMock()
+    sys.modules['aqualogic.states'] = _states
+
+import pool_bridge
+
+pool_bridge.log.setLevel('WARNING')
+
+# ─── Fixtures ──────────────────────────────────────────────────────
+class FakePanel:
+    """Just enough of AquaLogic for build_state() and set_state()."""
+
+    def __init__(self):
+        self.air_temp = 85
+        self.pool_temp = 78
+        self.spa_temp = 92
+        self.salt_level = 3200
+        self.pool_chlorinator = 50
+        self.spa_chlorinator = 20
+        self.pump_speed = 60
+        self.pump_power = 1100
+        self.is_metric = False
+        self.is_heater_enabled = False
+        self.check_system_msg = None
+        self.states = {name: False for name in pool_bridge.CIRCUIT_MAP}
+
+    # The panel API takes States members; self.states is keyed by circuit
+    # name, as churn() and --steady use it
+    NAMES = {state: name for name, state in pool_bridge.CIRCUIT_MAP.items()}
+
+    def get_state(self, state):
+        return self.states.get(self.NAMES.get(state), False)
+
+    def set_state(self, state, value):
+        self.states[self.NAMES[state]] = value
+        return True
+
+def churn(fake, rng, steady=()):
+    """Apply one realistic state change: mostly pump power ticks, sometimes
+    a temperature drift, occasionally a circuit toggle (never of a circuit
+    in `steady`)."""
+    roll = rng.random()
+    if roll < 0.7:
+        fake.pump_power = 1000 + rng.randrange(200)
+    elif roll < 0.9:
+        fake.pool_temp += rng.choice((-1, 1))
+    elif roll < 0.95:
+        fake.air_temp += rng.choice((-1, 1))
+    else:
+        name = rng.choice(sorted(fake.states))
+        if name not in steady:
+            fake.states[name] = not fake.states[name]
+
+def start_bridge():
+    """Start an in-process bridge on an ephemeral port; returns the server."""
+    fake = FakePanel()
+    pool_bridge.panel = fake
+    pool_bridge.on_data_changed(fake)
+    server = pool_bridge.PoolHTTPServer(('127.0.0.1', 0), pool_bridge.PoolHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def open_sse(port, path='/events'):
+    """Open a raw SSE connection and return the socket once headers arrive."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(f'GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+    head = b''
+    while b'\r\n\r\n' not in head:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('SSE connection closed during handshake')
+        head += chunk
+    if not head.startswith(b'HTTP/1.0 200') and not head.startswith(b'HTTP/1.1 200'):
+        sock.close()
+        raise ConnectionError(head.split(b'\r\n', 1)[0].decode())
+    return sock
+
+def drain(sock):
+    """Read and discard an SSE stream until it closes."""
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+def http_request_quiet(port, path):
+    """One GET, response discarded."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', path)
+    conn.getresponse().read()
+    conn.close()
+
+def read_events(sock, on_event):
+    """Parse an SSE stream, calling on_event(fields, arrival_time) per event."""
+    buf = b''
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            now = time.perf_counter()
+            buf += chunk
+            while b'\n\n' in buf:
+                raw, buf = buf.split(b'\n\n', 1)
+                fields = {}
+                for line in raw.decode().split('\n'):
+                    if line and not line.startswith(':'):
+                        key, _, value = line.partition(': ')
+                        fields[key] = value
+                if fields:
+                    on_event(fields, now)
+    except OSError:
+        pass
+
+# ─── Synthetic RS-485 traffic ──────────────────────────────────────
+DLE, STX, ETX = 0x10, 0x02, 0x03
+KEEP_ALIVE, LEDS, DISPLAY, PUMP_STATUS = b'\x01\x01', b'\x01\x02', b'\x01\x03', b'\x00\x0c'
+LED_BITS = {'HEATER_1': 1 << 0, 'POOL': 1 << 3, 'SPA': 1 << 4, 'FILTER': 1 << 5,
+            'LIGHTS': 1 << 6, 'AUX_1': 1 << 7, 'AUX_2': 1 << 8}
+
+def encode_frame(frame_type, data=b''):
+    """One AquaLogic frame: DLE STX, payload + checksum with every DLE
+    followed by a stuffed NUL, DLE ETX (AQ-CO-SERIAL framing)."""
+    payload = frame_type + data
+    checksum = DLE + STX + sum(payload)
+    out = bytearray((DLE, STX))
+    for byte in payload + checksum.to_bytes(2, 'big'):
+        out.append(byte)
+        if byte == DLE:
+            out.append(0)
+    out += bytes((DLE, ETX))
+    return bytes(out)
+
+def display_frame(top, bottom):
+    """A two-line LCD update; '°' is the panel's 0xdf glyph."""
+    text = top.center(16) + bottom.center(16)
+    return encode_frame(DISPLAY, text.encode('latin-1').replace(b'\xb0', b'\xdf') + b'\x00')
+
+def synthesize_capture(path, minutes, seed=1):
+    """Write a capture that looks like a panel with a VSP pump: keep-alives
+    at 10 Hz, LEDs twice a second, the display cycling through its screens
+    and pump status once a second, with slowly drifting values."""
+    rng = random.Random(seed)
+    pool_temp, air_temp, salt, power = 78, 85, 3200, 1100
+    leds = LED_BITS['POOL'] | LED_BITS['FILTER']
+    screens = ('pool', 'air', 'salt', 'chlorinator', 'heater')
+    with open(path, 'wb') as f:
+        f.write(pool_bridge.CAPTURE_MAGIC)
+
+        def emit(t, frame):
+            f.write(pool_bridge.CAPTURE_RECORD.pack(t, len(frame)))
+            f.write(frame)
+
+        for tick in range(int(minutes * 600)):
+            t = tick / 10
+            emit(t, encode_frame(KEEP_ALIVE))
+            if tick % 5 == 2:
+                if rng.random() < 0.01:
+                    leds ^= LED_BITS[rng.choice(sorted(LED_BITS))]
+                emit(t + 0.02, encode_frame(LEDS, leds.to_bytes(4, 'little') + bytes(4)))
+            if tick % 10 == 4:
+                screen = screens[tick // 10 % len(screens)]
+                if screen == 'pool':
+                    pool_temp += rng.choice((0,) * 18 + (-1, 1))
+                    frame = display_frame('Pool Temp', f'{pool_temp}°F')
+                elif screen == 'air':
+                    air_temp += rng.choice((0,) * 8 + (-1, 1))
+                    frame = display_frame('Air Temp', f'{air_temp}°F')
+                elif screen == 'salt':
+                    salt += rng.choice((0,) * 18 + (-100, 100))
+                    frame = display_frame('Salt Level', f'{salt} PPM')
+                elif screen == 'chlorinator':
+                    frame = display_frame('Pool Chlorinator', '50%')
+                else:
+                    frame = display_frame('Heater1', 'Auto')
+                emit(t + 0.04, frame)
+            if tick % 10 == 7:
+                power = max(0, power + rng.randrange(-20, 21))
+                bcd = bytes((power // 1000 << 4 | power // 100 % 10,
+                             power // 10 % 10 << 4 | power % 10))
+                emit(t + 0.07, encode_frame(PUMP_STATUS, b'\x00\x00\x3c' + bcd))
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return float('nan')
+    k = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+def report(name, samples_ms):
+    print(f'  {name:<28} n={len(samples_ms):<5} '
+          f'p50={percentile(samples_ms, 50):7.2f} ms  '
+          f'p99={percentile(samples_ms, 99):7.2f} ms')
+
+# ─── Benchmarks ────────────────────────────────────────────────────
+def bench_sse_load(args):
+    """REST latency while N clients hold /events streams open."""
+    server = start_bridge()
+    port = server.server_address[1]
+    streams = []
+    for _ in range(args.clients):
+        sock = open_sse(port)
+        threading.Thread(target=drain, args=(sock,), daemon=True).start()
+        streams.append(sock)
+    print(f'{len(streams)} SSE clients connected '
+          f'(workers={pool_bridge.HTTP_WORKERS}, '
+          f'max streams={pool_bridge.MAX_SSE_CLIENTS})')
+
+    requests = [
+        ('GET /state/all', 'GET', '/state/all', None),
+        ('GET /health', 'GET', '/health', None),
+        ('PUT /state/circuit/setState', 'PUT', '/state/circuit/setState', 'LIGHTS'),
+    ]
+    samples = {name: [] for name, *_ in requests}
+    for i in range(args.requests):
+        name, method, path, circuit = requests[i % len(requests)]
+        body = None
+        if circuit:
+            # Flip it each time so every PUT reaches the panel
+            body = json.dumps({'circuit': circuit,
+                               'state': not pool_bridge.panel.get_state(
+                                   pool_bridge.CIRCUIT_MAP[circuit])})
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        start = time.perf_counter()
+        conn.request(method, path, body=body,
+                     headers={'Content-Type': 'application/json'} if body else {})
+        conn.getresponse().read()
+        samples[name].append((time.perf_counter() - start) * 1000)
+        conn.close()
+        if circuit:
+            # The panel's next update shows the write, so the circuit
+            # settles; otherwise the next PUT waits out COMMAND_TIMEOUT
+            pool_bridge.on_data_changed(pool_bridge.panel)
+
+    for name, values in samples.items():
+        report(name, values)
+    for sock in streams:
+        sock.close()
+    server.shutdown()
+    server.server_close()
+
+def bench_fanout(args):
+    """Change-to-client latency and idle CPU with N subscribed clients."""
+    server = start_bridge()
+    port = server.server_address[1]
+    fake = pool_bridge.panel
+    published = {}   # pumpPower value -> perf_counter when published
+    latencies = []
+    lock = threading.Lock()
+
+    def on_event(fields, now):
+        power = json.loads(fields['data']).get('pumpPower')
+        if power in published:
+            with lock:
+                latencies.append((now - published[power]) * 1000)
+
+    streams = []
+    for _ in range(args.clients):
+        sock = open_sse(port)
+        threading.Thread(target=read_events, args=(sock, on_event), daemon=True).start()
+        streams.append(sock)
+    time.sleep(0.2)  # let the initial snapshots drain
+
+    idle_secs = 2.0
+    cpu = time.process_time()
+    time.sleep(idle_secs)
+    idle_cpu = (time.process_time() - cpu) / idle_secs * 100
+
+    for i in range(args.changes):
+        fake.pump_power = 10000 + i
+        published[fake.pump_power] = time.perf_counter()
+        pool_bridge.on_data_changed(fake)
+        time.sleep(0.005)
+    time.sleep(0.5)
+
+    print(f'{len(streams)} SSE clients, {args.changes} state changes')
+    report('change -> client', latencies)
+    print(f'  idle CPU with {len(streams)} clients: {idle_cpu:.2f}% of one core')
+    for sock in streams:
+        sock.close()
+    server.shutdown()
+    server.server_close()
+
+def bench_delta_bytes(args):
+    """Bytes a client receives for the same changes, full vs delta frames."""
+    fake = FakePanel()
+    rng = random.Random(42)
+    pool_bridge.on_data_changed(fake)
+    sub = pool_bridge.broadcaster.subscribe(maxlen=args.changes)
+    for _ in range(args.changes):
+        churn(fake, rng)
+        pool_bridge.on_data_changed(fake)
+    changes = sub.pop_all(timeout=0)
+    pool_bridge.broadcaster.unsubscribe(sub)
+
+    full = sum(len(c.full_frame) for c in changes)
+    delta = sum(len(c.delta_frame) for c in changes)
+    print(f'{len(changes)} state changes')
+    print(f'  full frames   {full:>9,} bytes  ({full / len(changes):6.1f} per event)')
+    print(f'  delta frames  {delta:>9,} bytes  ({delta / len(changes):6.1f} per event)')
+    print(f'  delta is {delta / full * 100:.1f}% of full')
+
+def bench_fields(args):
+    """?fields= subscriptions vs filtering in each client's stream: wakeups,
+    bytes and JSON encodes for wall displays, automations and full clients."""
+    groups = [('poolTemp', 'wall display'), ('circuits.HEATER_1', 'automation'),
+              (None, 'full delta')]
+    per_group = max(1, args.clients // len(groups))
+    encodes = [0]
+    encode = pool_bridge._encode
+
+    def counting_encode(data):
+        encodes[0] += 1
+        return encode(data)
+
+    for mode in ('per client', 'grouped'):
+        # Same changes, versions and ids for both modes
+        fake, rng = FakePanel(), random.Random(42)
+        pool_bridge.state_version, pool_bridge.last_reading = 0, None
+        pool_bridge.on_data_changed(fake)
+        subs = []
+        for selection, name in groups:
+            fields = pool_bridge.parse_fields(selection) if selection else None
+            for _ in range(per_group):
+                sub = pool_bridge.broadcaster.subscribe(
+                    maxlen=args.changes, fields=fields if mode == 'grouped' else None)
+                subs.append((sub, name, fields))
+        wakeups = dict.fromkeys((name for _, name in groups), 0)
+        sent = dict(wakeups)
+        encodes[0] = 0
+        pool_bridge._encode = counting_encode
+        start = time.process_time()
+        for _ in range(args.changes):
+            churn(fake, rng)
+            pool_bridge.on_data_changed(fake)
+            for sub, name, fields in subs:
+                changes = sub.pop_all(timeout=0)
+                if not changes:
+                    continue
+                wakeups[name] += 1
+                if mode == 'grouped' or fields is None:
+                    sent[name] += len(pool_bridge._frames_for(changes, sub, True, False))
+                else:   # the stream filters and encodes for its own client
+                    patch = pool_bridge.select_fields(changes[-1].patch, fields)
+                    if patch:
+                        sent[name] += len(f'id: {changes[-1].event_id}\nevent: patch\n'
+                                          f'data: {pool_bridge._encode(patch)}\n\n')
+        cpu = time.process_time() - start
+        pool_bridge._encode = encode
+        for sub, _, _ in subs:
+            pool_bridge.broadcaster.unsubscribe(sub)
+        print(f'{mode}: {len(subs)} clients, {args.changes} changes')
+        for _, name in groups:
+            print(f'  {name:<14} {wakeups[name] / per_group:7.0f} wakeups  '
+                  f'{sent[name] / per_group:9,.0f} bytes per client')
+        print(f'  {encodes[0]:,} JSON encodes, {cpu * 1e6 / args.changes:.0f} us CPU per change')
+
+def hammer(port, seconds, threads, headers):
+    """GET /state/all from several threads; returns requests/sec."""
+    deadline = time.perf_counter() + seconds
+    counts = [0] * threads
+
+    def worker(i):
+        while time.perf_counter() < deadline:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', '/state/all', headers=headers)
+            conn.getresponse().read()
+            conn.close()
+            counts[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts) / seconds
+
+def bench_state_rps(args):
+    """Requests/sec for GET /state/all: plain, conditional (304) and gzip."""
+    if args.uncached:
+        # Re-encode on every request, as the bridge did before bodies were cached
+        original = pool_bridge.StateChange.body
+        pool_bridge.StateChange.body = (
+            lambda self, part='all', compressed=False:
+            original(pool_bridge.StateChange(self.version, dict(self.state), self.patch),
+                     part, compressed))
+    server = start_bridge()
+    port = server.server_address[1]
+    with pool_bridge.state_lock:
+        etag = pool_bridge._latest_change().etag
+
+    print(f'GET /state/all, {args.threads} threads, {args.seconds}s each'
+          f'{" (uncached)" if args.uncached else ""}')
+    for name, headers in [('plain', {}),
+                          ('If-None-Match (304)', {'If-None-Match': etag}),
+                          ('Accept-Encoding: gzip', {'Accept-Encoding': 'gzip'})]:
+        rps = hammer(port, args.seconds, args.threads, headers)
+        print(f'  {name:<24} {rps:8.0f} req/s')
+    server.shutdown()
+    server.server_close()
+
+def poll_state(port, seconds, threads, persistent):
+    """A dashboard-style mix of GETs from several threads, either reusing one
+    connection per thread or opening a new one per request.
+
+    Returns (requests/sec, TCP connections opened, p50 ms).
+    """
+    deadline = time.perf_counter() + seconds
+    counts, connects, samples = [0] * threads, [0] * threads, [[] for _ in range(threads)]
+    paths = ('/state/all', '/health', '/state/all', '/history?limit=10')
+
+    def worker(i):
+        conn = None
+        while time.perf_counter() < deadline:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                connect = conn.connect
+
+                def counted():
+                    connects[i] += 1
+                    connect()
+                conn.connect = counted
+            start = time.perf_counter()
+            conn.request('GET', paths[counts[i] % len(paths)])
+            conn.getresponse().read()
+            samples[i].append((time.perf_counter() - start) * 1000)
+            counts[i] += 1
+            if not persistent:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    latencies = sorted(s for per_thread in samples for s in per_thread)
+    return sum(counts) / seconds, sum(connects), latencies[len(latencies) // 2]
+
+def bench_keepalive(args):
+    """Requests/sec and TCP handshakes for REST polling, with and without
+    keep-alive, on both runtimes."""
+    print(f'{args.threads} polling threads, {args.seconds:g}s each')
+    for runtime in ('threads', 'asyncio'):
+        proc, port = spawn_bridge(runtime, change_rate=5)
+        try:
+            time.sleep(0.5)
+            for label, persistent in (('new connection each', False),
+                                      ('keep-alive', True)):
+                rps, connects, p50 = poll_state(port, args.seconds, args.threads,
+                                                persistent)
+                total = rps * args.seconds
+                print(f'  {runtime:<8} {label:<20} {rps:7.0f} req/s  '
+                      f'p50 {p50:5.2f} ms  {connects:6d} handshakes '
+                      f'({connects / total * 100:5.1f}% of requests)')
+        finally:
+            proc.kill()
+            proc.wait()
+
+def serve(args):
+    """Standalone fake bridge for out-of-process benchmarks.
+
+    Prints the listening port on the first line of stdout. Each of the
+    --panels fake panels (pool1, pool2, ...) changes state --change-rate
+    times a second and stamps each change's wall-clock time into
+    checkSystemMsg so clients can measure latency. With --stuck-panel,
+    pool1 goes silent and its writes never return, like a hung adapter.
+    With --replicate URL it has no panels and mirrors that bridge instead.
+    Circuits listed in --steady only change when a client sets them.
+    """
+    pool_bridge.configure_panels([(f'pool{i}', os.devnull)
+                                  for i in range(1, args.panels + 1)])
+
+    steady = set(args.steady.split(',')) if args.steady else set()
+
+    def ticker(ctx, fake, seed):
+        rng = random.Random(seed)
+        while True:
+            time.sleep(1 / args.change_rate)
+            churn(fake, rng, steady)
+            fake.check_system_msg = f'{time.time():.6f}'
+            ctx.on_data_changed(fake)
+
+    if args.replicate:
+        pool_bridge.replica = pool_bridge.Replica(args.replicate)
+        threading.Thread(target=pool_bridge.replica.run, daemon=True).start()
+    else:
+        for i, ctx in enumerate(pool_bridge.panels.values()):
+            fake = FakePanel()
+            ctx.panel = fake
+            ctx.on_data_changed(fake)
+            if i == 0 and args.stuck_panel:
+                fake.set_state = lambda state, value: time.sleep(3600)
+            else:
+                threading.Thread(target=ticker, args=(ctx, fake, i + 1),
+                                 daemon=True).start()
+    if args.runtime == 'asyncio':
+        async def run():
+            server = await pool_bridge.AsyncBridgeServer().start('127.0.0.1', args.port)
+            print(server.sockets[0].getsockname()[1], flush=True)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(run())
+    else:
+        server = pool_bridge.PoolHTTPServer(('127.0.0.1', args.port), pool_bridge.PoolHandler)
+        print(server.server_address[1], flush=True)
+        server.serve_forever()
+
+STRESS_CIRCUITS = ('AUX_1', 'AUX_2', 'AUX_3', 'AUX_4')
+
+def spawn_bridge(runtime, change_rate, *extra):
+    """Start `serve` in a child process; returns (process, port)."""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'serve', '--runtime', runtime,
+         '--change-rate', str(change_rate), *extra],
+        stdout=subprocess.PIPE, text=True)
+    return proc, int(proc.stdout.readline())
+
+def proc_status(pid):
+    """(RSS in MiB, thread count) from /proc."""
+    fields = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()
+    return int(fields['VmRSS'][0]) / 1024, int(fields['Threads'][0])
+
+def proc_cpu_seconds(pid):
+    """User + system CPU time of a process, from /proc/<pid>/stat."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def scrape(port):
+    """GET /metrics as {series name: summed value}."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/metrics')
+    text = conn.getresponse().read().decode()
+    conn.close()
+    series = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            name = name.split('{', 1)[0]
+            series[name] = series.get(name, 0) + float(value)
+    return series
+
+def bench_metrics(args):
+    """What the /metrics instrumentation costs, per operation and as a share
+    of the bridge's CPU under a realistic load."""
+    n = 200000
+    counter, hist = pool_bridge.Counter(), pool_bridge.Histogram()
+    family = pool_bridge.Family(pool_bridge.Histogram)
+    costs = {}
+    for name, op in (('Counter.inc()', counter.inc),
+                     ('Histogram.observe()', lambda: hist.observe(0.003)),
+                     ('labels().observe()', lambda: family.labels('/state/all').observe(0.003))):
+        start = time.perf_counter()
+        for _ in range(n):
+            op()
+        costs[name] = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for _ in range(100):
+        pool_bridge.metrics.render()
+    render = (time.perf_counter() - start) / 100
+    for name, cost in costs.items():
+        print(f'  {name:<28} {cost * 1e9:7.0f} ns')
+    print(f'  {"render()":<28} {render * 1e3:7.2f} ms')
+
+    # Realistic load on a separate bridge process: phones streaming, the
+    # app polling, the panel changing a few times a second.
+    proc, port = spawn_bridge('threads', args.change_rate)
+    try:
+        streams = []
+        for _ in range(args.clients):
+            sock = open_sse(port)
+            threading.Thread(target=drain, args=(sock,), daemon=True).start()
+            streams.append(sock)
+        before, cpu_before = scrape(port), proc_cpu_seconds(proc.pid)
+        start = time.monotonic()
+        while time.monotonic() - start < args.seconds:
+            http_request_quiet(port, '/state/all')
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+        cpu = proc_cpu_seconds(proc.pid) - cpu_before
+        after = scrape(port)
+    finally:
+        proc.kill()
+        proc.wait()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    # One update per counter increment or histogram observation; the SSE
+    # byte counter is bumped once per write, i.e. per change per client.
+    ops = sum(delta(name) for name in after
+              if name.endswith('_count') or (name.endswith('_total')
+                                             and not name.startswith('process_')
+                                             and name not in ('pool_bridge_sse_bytes_total',
+                                                              'pool_bridge_commands_total')))
+    ops += delta('pool_bridge_state_changes_total') * args.clients
+    ops -= 1  # the closing scrape's own response count
+    per_op = max(costs.values())
+    overhead = ops * per_op + render * elapsed / 15   # plus a scrape every 15 s
+    print(f'Load: {args.clients} streams, {args.change_rate:g} changes/s, '
+          f'10 req/s for {elapsed:.1f} s')
+    print(f'  bridge CPU {cpu / elapsed * 100:.2f}% of a core; '
+          f'{ops / elapsed:,.0f} metric updates/s')
+    print(f'  instrumentation ~{overhead / elapsed * 100:.3f}% of a core, '
+          f'{overhead / cpu * 100 if cpu else 0:.2f}% of the bridge\'s CPU')
+
+def bench_runtime(args):
+    """Threaded vs asyncio runtime: RSS, threads and latency under N streams."""
+    for runtime in ('threads', 'asyncio'):
+        proc, port = spawn_bridge(runtime, change_rate=5)
+        try:
+            time.sleep(0.5)
+            rss_idle, _ = proc_status(proc.pid)
+            latencies = []
+
+            def on_event(fields, now):
+                stamp = json.loads(fields['data']).get('checkSystemMsg')
+                if stamp:
+                    latencies.append((time.time() - float(stamp)) * 1000)
+
+            streams = []
+            for _ in range(args.clients):
+                sock = open_sse(port)
+                threading.Thread(target=read_events, args=(sock, on_event),
+                                 daemon=True).start()
+                streams.append(sock)
+            time.sleep(1)
+            rss, threads = proc_status(proc.pid)
+
+            rest = []
+            for i in range(args.requests):
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                start = time.perf_counter()
+                conn.request('GET', '/state/all' if i % 2 else '/health')
+                conn.getresponse().read()
+                rest.append((time.perf_counter() - start) * 1000)
+                conn.close()
+
+            print(f'{runtime}: {len(streams)} SSE clients')
+            print(f'  RSS {rss_idle:.1f} MiB idle -> {rss:.1f} MiB with clients, '
+                  f'{threads} threads')
+            report('REST request', rest)
+            report('change -> client', latencies)
+            for sock in streams:
+                sock.close()
+        finally:
+            proc.kill()
+            proc.wait()
+
+def put_circuit(port, path, circuit, state):
+    """PUT one circuit change; returns the status code."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('PUT', path, body=json.dumps({'circuit': circuit, 'state': state}),
+                 headers={'Content-Type': 'application/json'})
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+def bench_backpressure(args):
+    """A client spamming PUTs, then stream clients that stop reading next to
+    ones that keep up: what reaches the panel, and how long stalled streams
+    hold a worker."""
+    proc, port = spawn_bridge('threads', args.change_rate)
+    try:
+        time.sleep(0.5)
+        statuses, start = {}, time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        for i in range(args.requests):
+            conn.request('PUT', '/state/circuit/setState?wait=0',
+                         body=json.dumps({'circuit': 'AUX_1', 'state': bool(i % 2)}),
+                         headers={'Content-Type': 'application/json',
+                                  'X-Real-IP': '10.0.0.9'})   # as if via nginx
+            resp = conn.getresponse()
+            resp.read()
+            statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            if resp.will_close:
+                conn.close()
+        elapsed = time.perf_counter() - start
+        print(f'{args.requests} PUTs from one client in {elapsed:.2f}s: '
+              f'{statuses.get(202, 0) + statuses.get(200, 0)} queued, '
+              f'{statuses.get(429, 0)} refused with 429')
+
+        latencies, streams = [], []
+
+        def on_event(fields, now):
+            stamp = json.loads(fields['data']).get('checkSystemMsg') if 'data' in fields else None
+            if stamp:
+                latencies.append((time.time() - float(stamp)) * 1000)
+
+        stalled = args.clients // 3
+        readers = args.clients - stalled
+        for _ in range(readers):
+            sock = open_sse(port)
+            threading.Thread(target=read_events, args=(sock, on_event), daemon=True).start()
+            streams.append(sock)
+        for _ in range(stalled):
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect(('127.0.0.1', port))
+            sock.sendall(b'GET /events HTTP/1.1\r\nHost: bench\r\n\r\n')
+            streams.append(sock)   # never read
+        print(f'{readers} streams reading, {stalled} stalled, '
+              f'{args.change_rate:g} changes/s')
+        start = time.monotonic()
+        open_streams = scrape(port)['pool_bridge_sse_clients']
+        dropped_after = None
+        while time.monotonic() - start < args.seconds:
+            time.sleep(0.5)
+            now_open = scrape(port)['pool_bridge_sse_clients']
+            if dropped_after is None and now_open <= readers:
+                dropped_after = time.monotonic() - start
+        totals = scrape(port)
+        print(f'  open streams {open_streams:.0f} -> {now_open:.0f}; stalled ones dropped '
+              + (f'after {dropped_after:.1f}s' if dropped_after is not None
+                 else f'not within {args.seconds:g}s'))
+        print(f'  write timeouts {totals["pool_bridge_sse_write_timeouts_total"]:.0f}, '
+              f'frames dropped {totals["pool_bridge_sse_dropped_frames_total"]:.0f}')
+        report('change -> reading client', latencies)
+        for sock in streams:
+            sock.close()
+    finally:
+        proc.kill()
+        proc.wait()
+
+def bench_replicas(args):
+    """Viewers all on the primary vs spread over replica bridges: streams
+    accepted, what the primary spends, and change -> viewer latency
+    through the extra hop."""
+    viewers = args.clients
+    print(f'{viewers} viewers on /events, {args.change_rate:g} changes/s, '
+          f'{args.seconds:g}s each')
+    for n in (0, 1, 2, 3):
+        primary, port = spawn_bridge('threads', args.change_rate)
+        replicas = [spawn_bridge('threads', args.change_rate, '--replicate',
+                                 f'http://127.0.0.1:{port}') for _ in range(n)]
+        # With replicas, viewers use them and the primary only feeds them
+        nodes = [p for _, p in replicas] or [port]
+        latencies, streams, refused, writes = [], [], 0, []
+
+        def on_event(fields, now):
+            if 'data' in fields:
+                stamp = json.loads(fields['data']).get('checkSystemMsg')
+                if stamp:
+                    latencies.append((time.time() - float(stamp)) * 1000)
+
+        try:
+            time.sleep(0.5)
+            for i in range(viewers):
+                try:
+                    sock = open_sse(nodes[i % len(nodes)])
+                except ConnectionError:   # 503: the node's streams are full
+                    refused += 1
+                    continue
+                threading.Thread(target=read_events, args=(sock, on_event),
+                                 daemon=True).start()
+                streams.append(sock)
+            held = scrape(port)['pool_bridge_sse_clients']
+            cpu, start = proc_cpu_seconds(primary.pid), time.monotonic()
+            time.sleep(args.seconds)
+            cpu = (proc_cpu_seconds(primary.pid) - cpu) / (time.monotonic() - start)
+            for i in range(30):
+                start = time.perf_counter()
+                put_circuit(nodes[i % len(nodes)], '/state/circuit/setState?wait=0',
+                            'AUX_1', bool(i % 2))
+                writes.append((time.perf_counter() - start) * 1000)
+        finally:
+            for sock in streams:
+                sock.close()
+            for proc, _ in replicas + [(primary, port)]:
+                proc.kill()
+                proc.wait()
+        print(f'{n} replica(s): {len(streams)} streams open, {refused} refused; '
+              f'primary holds {held:.0f}, CPU {cpu * 100:.1f}%')
+        report('change -> viewer', latencies)
+        report('PUT setState?wait=0', writes)
+
+def bench_panels(args):
+    """One bridge process serving 1-8 panels: memory, threads and latency as
+    panels are added, then healthy panels next to a stuck one."""
+    streams_per_panel = 2
+    print(f'{streams_per_panel} streams per panel + 1 on /panels/events, '
+          f'{args.change_rate:g} changes/s per panel')
+    single_rss = None
+    for n in (1, 2, 4, 8):
+        proc, port = spawn_bridge('threads', args.change_rate, '--panels', str(n))
+        ids = [f'pool{i}' for i in range(1, n + 1)]
+        per_panel, aggregate, streams = [], [], []
+
+        # open_sse() may swallow the start of the first event; skip the rest of it
+        def on_panel_event(fields, now):
+            if 'data' in fields:
+                stamp = json.loads(fields['data']).get('checkSystemMsg')
+                if stamp:
+                    per_panel.append((time.time() - float(stamp)) * 1000)
+
+        def on_aggregate_event(fields, now):
+            if 'data' in fields:
+                stamp = json.loads(fields['data'])['state'].get('checkSystemMsg')
+                if stamp:
+                    aggregate.append((time.time() - float(stamp)) * 1000)
+
+        try:
+            time.sleep(0.5)
+            for panel_id in ids:
+                for _ in range(streams_per_panel):
+                    sock = open_sse(port, f'/panels/{panel_id}/events')
+                    threading.Thread(target=read_events, args=(sock, on_panel_event),
+                                     daemon=True).start()
+                    streams.append(sock)
+            sock = open_sse(port, '/panels/events')
+            threading.Thread(target=read_events, args=(sock, on_aggregate_event),
+                             daemon=True).start()
+            streams.append(sock)
+            time.sleep(args.seconds)
+            rss, threads = proc_status(proc.pid)
+            rest = []
+            for i in range(args.requests):
+                start = time.perf_counter()
+                http_request_quiet(port, f'/panels/{ids[i % n]}/state/all')
+                rest.append((time.perf_counter() - start) * 1000)
+        finally:
+            for sock in streams:
+                sock.close()
+            proc.kill()
+            proc.wait()
+        single_rss = single_rss or rss
+        print(f'{n} panel(s): RSS {rss:.1f} MiB ({single_rss * n:.1f} MiB as {n} '
+              f'processes), {threads} threads')
+        report('GET /panels/<id>/state/all', rest)
+        report('change -> panel stream', per_panel)
+        report('change -> /panels/events', aggregate)
+
+    # pool1 stops answering mid-write; pool2-4 should not notice.
+    circuits = sorted(pool_bridge.CIRCUIT_MAP)
+    for stuck in (False, True):
+        extra = ('--panels', '4') + (('--stuck-panel',) if stuck else ())
+        proc, port = spawn_bridge('threads', args.change_rate, *extra)
+        try:
+            time.sleep(0.5)
+            if stuck:
+                for circuit in circuits[:5]:
+                    put_circuit(port, '/panels/pool1/state/circuit/setState?wait=0',
+                                circuit, True)
+            writes, reads = [], []
+            for i in range(args.requests // 3):
+                panel_id = f'pool{2 + i % 3}'
+                circuit = circuits[(i // 3) % len(circuits)]
+                start = time.perf_counter()
+                status = put_circuit(port, f'/panels/{panel_id}/state/circuit/setState',
+                                     circuit, bool(i // (3 * len(circuits)) % 2 == 0))
+                writes.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    print(f'  write to {panel_id} answered {status}')
+                start = time.perf_counter()
+                http_request_quiet(port, f'/panels/{panel_id}/state/all')
+                reads.append((time.perf_counter() - start) * 1000)
+        finally:
+            proc.kill()
+            proc.wait()
+        print('pool1 stuck (writes hang, no frames):' if stuck else 'all 4 panels healthy:')
+        report('PUT setState, pool2-4', writes)
+        report('GET state/all, pool2-4', reads)
+
+def replay_ingest(path):
+    """Replay a capture through a pseudo-terminal into the real AquaLogic
+    parser as fast as it reads: (replay, panel, frames, seconds, callback ms)."""
+    import serial
+
+    replay = pool_bridge.SerialReplay(path, speed=0)
+    frames = sum(data.count(bytes((DLE, STX))) for _, data in replay.records)
+    aq = pool_bridge.new_panel()
+    aq.connect_serial(replay.port)
+    pool_bridge.panel = aq
+    callbacks = []
+
+    def timed_callback(p):
+        start = time.perf_counter()
+        pool_bridge.on_data_changed(p)
+        callbacks.append((time.perf_counter() - start) * 1000)
+
+    def hang_up_when_read():
+        replay.done.wait()
+        while replay.pending():
+            time.sleep(0.01)
+        replay.close()   # the reader's next read fails, ending process()
+
+    threading.Thread(target=hang_up_when_read, daemon=True).start()
+    start = time.perf_counter()
+    replay.start()
+    try:
+        aq.process(timed_callback)
+    except serial.SerialException:
+        pass
+    return replay, aq, frames, time.perf_counter() - start, callbacks
+
+def bench_ingest(args):
+    """RS-485 ingest: replay a capture through a pseudo-terminal into the
+    real AquaLogic parser as fast as it reads, timing on_data_changed()."""
+    if not HAVE_AQUALOGIC:
+        sys.exit('ingest needs the aqualogic package (pip3 install aqualogic)')
+    path = args.capture
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.cap')
+        os.close(fd)
+        synthesize_capture(path, args.minutes)
+    changes_before = pool_bridge.state_changes.value
+    replay, aq, frames, elapsed, callbacks = replay_ingest(path)
+
+    build = []
+    for _ in range(2000):
+        t = time.perf_counter()
+        pool_bridge.build_state(aq)
+        build.append((time.perf_counter() - t) * 1000)
+
+    recorded = replay.records[-1][0] if replay.records else 0
+    print(f'{replay.size} bytes, {frames} frames ({recorded / 60:.0f} min of traffic) '
+          f'in {elapsed:.2f} s')
+    print(f'  {frames / elapsed:,.0f} frames/s, {replay.size / elapsed / 1024:,.0f} KiB/s '
+          f'({replay.size / 1920 / elapsed:,.0f}x the 19200-baud line rate)')
+    print(f'  {len(callbacks)} callbacks, '
+          f'{pool_bridge.state_changes.value - changes_before} state changes')
+    report('on_data_changed()', callbacks)
+    report('build_state()', build)
+    if args.capture is None:
+        os.unlink(path)
+
+def bench_profile(args):
+    """Sampling profiler overhead: replay the same capture into the real
+    parser before any capture, after one, and while one runs."""
+    if not HAVE_AQUALOGIC:
+        sys.exit('profile needs the aqualogic package (pip3 install aqualogic)')
+    logging.getLogger('pool_bridge').setLevel('CRITICAL')
+    fd, path = tempfile.mkstemp(suffix='.cap')
+    os.close(fd)
+    synthesize_capture(path, args.minutes)
+
+    def round_(name):
+        replay, _, frames, elapsed, callbacks = replay_ingest(path)
+        print(f'{name:<18} {frames / elapsed:>9,.0f} frames/s   '
+              f'on_data_changed p50 {percentile(callbacks, 50):.3f} ms  '
+              f'p99 {percentile(callbacks, 99):.3f} ms')
+        return elapsed
+
+    elapsed = round_('never profiled')
+    pool_bridge.profiler.capture(0.2)
+    round_('after a capture')
+    result = {}
+    sampler = threading.Thread(target=lambda: result.update(
+        out=pool_bridge.profiler.capture(elapsed * 2 + 1)))
+    sampler.start()
+    round_('during a capture')
+    sampler.join()
+    os.unlink(path)
+
+    stacks, passes = result['out']
+    print(f'\n{passes} sampling passes; top stacks (leaf frames):')
+    for stack, n in sorted(stacks.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f'  {n:>5}  {" <- ".join(reversed(stack.split(";")[-3:]))}')
+
+def bench_mttr(args):
+    """Mean time to recover: the reconnect supervisor vs. the old flat 5 s
+    retry with no stall watchdog, against a replayed panel that is
+    unplugged and replugged, or that goes silent while the port stays open."""
+    if not HAVE_AQUALOGIC:
+        sys.exit('mttr needs the aqualogic package (pip3 install aqualogic)')
+    for name in ('pool_bridge', 'aqualogic'):
+        logging.getLogger(name).setLevel('CRITICAL')
+    tmp = tempfile.mkdtemp()
+    capture = os.path.join(tmp, 'panel.cap')
+    synthesize_capture(capture, 1)
+    silent = os.path.join(tmp, 'silent.cap')   # 5 s of traffic, then nothing
+    with open(silent, 'wb') as f:
+        f.write(pool_bridge.CAPTURE_MAGIC)
+        for offset, data in pool_bridge.read_capture(capture):
+            if offset < 5:
+                f.write(pool_bridge.CAPTURE_RECORD.pack(offset, len(data)) + data)
+    link = os.path.join(tmp, 'ttyPOOL')
+    pool_bridge.SERIAL_PORT = link
+    stall_timeout = pool_bridge.STALL_TIMEOUT
+
+    def plug(path, loop=True):
+        replay = pool_bridge.SerialReplay(path, loop=loop)
+        os.symlink(replay.port, link)
+        return replay.start()
+
+    def unplug(replay):
+        os.unlink(link)
+        replay.close()
+
+    def wait_for(predicate, timeout=60):
+        deadline = time.monotonic() + timeout
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    for policy in ('supervisor', 'flat 5 s'):
+        sup = pool_bridge.PanelSupervisor()
+        if policy == 'flat 5 s':
+            sup.probe = lambda port: True
+            sup.backoff = lambda: 5.0
+            pool_bridge.STALL_TIMEOUT = float('inf')
+        else:
+            pool_bridge.STALL_TIMEOUT = stall_timeout
+        pool_bridge.supervisor = sup
+        stop = threading.Event()
+        replay = plug(capture)
+        runner = threading.Thread(target=sup.run, args=(stop,), daemon=True)
+        runner.start()
+        wait_for(sup.connected.is_set)
+        print(f'{policy}:')
+        for outage in (1, 5):
+            samples = []
+            for _ in range(args.trials):
+                unplug(replay)
+                wait_for(lambda: not sup.connected.is_set())
+                time.sleep(outage)
+                replay = plug(capture)
+                back = time.monotonic()
+                wait_for(lambda: sup.last_frame > back)
+                samples.append((sup.last_frame - back) * 1000)
+            report(f'replug after {outage} s outage', samples)
+
+        unplug(replay)
+        wait_for(lambda: not sup.connected.is_set())
+        samples = []
+        for _ in range(args.trials):
+            replay = plug(silent, loop=False)
+            wait_for(sup.connected.is_set)
+            replay.done.wait()
+            went_quiet = time.monotonic()
+            wait_for(lambda: not sup.connected.is_set())
+            samples.append((time.monotonic() - went_quiet) * 1000)
+            unplug(replay)
+        report('silent line detected', samples)
+        stop.set()
+        runner.join()
+
+def bench_startup(args):
+    """Cold start: exec pool_bridge.py (no panel attached) and time the first
+    200 from /health and the first /state/all with circuits in it, served
+    from a snapshot left by a previous run."""
+    if not HAVE_AQUALOGIC:
+        sys.exit('startup needs the aqualogic package (pip3 install aqualogic)')
+    bridge = args.bridge or pool_bridge.__file__
+    home = tempfile.mkdtemp()
+    fake = FakePanel()
+    pool_bridge.panel = fake
+    with open(os.path.join(home, 'pool_snapshot.json'), 'w') as f:
+        json.dump({'default': pool_bridge.build_state(fake)}, f)
+    env = dict(os.environ, HOME=home)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)   # time it as systemd runs it
+
+    def first_ok(port, path, deadline, check=lambda body: True):
+        while time.perf_counter() < deadline:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                body = resp.read()
+                conn.close()
+                if resp.status == 200 and check(body):
+                    return time.perf_counter()
+            except OSError:
+                pass
+            time.sleep(0.002)
+        return None
+
+    health, state = [], []
+    for trial in range(args.trials + 1):   # the first run only warms the caches
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, bridge, '--port', str(port),
+                                 '--serial', os.path.join(home, 'ttyNONE')],
+                                env=env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            deadline = start + 10
+            up = first_ok(port, '/health', deadline)
+            cached = up and first_ok(port, '/state/all', up + 1,
+                                     lambda body: b'circuits' in body)
+        finally:
+            proc.terminate()
+            proc.wait()
+        if trial and up:
+            health.append((up - start) * 1000)
+            if cached:
+                state.append((cached - start) * 1000)
+    print(f'{os.path.relpath(bridge)}, {args.trials} cold starts:')
+    report('exec -> /health 200', health)
+    if state:
+        report('exec -> /state/all with circuits', state)
+    else:
+        print('  /state/all had no circuits within 1 s of /health (no snapshot support)')
+
+def bench_snapshot(args):
+    """Snapshot writes vs. state churn: the throttled SnapshotWriter against
+    writing on every change, with time compressed so each churn rate runs
+    for twelve SNAPSHOT_EVERY intervals."""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'snapshot.json')
+    every = pool_bridge.SNAPSHOT_EVERY
+    scale = every * 12 / args.seconds          # simulated seconds per real second
+    fake = FakePanel()
+    pool_bridge.on_data_changed(fake)
+    pool_bridge.save_snapshot(path)
+    size = os.path.getsize(path)
+    timings = []
+    for _ in range(50):
+        start = time.perf_counter()
+        pool_bridge.save_snapshot(path)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f'snapshot is {size} bytes; writing at most every {every} s')
+    report('save_snapshot() incl. fsync', timings)
+    print(f'  {"changes/min":>11}  {"every change":>16}  {"throttled":>16}  {"writes/day":>10}')
+    rng = random.Random(42)
+    for per_minute in (0.2, 1, 6, 60, 600):
+        writer = pool_bridge.SnapshotWriter(path, every=every / scale)
+        pool_bridge.snapshots = writer
+        writes_before = pool_bridge.snapshot_writes.value
+        writer.start()
+        gap = 60 / per_minute / scale
+        changes = 0
+        deadline = time.perf_counter() + args.seconds
+        next_change = time.perf_counter()
+        while next_change < deadline:
+            churn(fake, rng)
+            pool_bridge.on_data_changed(fake)
+            changes += 1
+            next_change += gap
+            time.sleep(max(0, next_change - time.perf_counter()))
+        writes = pool_bridge.snapshot_writes.value - writes_before
+        pool_bridge.snapshots = None
+        writer.close()
+        hours = args.seconds * scale / 3600
+        print(f'  {per_minute:>11g}  {changes / hours:>8,.0f} writes/h  '
+              f'{writes / hours:>8,.0f} writes/h  {writes / hours * 24:>10,.0f}')
+    print(f'  (a day of throttled writes at 600 changes/min is about '
+          f'{24 * 3600 / every * size / 1024:,.0f} KiB)')
+
+class NullQueue:
+    """Swallows the commands rules queue, so only evaluation is timed."""
+    def submit(self, circuit, state):
+        pass
+
+    def wake(self):
+        pass
+
+def random_rule(rng, i):
+    """One or two field conditions, sometimes with a time window."""
+    numeric = {'airTemp': 85, 'poolTemp': 78, 'spaTemp': 92, 'saltLevel': 3200,
+               'pumpSpeed': 60, 'pumpPower': 1100}
+    when = []
+    for _ in range(rng.choice((1, 2))):
+        if rng.random() < 0.7:
+            field = rng.choice(sorted(numeric))
+            when.append({'field': field, 'op': rng.choice(('<', '>=')),
+                         'value': numeric[field] + rng.randrange(-5, 6)})
+        else:
+            when.append({'field': 'circuits.' + rng.choice(sorted(pool_bridge.CIRCUIT_MAP)),
+                         'value': rng.random() < 0.5})
+    if rng.random() < 0.2:
+        when.append({'time': ['08:00', '16:00']})
+    return pool_bridge.Rule(f'r{i}', {
+        'when': when, 'set': {rng.choice(sorted(pool_bridge.CIRCUIT_MAP)): rng.random() < 0.5}})
+
+def bench_rules(args):
+    """Rule evaluation cost per state change with hundreds of rules: the
+    field index vs. checking every rule on every change."""
+    pool_bridge.commands = NullQueue()
+    for count in (100, 300, 1000):
+        for mode in ('indexed', 'every rule'):
+            rng = random.Random(42)
+            fake = FakePanel()
+            pool_bridge.panel = fake
+            engine = pool_bridge.RuleEngine()
+            pool_bridge.rules = engine
+            pool_bridge.state_version, pool_bridge.last_reading = 0, None
+            pool_bridge.on_data_changed(fake)
+            every = [random_rule(rng, i) for i in range(count)]
+            for rule in every:
+                engine.put(rule)
+            fired_before = pool_bridge.rules_fired.value
+            samples = []
+
+            def timed(change=None, evaluate=engine.evaluate):
+                start = time.perf_counter()
+                if mode == 'indexed':
+                    evaluate(change)
+                else:
+                    engine._check(every)
+                samples.append((time.perf_counter() - start) * 1000)
+            engine.evaluate = timed
+            for _ in range(args.changes):
+                churn(fake, rng)
+                pool_bridge.on_data_changed(fake)
+            report(f'{count} rules, {mode}', samples)
+            print(f'    ({pool_bridge.rules_fired.value - fired_before} rules fired '
+                  f'over {len(samples)} changes)')
+
+def bench_binary(args):
+    """Payload size and encode cost: JSON vs. the binary encoding, for
+    /state/all bodies and /events messages."""
+    fake = FakePanel()
+    rng = random.Random(42)
+    pool_bridge.on_data_changed(fake)
+    sub = pool_bridge.broadcaster.subscribe(maxlen=args.changes)
+    for _ in range(args.changes):
+        churn(fake, rng)
+        pool_bridge.on_data_changed(fake)
+    changes = sub.pop_all(timeout=0)
+    pool_bridge.broadcaster.unsubscribe(sub)
+
+    def per_change_us(encode, rounds=20):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for c in changes:
+                encode(c)
+        return (time.perf_counter() - start) / rounds / len(changes) * 1e6
+
+    sizes = [
+        ('JSON /state/all', sum(len(pool_bridge._encode(c.state)) for c in changes)),
+        ('JSON, gzipped', sum(len(gzip.compress(pool_bridge._encode(c.state).encode(), mtime=0))
+                              for c in changes)),
+        ('binary /state/all', sum(len(pool_bridge.encode_state(c.state, c.version))
+                                  for c in changes)),
+        ('SSE full event', sum(len(c.frame('full')) for c in changes)),
+        ('SSE delta event', sum(len(c.frame('delta')) for c in changes)),
+        ('binary stream record', sum(len(c.frame('binary')) for c in changes)),
+    ]
+    print(f'{len(changes)} state changes, bytes per message:')
+    for name, total in sizes:
+        print(f'  {name:<22} {total / len(changes):7.1f}')
+    print('encode cost per state:')
+    print(f'  {"json.dumps":<22} {per_change_us(lambda c: pool_bridge._encode(c.state)):7.1f} µs')
+    print(f'  {"encode_state":<22} '
+          f'{per_change_us(lambda c: pool_bridge.encode_state(c.state, c.version)):7.1f} µs')
+
+# ─── Stress suite ──────────────────────────────────────────────────
+# What --baseline compares: (section, key, allowed growth, absolute slack).
+# A value regresses when it exceeds baseline * (1 + growth) + slack; the
+# slack keeps millisecond-level noise from failing a run. Toggles use p90:
+# at 10 a second there are too few for a steady p99.
+STRESS_CHECKS = [
+    ('rest', 'p50_ms', 1.0, 2),
+    ('rest', 'p99_ms', 1.0, 10),
+    ('rest', 'errors', 0, 0),
+    ('toggles', 'p50_ms', 1.0, 2),
+    ('toggles', 'p90_ms', 1.0, 10),
+    ('toggles', 'errors', 0, 0),
+    ('sse', 'lag_p50_ms', 1.0, 2),
+    ('sse', 'lag_p99_ms', 1.0, 10),
+    ('sse', 'refused', 0, 0),
+    ('sse', 'dropped_frames', 0.5, 10),
+    ('process', 'cpu_percent', 0.5, 2),
+    ('process', 'rss_mib_peak', 0.1, 2),
+]
+
+def paced(port, rate, threads, seconds, send):
+    """Call send(conn, i) `rate` times a second, spread over `threads`
+    persistent connections, for `seconds`.
+
+    Requests are scheduled on a fixed clock and latency is measured from
+    the scheduled time, so a stalled bridge shows up as latency instead of
+    quietly lowering the request rate. Like browsers and nginx, a request
+    that finds its kept-alive connection closed by the bridge is retried
+    once on a new one. Returns (latencies ms, errors).
+    """
+    start = time.perf_counter() + 0.05
+    period = threads / rate
+    samples, errors = [[] for _ in range(threads)], [0] * threads
+
+    def connect():
+        return http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+
+    def worker(t):
+        conn, i = None, 0
+        while True:
+            due = start + t / rate + i * period
+            if due - start >= seconds:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                reused, conn = conn is not None, conn or connect()
+                try:
+                    ok = send(conn, i * threads + t)
+                except (ConnectionResetError, BrokenPipeError):
+                    # RemoteDisconnected included: the bridge closed the
+                    # idle connection as this request went out
+                    if not reused:
+                        raise
+                    conn.close()
+                    conn = connect()
+                    ok = send(conn, i * threads + t)
+                if ok:
+                    samples[t].append((time.perf_counter() - due) * 1000)
+                else:
+                    errors[t] += 1
+            except (OSError, http.client.HTTPException):
+                errors[t] += 1
+                conn.close()
+                conn = None
+            i += 1
+        if conn is not None:
+            conn.close()
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return [s for per_thread in samples for s in per_thread], sum(errors)
+
+def latency_summary(samples, errors, seconds, target):
+    return {'target_rps': target, 'rps': round(len(samples) / seconds, 1),
+            'errors': errors, 'p50_ms': round(percentile(samples, 50), 2),
+            'p90_ms': round(percentile(samples, 90), 2),
+            'p99_ms': round(percentile(samples, 99), 2),
+            'max_ms': round(max(samples, default=float('nan')), 2)}
+
+def get_state(conn, i):
+    conn.request('GET', '/state/all')
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status == 200
+
+def toggle(conn, i):
+    # Round-robin over a few circuits so each one has settled before its
+    # next write, as when several people use the app at once
+    n = len(STRESS_CIRCUITS)
+    conn.request('PUT', '/state/circuit/setState',
+                 body=json.dumps({'circuit': STRESS_CIRCUITS[i % n], 'state': bool(i // n % 2)}),
+                 headers={'Content-Type': 'application/json'})
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status == 200
+
+def stress_run(args):
+    """One stress run against a `serve` bridge; returns the report dict."""
+    # The fake panel leaves the toggled circuits alone; if it flipped one
+    # between a write and the next update, that toggle would wait out
+    # COMMAND_SETTLE and skew the latencies
+    proc, port = spawn_bridge(args.runtime, args.change_rate,
+                              '--steady', ','.join(STRESS_CIRCUITS))
+    lags, streams, refused, peak = [], [], 0, {'rss': 0, 'threads': 0}
+    events = [0]
+
+    def on_event(fields, now):
+        events[0] += 1
+        stamp = json.loads(fields['data']).get('checkSystemMsg') if 'data' in fields else None
+        if stamp:
+            lags.append((time.time() - float(stamp)) * 1000)
+
+    def watch(stop):
+        while not stop.wait(0.25):
+            rss, threads = proc_status(proc.pid)
+            peak['rss'], peak['threads'] = max(peak['rss'], rss), max(peak['threads'], threads)
+
+    try:
+        time.sleep(0.5)
+        rss_idle, _ = proc_status(proc.pid)
+        for _ in range(args.clients):
+            try:
+                sock = open_sse(port)
+            except ConnectionError:   # 503: the stream limit
+                refused += 1
+                continue
+            threading.Thread(target=read_events, args=(sock, on_event), daemon=True).start()
+            streams.append(sock)
+        time.sleep(0.5)
+        del lags[:]
+        events[0] = 0
+        before = scrape(port)
+        stop = threading.Event()
+        threading.Thread(target=watch, args=(stop,), daemon=True).start()
+        cpu, start = proc_cpu_seconds(proc.pid), time.monotonic()
+        results = {}
+        loads = [threading.Thread(target=lambda: results.update(rest=paced(
+                     port, args.rps, 4, args.seconds, get_state))),
+                 threading.Thread(target=lambda: results.update(toggles=paced(
+                     port, args.toggles, 2, args.seconds, toggle)))]
+        for t in loads:
+            t.start()
+        for t in loads:
+            t.join()
+        elapsed = time.monotonic() - start
+        cpu = proc_cpu_seconds(proc.pid) - cpu
+        stop.set()
+        rss, threads = proc_status(proc.pid)
+        after = scrape(port)
+    finally:
+        for sock in streams:
+            sock.close()
+        proc.kill()
+        proc.wait()
+
+    with open(pool_bridge.__file__, 'rb') as f:
+        bridge = hashlib.sha256(f.read()).hexdigest()[:12]
+    return {
+        'benchmark': 'stress',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'bridge_sha256': bridge,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'config': {'runtime': args.runtime, 'seconds': args.seconds,
+                   'sse_clients': args.clients, 'rest_rps': args.rps,
+                   'toggles_per_s': args.toggles, 'change_rate': args.change_rate},
+        'rest': latency_summary(*results['rest'], args.seconds, args.rps),
+        'toggles': latency_summary(*results['toggles'], args.seconds, args.toggles),
+        'sse': {'clients': len(streams), 'refused': refused, 'events': events[0],
+                'events_per_s': round(events[0] / elapsed, 1),
+                'lag_p50_ms': round(percentile(lags, 50), 2),
+                'lag_p99_ms': round(percentile(lags, 99), 2),
+                'dropped_frames': after['pool_bridge_sse_dropped_frames_total']
+                                  - before['pool_bridge_sse_dropped_frames_total']},
+        'process': {'cpu_percent': round(cpu / elapsed * 100, 1),
+                    'rss_mib_idle': round(rss_idle, 1), 'rss_mib': round(rss, 1),
+                    'rss_mib_peak': round(max(peak['rss'], rss), 1),
+                    'threads_peak': max(peak['threads'], threads)},
+    }
+
+def regressions(result, baseline):
+    """STRESS_CHECKS that got worse than the baseline report allows."""
+    found = []
+    for section, key, growth, slack in STRESS_CHECKS:
+        old, new = baseline.get(section, {}).get(key), result[section][key]
+        if old is None or old != old or new != new:   # missing or NaN
+            continue
+        limit = old * (1 + growth) + slack
+        if new > limit:
+            found.append(f'{section}.{key}: {new:g} (baseline {old:g}, limit {limit:g})')
+    return found
+
+def bench_stress(args):
+    """Everything at once against a separate bridge process: SSE clients,
+    /state/all polling and toggles at fixed rates while the fake panel
+    changes. Writes a JSON report with --report and, given a --baseline
+    report, exits 1 if latency, errors, CPU or memory regressed."""
+    result = stress_run(args)
+    rest, toggles, sse, process = (result[k] for k in ('rest', 'toggles', 'sse', 'process'))
+    print(f'{args.runtime}: {sse["clients"]} SSE clients ({sse["refused"]} refused), '
+          f'{args.rps:g} GET/s, {args.toggles:g} PUT/s, {args.change_rate:g} changes/s, '
+          f'{args.seconds:g}s')
+    for name, r in (('GET /state/all', rest), ('PUT setState', toggles)):
+        print(f'  {name:<16} {r["rps"]:6.1f}/s  p50 {r["p50_ms"]:6.2f} ms  '
+              f'p90 {r["p90_ms"]:6.2f} ms  p99 {r["p99_ms"]:6.2f} ms  {r["errors"]} errors')
+    print(f'  {"change -> client":<16} {sse["events_per_s"]:6.0f}/s  p50 {sse["lag_p50_ms"]:6.2f} ms'
+          f'  p99 {sse["lag_p99_ms"]:6.2f} ms  {sse["dropped_frames"]:.0f} frames dropped')
+    print(f'  bridge CPU {process["cpu_percent"]:.1f}%, RSS {process["rss_mib_idle"]:.1f} -> '
+          f'{process["rss_mib_peak"]:.1f} MiB peak, {process["threads_peak"]} threads')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+        print(f'report written to {args.report}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != result['config']:
+            sys.exit(f'{args.baseline} was run with {baseline.get("config")}; '
+                     f'rerun it or match its options')
+        found = regressions(result, baseline)
+        for line in found:
+            print(f'REGRESSION {line}')
+        if found:
+            sys.exit(1)
+        print(f'no regressions against {args.baseline}')
+
+BENCHMARKS = {
+    'sse-load': bench_sse_load,
+    'fanout': bench_fanout,
+    'delta-bytes': bench_delta_bytes,
+    'state-rps': bench_state_rps,
+    'keepalive': bench_keepalive,
+    'runtime': bench_runtime,
+    'ingest': bench_ingest,
+    'metrics': bench_metrics,
+    'mttr': bench_mttr,
+    'panels': bench_panels,
+    'fields': bench_fields,
+    'startup': bench_startup,
+    'snapshot': bench_snapshot,
+    'rules': bench_rules,
+    'binary': bench_binary,
+    'replicas': bench_replicas,
+    'backpressure': bench_backpressure,
+    'profile': bench_profile,
+    'stress': bench_stress,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['serve', 'synth'])
+    parser.add_argument('--clients', type=int, default=None,
+                        help='concurrent SSE clients (default 30, replicas 90, stress 50)')
+    parser.add_argument('--requests', type=int, default=300,
+                        help='REST requests to time (default 300)')
+    parser.add_argument('--changes', type=int, default=None,
+                        help='state changes to publish '
+                             '(default 200, delta-bytes/fields/binary 1000)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='concurrent request threads (default 4)')
+    parser.add_argument('--seconds', type=float, default=None,
+                        help='duration of each timed run (default 5, stress 10)')
+    parser.add_argument('--uncached', action='store_true',
+                        help='re-encode every response (pre-cache behaviour)')
+    parser.add_argument('--runtime', choices=('threads', 'asyncio'), default='threads',
+                        help='serve: HTTP runtime (default threads)')
+    parser.add_argument('--port', type=int, default=0,
+                        help='serve: port to listen on (default: any free port)')
+    parser.add_argument('--change-rate', type=float, default=5,
+                        help='serve: fake state changes per second (default 5)')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='ingest: capture to replay; synth: file to write')
+    parser.add_argument('--trials', type=int, default=None,
+                        help='repetitions: mttr of each fault (default 2), '
+                             'startup of the cold start (default 5)')
+    parser.add_argument('--bridge', metavar='FILE',
+                        help='startup: pool_bridge.py to time (default this one)')
+    parser.add_argument('--panels', type=int, default=1,
+                        help='serve: number of fake panels (default 1)')
+    parser.add_argument('--replicate', metavar='URL',
+                        help='serve: mirror the bridge at URL instead of fake panels')
+    parser.add_argument('--steady', metavar='CIRCUITS',
+                        help='serve: comma-separated circuits the fake panel never flips')
+    parser.add_argument('--stuck-panel', action='store_true',
+                        help='serve: pool1 stops sending and its writes hang')
+    parser.add_argument('--minutes', type=float, default=60,
+                        help='length of a synthesized capture (default 60)')
+    parser.add_argument('--top', type=int, default=5,
+                        help='profile: how many of the busiest stacks to show')
+    parser.add_argument('--rps', type=float, default=100,
+                        help='stress: GET /state/all per second (default 100)')
+    parser.add_argument('--toggles', type=float, default=10,
+                        help='stress: circuit PUTs per second (default 10)')
+    parser.add_argument('--report', metavar='FILE',
+                        help='stress: write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='stress: compare with an earlier --report, exit 1 on regression')
+    args = parser.parse_args()
+    if args.benchmark == 'serve':
+        serve(args)
+        return
+    if args.benchmark == 'synth':
+        if not args.capture:
+            parser.error('synth needs --capture FILE')
+        synthesize_capture(args.capture, args.minutes)
+        return
+    if args.trials is None:
+        args.trials = 5 if args.benchmark == 'startup' else 2
+    if args.clients is None:
+        args.clients = {'replicas': 90, 'stress': 50}.get(args.benchmark, 30)
+    if args.seconds is None:
+        args.seconds = 10 if args.benchmark == 'stress' else 5
+    if args.changes is None:
+        args.changes = 1000 if args.benchmark in ('delta-bytes', 'fields', 'binary') else 200
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
@@ -8,20 +8,122 @@ API:
   GET  /state/all              → full state JSON
   GET  /state/circuits         → circuits only
   PUT  /state/circuit/setState  → {"circuit":"FILTER","state":true}
+  PUT  /state/circuits         → {"FILTER":true,"SPA":true,...} (batch)
+  GET  /commands/<id>          → status of a queued circuit command
   GET  /events                 → Server-Sent Events (live state push)
+  GET  /events?fields=poolTemp,circuits.SPA → only those fields, only when they change
+  GET  /state/schema           → layout of the binary encoding (Accept:
+                                  application/x-pool-state on /state/all, /events)
+  GET  /history?field=&from=&to=&step= → downsampled readings over time
+  GET  /rules                  → automation rules and when they last fired
+  PUT  /rules/<id>             → {"when":[{"field":"poolTemp","op":">=","value":84}],
+                                  "set":{"HEATER_1":false}} (create or replace)
+  DELETE /rules/<id>           → remove a rule
   GET  /health                 → connection status
+  GET  /metrics                → Prometheus text-format metrics
+
+Several panels (--panel ID=DEVICE, repeated):
+  GET  /panels                 → configured panels and their status
+  *    /panels/<id>/...        → any route above, for panel <id>
+  GET  /panels/events          → every panel's changes on one SSE stream
+
+Debugging without the panel:
+  pool_bridge.py --capture FILE   record the raw RS-485 stream while running
+  pool_bridge.py --replay FILE    serve a recording instead of the serial port
 """
 
-import json, threading, queue, time, logging, signal, sys
+import argparse, bisect, fcntl, gzip, http.client, importlib.util, io, itertools, json, math, operator, os, random, re, select, socket, struct, threading, queue, time, logging, signal, sys, termios, tty
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from aqualogic.core import AquaLogic
 from aqualogic.states import States
 
+def _lazy_import(name):
+    """Module `name`, executed on first attribute access rather than now."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# Kept off the startup path so /health answers sooner on a Pi Zero:
+# asyncio is only needed for --asyncio, hmac for /debug/profile, and
+# aqualogic.core (which pulls in pyserial) is imported by the reader
+# thread in new_panel().
+asyncio = _lazy_import('asyncio')
+hmac = _lazy_import('hmac')
+AquaLogic = None
+
 # ─── Config ────────────────────────────────────────────────────────
 SERIAL_PORT = '/dev/ttyAMA0'
 HTTP_PORT   = 4200
 LOG_LEVEL   = logging.INFO
 
+HTTP_WORKERS    = 48   # request-handling threads (SSE streams hold one each)
+HTTP_BACKLOG    = 64   # accepted connections waiting for a free worker
+KEEPALIVE_TIMEOUT = 5  # seconds an idle persistent connection is kept open
+KEEPALIVE_MAX   = 100  # requests per connection before the bridge closes it
+KEEPALIVE_POLL  = 0.1  # seconds between checks for queued clients while idle
+CORS_MAX_AGE    = 86400  # seconds a browser may reuse a CORS preflight answer
+MAX_SSE_CLIENTS = 32   # keep HTTP_WORKERS - MAX_SSE_CLIENTS free for REST calls
+SSE_QUEUE_SIZE  = 8    # frames buffered per client before the oldest is dropped
+SSE_KEEPALIVE   = 15   # seconds of silence before a comment ping (keeps proxies open)
+SSE_WRITE_TIMEOUT = 10 # a stream write blocked this long drops the client
+SSE_SLOW_WRITE  = 0.5  # a client whose last write took longer gets its backlog as
+                       # one full state instead of every patch
+SSE_SEND_BUFFER = 16384  # bytes the kernel buffers per stream; bounds how far
+                         # behind a stalled client's data can be
+EVENT_HISTORY   = 256  # recent changes kept so reconnecting clients can resume
+GZIP_MIN_BYTES  = 256  # don't bother compressing bodies smaller than this
+
+RATE_READS      = (20, 60)  # per client: GETs per second and burst (None: no limit)
+RATE_WRITES     = (2, 10)   # per client: PUTs/DELETEs per second and burst
+RATE_CLIENTS    = 1024      # clients tracked; the least recently seen is forgotten
+TRUSTED_PROXIES = ('127.0.0.1', '::1')  # nginx, mirrors: the client is their X-Real-IP;
+                                        # their own requests aren't limited
+
+COMMAND_TIMEOUT = 3.0  # seconds a PUT waits for its command before answering 202
+COMMAND_SETTLE  = 5.0  # max seconds to wait for the panel to show a write before
+                       # sending another one for the same circuit
+COMMAND_HISTORY = 128  # finished commands kept for GET /commands/<id>
+
+HISTORY_DIR     = os.path.expanduser('~/pool_history')  # None disables history
+HISTORY_FLUSH   = 300  # seconds between SD-card writes (buffered in memory)
+HISTORY_RAW_DAYS = 14  # days kept at full resolution before hourly rollup
+HISTORY_KEEP_DAYS = 400  # days of hourly rollups kept
+HISTORY_MAX_POINTS = 1000  # /history never returns more buckets than this
+
+SNAPSHOT_PATH   = os.path.expanduser('~/pool_snapshot.json')  # last state, served
+                                                             # at startup; None disables
+SNAPSHOT_EVERY  = 60     # write the snapshot at most this often (seconds)
+SNAPSHOT_FORMAT = 1      # bump when the snapshot layout changes
+
+RULES_PATH      = os.path.expanduser('~/pool_rules.json')  # None keeps rules in memory
+RULE_TICK       = 20     # seconds between checks of time-of-day conditions
+
+PROFILE_TOKEN_PATH = os.path.expanduser('~/pool_profile_token')  # bearer token for
+                                        # /debug/profile; no file, no endpoint
+PROFILE_INTERVAL = 0.01  # seconds between stack samples while profiling
+PROFILE_MAX_SECONDS = 300
+
+CAPTURE_GAP     = 0.002  # bytes read within this many seconds share one capture record
+
+RECONNECT_MIN   = 0.25  # first retry after losing the panel (seconds); doubles
+RECONNECT_MAX   = 30.0  # per failed attempt, with jitter, up to this
+PROBE_INTERVAL  = 0.5   # while the serial device is missing, look for it this often
+STALL_TIMEOUT   = 5.0   # no frame from the panel for this long → reconnect
+                        # (it sends keep-alives several times a second)
+WRITE_GRACE     = 10.0  # circuit writes made while reconnecting wait this long
+
+REPLICA_STALL   = 2 * SSE_KEEPALIVE + 5  # --replicate: no event or ping from the
+                                         # primary for this long → reconnect
+FORWARD_TIMEOUT = COMMAND_TIMEOUT + 5    # seconds a replica waits for the primary
+                                         # to answer a forwarded request
+
 # ─── Logging ───────────────────────────────────────────────────────
 logging.basicConfig(
     level=LOG_LEVEL,
@@ -51,130 +153,2443 @@ CIRCUIT_MAP = {
     'FILTER_LOW_SPEED': States.FILTER_LOW_SPEED,
 }
 
+# ─── Metrics ──────────────────────────────────────────────────────
+# Seconds; covers a cached GET (~0.5 ms on a Pi Zero) up to a slow set_state.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class _PerThread:
+    """Each thread updates its own cell, so the hot path takes no lock and
+    never loses an update; readers sum the cells at scrape time."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = []
+
+    def _cell(self):
+        cell = self._new_cell()
+        self._local.cell = cell
+        self._cells.append(cell)  # list.append is atomic
+        return cell
+
+    def _sum(self, size):
+        totals = [0] * size
+        for cell in list(self._cells):
+            for i in range(size):
+                totals[i] += cell[i]
+        return totals
+
+class Counter(_PerThread):
+    def _new_cell(self):
+        return [0]
+
+    def inc(self, n=1):
+        try:
+            self._local.cell[0] += n
+        except AttributeError:
+            self._cell()[0] += n
+
+    @property
+    def value(self):
+        return self._sum(1)[0]
+
+class Histogram(_PerThread):
+    """Fixed-bucket histogram; a cell is per-bucket counts plus the sum."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        super().__init__()
+        self.buckets = tuple(buckets)
+
+    def _new_cell(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        """(cumulative counts per bucket with +Inf last, sum)"""
+        totals = self._sum(len(self.buckets) + 2)
+        return list(itertools.accumulate(totals[:-1])), totals[-1]
+
+class Family:
+    """Metrics of one kind split by a single label (e.g. route)."""
+
+    def __init__(self, make):
+        self._make = make
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value):
+        child = self._children.get(value)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(value, self._make())
+        return child
+
+    def items(self):
+        return sorted(self._children.items())
+
+def _fmt(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """Named metrics rendered in the Prometheus text exposition format.
+
+    Counters and histograms are updated on the hot path; gauges (and
+    counters kept elsewhere) pass `fn`, which is only called on a scrape.
+    """
+
+    def __init__(self):
+        self._metrics = []   # (name, help, type, label, metric or fn)
+
+    def _add(self, name, help, kind, label, metric):
+        self._metrics.append((name, help, kind, label, metric))
+        return metric
+
+    def counter(self, name, help, label=None, fn=None):
+        return self._add(name, help, 'counter', label,
+                         fn or (Family(Counter) if label else Counter()))
+
+    def gauge(self, name, help, fn, label=None):
+        return self._add(name, help, 'gauge', label, fn)
+
+    def histogram(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        make = lambda: Histogram(buckets)
+        return self._add(name, help, 'histogram', label,
+                         Family(make) if label else make())
+
+    def render(self):
+        lines = []
+        for name, help, kind, label, metric in self._metrics:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if callable(metric):
+                value = metric()
+                children = sorted(value.items()) if label else [(None, value)]
+            else:
+                children = metric.items() if label else [(None, metric)]
+            for label_value, child in children:
+                tag = f'{label}="{label_value}"' if label else ''
+                if kind == 'histogram':
+                    counts, total = child.snapshot()
+                    for bound, count in zip(child.buckets + ('+Inf',), counts):
+                        le = bound if bound == '+Inf' else f'{bound:g}'
+                        sep = ',' if tag else ''
+                        lines.append(f'{name}_bucket{{{tag}{sep}le="{le}"}} {count}')
+                    suffix = f'{{{tag}}}' if tag else ''
+                    lines.append(f'{name}_sum{suffix} {_fmt(total)}')
+                    lines.append(f'{name}_count{suffix} {counts[-1]}')
+                else:
+                    if isinstance(child, Counter):
+                        child = child.value
+                    lines.append(f'{name}{{{tag}}} {_fmt(child)}' if tag
+                                 else f'{name} {_fmt(child)}')
+        return '\n'.join(lines) + '\n'
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+metrics = MetricsRegistry()
+panel_callbacks = metrics.counter(
+    'pool_bridge_panel_callbacks_total', 'Data callbacks from the AquaLogic reader.')
+state_changes = metrics.counter(
+    'pool_bridge_state_changes_total', 'Callbacks that actually changed the state.')
+panel_disconnects = metrics.counter(
+    'pool_bridge_panel_disconnects_total',
+    'Times the reader lost the panel and reconnected, by reason.', label='reason')
+serial_frames = metrics.counter(
+    'pool_bridge_serial_frames_total', 'Frame starts seen on the RS-485 line.')
+callback_seconds = metrics.histogram(
+    'pool_bridge_callback_seconds', 'Time spent in on_data_changed().')
+build_state_seconds = metrics.histogram(
+    'pool_bridge_build_state_seconds', 'Time to read the panel and rebuild the state on a change.')
+http_seconds = metrics.histogram(
+    'pool_bridge_http_request_seconds',
+    'REST request latency by route (event streams excluded).', label='route')
+http_responses = metrics.counter(
+    'pool_bridge_http_responses_total', 'HTTP responses by status code.', label='code')
+sse_bytes = metrics.counter(
+    'pool_bridge_sse_bytes_total', 'Bytes written to event streams.')
+sse_dropped = metrics.counter(
+    'pool_bridge_sse_dropped_frames_total', 'Frames dropped for slow stream clients.')
+set_state_seconds = metrics.histogram(
+    'pool_bridge_set_state_seconds', 'Latency of panel set_state() calls.')
+set_state_errors = metrics.counter(
+    'pool_bridge_set_state_errors_total', 'set_state() calls that raised.')
+snapshot_writes = metrics.counter(
+    'pool_bridge_snapshot_writes_total', 'Times the state snapshot was written to disk.')
+rate_limited = metrics.counter(
+    'pool_bridge_rate_limited_total', 'Requests refused with 429, by kind.', label='kind')
+sse_slow = metrics.counter(
+    'pool_bridge_sse_slow_batches_total',
+    'Backlogs sent to a slow stream client as one full state instead of every patch.')
+sse_write_timeouts = metrics.counter(
+    'pool_bridge_sse_write_timeouts_total',
+    'Stream clients dropped because a write blocked for SSE_WRITE_TIMEOUT.')
+rules_fired = metrics.counter(
+    'pool_bridge_rules_fired_total', 'Times an automation rule queued its circuits.')
+replica_events = metrics.counter(
+    'pool_bridge_replica_events_total', 'Events received from the primary (replicas only).')
+replica_disconnects = metrics.counter(
+    'pool_bridge_replica_disconnects_total', 'Times a replica lost its primary\'s stream.')
+forwarded_requests = metrics.counter(
+    'pool_bridge_forwarded_requests_total',
+    'Requests a replica passed to its primary, by status code.', label='code')
+metrics.gauge('pool_bridge_panel_connected', 'Whether each panel is connected.',
+              lambda: {ctx.id: ctx.panel is not None for ctx in list(panels.values())},
+              label='panel')
+metrics.gauge('pool_bridge_state_version', 'Current state version of each panel.',
+              lambda: {ctx.id: ctx.state_version for ctx in list(panels.values())},
+              label='panel')
+metrics.gauge('pool_bridge_sse_clients', 'Open event streams.',
+              lambda: len(all_panels) + sum(len(ctx.broadcaster)
+                                            for ctx in list(panels.values())))
+metrics.gauge('pool_bridge_command_queue_depth', 'Circuit commands waiting to run.',
+              lambda: sum(len(ctx.commands) for ctx in list(panels.values())))
+
+def _command_counts():
+    totals = {}
+    for ctx in list(panels.values()):
+        for status, n in ctx.commands.counts.items():
+            totals[status] = totals.get(status, 0) + n
+    return totals
+
+metrics.counter('pool_bridge_commands_total', 'Circuit commands by outcome.',
+                label='status', fn=_command_counts)
+metrics.counter('process_cpu_seconds_total', 'User and system CPU time.',
+                fn=time.process_time)
+metrics.gauge('process_resident_memory_bytes', 'Resident set size.', _rss_bytes)
+
+# ─── SSE fan-out ──────────────────────────────────────────────────
+class Subscriber:
+    """One SSE client's bounded frame queue; the oldest frame is dropped when full.
+
+    `fields` is the client's ?fields= selection (None for everything).
+    """
+
+    def __init__(self, maxlen=SSE_QUEUE_SIZE, fields=None):
+        self.fields = fields
+        self._frames = deque(maxlen=maxlen)
+        self._ready = threading.Condition()
+        self._lost = False
+        self.dropped = 0
+        self.gap = False      # frames were dropped before the last pop_all()
+        self.slow = False     # the last write to this client took over SSE_SLOW_WRITE
+
+    def push(self, frame):
+        with self._ready:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+                sse_dropped.inc()
+                self._lost = True
+            self._frames.append(frame)
+            self._ready.notify()
+
+    def pop_all(self, timeout=None):
+        """Block until frames arrive (or timeout); returns them oldest first."""
+        with self._ready:
+            if not self._frames:
+                self._ready.wait(timeout)
+            frames = list(self._frames)
+            self._frames.clear()
+            self.gap, self._lost = self._lost, False
+        return frames
+
+class AsyncSubscriber(Subscriber):
+    """Subscriber consumed by a coroutine on `loop` instead of a thread."""
+
+    def __init__(self, loop, maxlen=SSE_QUEUE_SIZE, fields=None):
+        super().__init__(maxlen, fields)
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def push(self, frame):
+        super().push(frame)
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass  # loop already closed
+
+    async def next_batch(self, timeout):
+        """Async pop_all(): wait up to timeout for frames."""
+        # A timer setting the event rather than wait_for() (see _deadline)
+        if not self._event.is_set():
+            timer = asyncio.get_running_loop().call_later(timeout, self._event.set)
+            try:
+                await self._event.wait()
+            finally:
+                timer.cancel()
+        self._event.clear()
+        return self.pop_all(timeout=0)
+
+class Broadcaster:
+    """Pushes each published frame to every subscriber.
+
+    Clients sleep on their own queue until something is published, so an
+    idle panel costs nothing per client. A client with a ?fields= selection
+    is only woken by changes that touch it; that check runs once per
+    change for each distinct selection (StateChange.touches caches it).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, maxlen=SSE_QUEUE_SIZE, loop=None, fields=None):
+        """New subscriber; pass an asyncio loop for an AsyncSubscriber."""
+        sub = (Subscriber(maxlen, fields) if loop is None
+               else AsyncSubscriber(loop, maxlen, fields))
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, frame):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            if sub.fields is None or frame.touches(sub.fields):
+                sub.push(frame)
+
+def diff_state(old, new):
+    """Return the keys of new whose values differ from old.
+
+    Circuits are compared one by one, so a single toggle yields
+    {'circuits': {'SPA': True}} rather than all 17 entries. Keys new no
+    longer has (such as staleSince) map to None, as in a JSON merge patch.
+    """
+    patch = {}
+    for key, value in new.items():
+        if key == 'circuits' and isinstance(old.get(key), dict):
+            before = old[key]
+            changed = {name: on for name, on in value.items() if before.get(name) != on}
+            if changed:
+                patch[key] = changed
+        elif key not in old or old[key] != value:
+            patch[key] = value
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    return patch
+
+def _encode(data):
+    return json.dumps(data, separators=(',', ':'))
+
+class StateChange:
+    """One published state version and its encodings.
+
+    SSE frames and REST bodies are encoded on first use and then shared by
+    every client, so each version is serialized at most once per format
+    (and per ?fields= selection).
+    """
+    __slots__ = ('version', 'state', 'patch', 'panel_id', '_frames', '_bodies')
+
+    def __init__(self, version, state, patch, panel_id=None):
+        self.version = version
+        self.state = state
+        self.patch = patch
+        self.panel_id = panel_id
+        self._frames = {}
+        self._bodies = {}
+
+    @property
+    def event_id(self):
+        return f'{BOOT_ID}-{self.version}'
+
+    @property
+    def full_frame(self):
+        return self.frame('full')
+
+    @property
+    def delta_frame(self):
+        return self.frame('delta')
+
+    @property
+    def panel_frame(self):
+        """Full frame for /panels/events, tagged with the panel it came from."""
+        return self.frame('panel')
+
+    @property
+    def panel_delta_frame(self):
+        return self.frame('panel_delta')
+
+    def touches(self, fields):
+        """Whether this change altered anything in a ?fields= selection."""
+        hit = self._frames.get(fields)
+        if hit is None:
+            hit = self._frames[fields] = bool(select_fields(self.patch, fields))
+        return hit
+
+    def frame(self, kind, fields=None):
+        """SSE frame of `kind` ('full', 'delta', 'panel' or 'panel_delta'),
+        cut down to a ?fields= selection if one is given, or a 'binary'
+        stream record (always the whole state)."""
+        key = (kind, fields)
+        frame = self._frames.get(key)
+        if frame is None and kind == 'binary':
+            body = self.body('binary')
+            frame = self._frames[key] = BINARY_LENGTH.pack(len(body)) + body
+        elif frame is None:
+            data = self.patch if kind.endswith('delta') else self.state
+            if fields is not None:
+                data = select_fields(data, fields)
+            if kind == 'full':
+                text = f'id: {self.event_id}\ndata: {_encode(data)}\n\n'
+            elif kind == 'delta':
+                text = f'id: {self.event_id}\nevent: patch\ndata: {_encode(data)}\n\n'
+            else:
+                tagged = {'panel': self.panel_id, 'version': self.version,
+                          'state' if kind == 'panel' else 'patch': data}
+                event = 'event: patch\n' if kind == 'panel_delta' else ''
+                text = f'{event}data: {_encode(tagged)}\n\n'
+            frame = self._frames[key] = text.encode()
+        return frame
+
+    @property
+    def etag(self):
+        return f'"{self.event_id}"'
+
+    def body(self, part='all', compressed=False):
+        """Encoded /state/all ('all'), /state/circuits ('circuits') or binary
+        /state/all ('binary') body, optionally gzipped. Built on first
+        request, then reused."""
+        key = (part, compressed)
+        body = self._bodies.get(key)
+        if body is None:
+            if part == 'binary':
+                body = encode_state(self.state, self.version)
+            elif compressed:
+                body = gzip.compress(self.body(part), mtime=0)
+            else:
+                data = self.state if part == 'all' else self.state.get('circuits', {})
+                body = _encode(data).encode()
+            self._bodies[key] = body
+        return body
+
+def parse_event_id(value):
+    """state_version from an SSE Last-Event-ID, or None if it's malformed or
+    was issued before the bridge last restarted."""
+    boot, _, version = (value or '').rpartition('-')
+    if boot != BOOT_ID or not version.isdigit():
+        return None
+    return int(version)
+
 # ─── Shared state ─────────────────────────────────────────────────
+BOOT_ID = os.urandom(4).hex()  # SSE ids from an earlier run never match
 panel = None          # AquaLogic instance (set after connect)
 state_lock = threading.Lock()
 current_state = {}    # latest JSON-serializable state
-ws_clients = set()    # simple polling set (SSE-style)
 state_version = 0     # incremented on every state change
+latest_change = None  # StateChange for state_version (frame cache)
+recent_changes = deque(maxlen=EVENT_HISTORY)  # for Last-Event-ID resume
+last_reading = None   # read_state() tuple behind current_state (on a
+                      # replica, the primary's event id)
+broadcaster = Broadcaster()
+sse_slots = threading.BoundedSemaphore(MAX_SSE_CLIENTS)
 
-def build_state(p):
-    """Build a JSON-serializable dict from the AquaLogic panel."""
-    circuits = {}
-    for name, s in CIRCUIT_MAP.items():
+# JSON key → AquaLogic attribute, in the order read_state() returns them
+STATE_FIELDS = (
+    ('airTemp',          'air_temp'),
+    ('poolTemp',         'pool_temp'),
+    ('spaTemp',          'spa_temp'),
+    ('saltLevel',        'salt_level'),
+    ('poolChlorinator',  'pool_chlorinator'),
+    ('spaChlorinator',   'spa_chlorinator'),
+    ('pumpSpeed',        'pump_speed'),
+    ('pumpPower',        'pump_power'),
+    ('isMetric',         'is_metric'),
+    ('isHeaterEnabled',  'is_heater_enabled'),
+    ('checkSystemMsg',   'check_system_msg'),
+)
+
+def read_state(p):
+    """Read the panel into a flat tuple: STATE_FIELDS values, then one
+    bool per CIRCUIT_MAP entry. Cheap to compare against the last read."""
+    values = [getattr(p, attr) for _, attr in STATE_FIELDS]
+    for s in CIRCUIT_MAP.values():
         try:
-            circuits[name] = p.get_state(s)
+            values.append(p.get_state(s))
         except Exception:
-            circuits[name] = False
+            values.append(False)
+    return tuple(values)
+
+def state_from_values(values):
+    """Turn a read_state() tuple into the JSON-serializable state dict."""
+    n = len(STATE_FIELDS)
+    state = {key: values[i] for i, (key, _) in enumerate(STATE_FIELDS)}
+    state['circuits'] = dict(zip(CIRCUIT_MAP, values[n:]))
+    return state
 
+def build_state(p):
+    """Build a JSON-serializable dict from the AquaLogic panel."""
+    return state_from_values(read_state(p))
+
+def event_fields():
+    """Everything ?fields= accepts: state keys, 'circuits' and 'circuits.<NAME>'."""
+    return ([key for key, _ in STATE_FIELDS] + ['staleSince', 'circuits']
+            + [f'circuits.{name}' for name in CIRCUIT_MAP])
+
+def parse_fields(value):
+    """?fields=poolTemp,circuits.SPA as a frozenset, or None for everything.
+
+    Equal selections give equal sets, so clients asking for the same
+    fields share one cached frame per change. Raises ValueError for an
+    unknown name.
+    """
+    if value is None:
+        return None
+    valid, fields = event_fields(), set()
+    for name in filter(None, (n.strip() for n in value.split(','))):
+        if name.startswith('circuits.'):
+            name = 'circuits.' + name[len('circuits.'):].upper()
+        if name not in valid:
+            raise ValueError(f'Unknown field: {name}')
+        fields.add(name)
+    if not fields:
+        raise ValueError('fields is empty')
+    if 'circuits' in fields:
+        fields = {name for name in fields if not name.startswith('circuits.')}
+    return frozenset(fields)
+
+def select_fields(data, fields):
+    """The part of a state (or patch) dict that a ?fields= selection names."""
+    out = {}
+    for key, value in data.items():
+        if key in fields:
+            out[key] = value
+        elif key == 'circuits':
+            picked = {name: on for name, on in value.items()
+                      if 'circuits.' + name in fields}
+            if picked:
+                out[key] = picked
+    return out
+
+def _frames_for(changes, sub, delta, resync):
+    """Bytes to send one client for a batch of changes.
+
+    Full frames supersede each other, and a delta client that lost patches
+    to an overflow (or never got a snapshot) needs a fresh full frame. So
+    does a slow client with a backlog: one current state reaches it sooner
+    than every patch on the way there.
+    """
+    if delta and not (resync or sub.gap):
+        if not sub.slow or len(changes) == 1:
+            return b''.join(c.frame('delta', sub.fields) for c in changes)
+        sse_slow.inc()
+    return changes[-1].frame('full', sub.fields)
+
+# ─── Binary encoding ──────────────────────────────────────────────
+# For displays that parse JSON slowly (ESP32 and friends): send
+# Accept: application/x-pool-state to /state/all or /events. A state is
+# BINARY_HEADER, BINARY_BODY, then checkSystemMsg as a length byte and
+# UTF-8. Little-endian, no padding; GET /state/schema describes it.
+BINARY_TYPE = 'application/x-pool-state'
+BINARY_STREAM_TYPE = 'application/x-pool-state-stream'   # u16 length + state, repeated
+BINARY_VERSION = 1
+BINARY_MAGIC = b'PS'
+BINARY_HEADER = struct.Struct('<2sBBIH')   # magic, schema version, flags, state version,
+                                           # bit per BINARY_FIELDS entry that is present
+BINARY_FLAGS = ('isMetric', 'isHeaterEnabled', 'staleSince')   # bit 0, 1, 2
+BINARY_FIELDS = (
+    ('airTemp', 'h'), ('poolTemp', 'h'), ('spaTemp', 'h'), ('saltLevel', 'f'),
+    ('poolChlorinator', 'B'), ('spaChlorinator', 'B'), ('pumpSpeed', 'B'),
+    ('pumpPower', 'H'),
+)
+BINARY_BODY = struct.Struct('<' + ''.join(code for _, code in BINARY_FIELDS) + 'I')
+BINARY_LENGTH = struct.Struct('<H')
+BINARY_PING = BINARY_LENGTH.pack(0)   # empty record: keep-alive on binary streams
+
+def encode_state(state, version):
+    """The binary encoding of a state dict (see BINARY_HEADER)."""
+    flags = 0
+    for bit, key in enumerate(BINARY_FLAGS):
+        if state.get(key):
+            flags |= 1 << bit
+    present, values = 0, []
+    for bit, (key, _) in enumerate(BINARY_FIELDS):
+        value = state.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            present |= 1 << bit
+            values.append(value)
+        else:
+            values.append(0)
+    mask = 0
+    circuits = state.get('circuits', {})
+    for bit, name in enumerate(CIRCUIT_MAP):
+        if circuits.get(name):
+            mask |= 1 << bit
+    try:
+        body = BINARY_BODY.pack(*values, mask)
+    except struct.error:   # a reading out of range for its field: send it as missing
+        for bit, (key, code) in enumerate(BINARY_FIELDS):
+            try:
+                struct.pack('<' + code, values[bit])
+            except struct.error:
+                present &= ~(1 << bit)
+                values[bit] = 0
+        body = BINARY_BODY.pack(*values, mask)
+    msg = (state.get('checkSystemMsg') or '').encode()[:255]
+    return (BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, version, present)
+            + body + bytes((len(msg),)) + msg)
+
+def binary_schema():
+    """/state/schema: the binary layout, generated from the structs above."""
+    types = {'h': 'i16', 'H': 'u16', 'I': 'u32', 'B': 'u8', 'f': 'f32'}
+    layout = [
+        {'name': 'magic', 'type': 'char[2]', 'offset': 0, 'value': BINARY_MAGIC.decode()},
+        {'name': 'schemaVersion', 'type': 'u8', 'offset': 2},
+        {'name': 'flags', 'type': 'u8', 'offset': 3, 'bits': list(BINARY_FLAGS)},
+        {'name': 'version', 'type': 'u32', 'offset': 4},
+        {'name': 'present', 'type': 'u16', 'offset': 8,
+         'bits': [key for key, _ in BINARY_FIELDS]},
+    ]
+    offset = BINARY_HEADER.size
+    for key, code in BINARY_FIELDS:
+        layout.append({'name': key, 'type': types[code], 'offset': offset})
+        offset += struct.calcsize('<' + code)
+    layout.append({'name': 'circuits', 'type': 'u32', 'offset': offset,
+                   'bits': list(CIRCUIT_MAP)})
+    offset += 4
+    layout.append({'name': 'checkSystemMsg', 'type': 'u8 length + UTF-8', 'offset': offset})
     return {
-        'airTemp':          p.air_temp,
-        'poolTemp':         p.pool_temp,
-        'spaTemp':          p.spa_temp,
-        'saltLevel':        p.salt_level,
-        'poolChlorinator':  p.pool_chlorinator,
-        'spaChlorinator':   p.spa_chlorinator,
-        'pumpSpeed':        p.pump_speed,
-        'pumpPower':        p.pump_power,
-        'isMetric':         p.is_metric,
-        'isHeaterEnabled':  p.is_heater_enabled,
-        'checkSystemMsg':   p.check_system_msg,
-        'circuits':         circuits,
+        'contentType': BINARY_TYPE,
+        'version': BINARY_VERSION,
+        'byteOrder': 'little',
+        'fixedSize': offset + 1,
+        'layout': layout,
+        'stream': {'contentType': BINARY_STREAM_TYPE,
+                   'record': 'u16 length, then a state; length 0 is a keep-alive'},
     }
 
+def wants_binary(accept):
+    return BINARY_TYPE in (accept or '')
+
+# ─── Panels ───────────────────────────────────────────────────────
+class PanelContext:
+    """One RS-485 panel: its reader, state, event stream and write queue.
+
+    Every panel has its own state_lock, Broadcaster, CommandQueue and
+    PanelSupervisor, so a slow or dead port only holds up the requests
+    and writes for that panel.
+    """
+
+    def __init__(self, panel_id, port):
+        self.id = panel_id
+        self.port = port
+        self.panel = None          # AquaLogic instance (set after connect)
+        self.state_lock = threading.Lock()
+        self.current_state = {}
+        self.state_version = 0
+        self.latest_change = None
+        self.recent_changes = deque(maxlen=EVENT_HISTORY)
+        self.last_reading = None
+        self.broadcaster = Broadcaster()
+        self.commands = CommandQueue(ctx=self)
+        self.rules = RuleEngine(ctx=self)
+        self.supervisor = PanelSupervisor(ctx=self)
+        self.history = None
+        self.capture = None
+        self.callbacks = Counter()   # this panel's share of panel_callbacks
+        self.changes = Counter()     # and of state_changes
+
+    def latest(self):
+        """StateChange for current_state (call with state_lock held)."""
+        if self.latest_change is None or self.latest_change.version != self.state_version:
+            self.latest_change = StateChange(self.state_version, self.current_state,
+                                             self.current_state, self.id)
+        return self.latest_change
+
+    def catch_up(self, last_seen, delta, fields=None):
+        """What a (re)connecting client should be sent first.
+
+        A client that is up to date gets nothing; a delta client whose
+        Last-Event-ID is still in recent_changes gets just the patches it
+        missed (those touching its fields); anyone else gets a full
+        snapshot. Call with state_lock held.
+        """
+        version, recent = self.state_version, self.recent_changes
+        if not version or last_seen == version:
+            return b''
+        if (delta and last_seen is not None and recent
+                and recent[0].version <= last_seen + 1
+                and recent[-1].version == version):
+            return b''.join(c.frame('delta', fields) for c in recent
+                            if c.version > last_seen
+                            and (fields is None or c.touches(fields)))
+        return self.latest().frame('full', fields)
+
+    def circuits(self):
+        """Circuit states read from the panel, or {} before the first reading
+        (a state loaded from the snapshot may be out of date). Call with
+        state_lock held."""
+        if self.last_reading is None:
+            return {}
+        return self.current_state.get('circuits', {})
+
+    def on_data_changed(self, p):
+        """Callback from AquaLogic when any data changes.
+
+        The panel calls back far more often than anything actually changes,
+        so compare the raw readings first and only rebuild, bump the version
+        and notify subscribers on a real change.
+        """
+        start = time.perf_counter()
+        panel_callbacks.inc()
+        self.callbacks.inc()
+        reading = read_state(p)
+        if reading == self.last_reading:
+            callback_seconds.observe(time.perf_counter() - start)
+            return
+        state_changes.inc()
+        self.changes.inc()
+        new_state = state_from_values(reading)
+        build_state_seconds.observe(time.perf_counter() - start)
+        self.publish(new_state, reading)
+        callback_seconds.observe(time.perf_counter() - start)
+
+    def publish(self, new_state, reading):
+        """Make new_state the next state version and hand it to streams,
+        the write queue, rules, history and the snapshot. `reading` becomes
+        last_reading. Returns the StateChange."""
+        with self.state_lock:
+            change = StateChange(self.state_version + 1, new_state,
+                                 diff_state(self.current_state, new_state), self.id)
+            first_live = self.last_reading is None
+            self.last_reading = reading
+            self.current_state = new_state
+            self.state_version = change.version
+            self.latest_change = change
+            self.recent_changes.append(change)
+            # Publishing under the lock keeps changes in version order and lets
+            # new streams snapshot + subscribe without missing one.
+            self.broadcaster.publish(change)
+            all_panels.publish(change)
+        self.commands.wake()
+        self.rules.evaluate(change)
+        if self.history is not None:
+            self.history.record(change, full=first_live)
+        if snapshots is not None:
+            snapshots.note()
+        log.debug('State updated (%s): air=%s pool=%s spa=%s', self.id,
+                  new_state.get('airTemp'), new_state.get('poolTemp'),
+                  new_state.get('spaTemp'))
+        return change
+
+def _module_global(name):
+    return property(lambda self: globals()[name],
+                    lambda self, value: globals().__setitem__(name, value))
+
+class DefaultPanel(PanelContext):
+    """The panel behind the unprefixed routes (/state/all, /events, ...).
+
+    Its state is the module globals above, which single-panel setups,
+    the tests and the benchmarks read and patch directly.
+    """
+    port = _module_global('SERIAL_PORT')
+    panel = _module_global('panel')
+    state_lock = _module_global('state_lock')
+    current_state = _module_global('current_state')
+    state_version = _module_global('state_version')
+    latest_change = _module_global('latest_change')
+    recent_changes = _module_global('recent_changes')
+    last_reading = _module_global('last_reading')
+    broadcaster = _module_global('broadcaster')
+    commands = _module_global('commands')
+    rules = _module_global('rules')
+    supervisor = _module_global('supervisor')
+    history = _module_global('history')
+    capture = _module_global('capture')
+
+    def __init__(self, panel_id='default'):
+        self.id = panel_id
+        self.callbacks = Counter()
+        self.changes = Counter()
+
+default_panel = DefaultPanel()
+panels = {default_panel.id: default_panel}   # id -> PanelContext, in --panel order
+all_panels = Broadcaster()   # every panel's changes, for /panels/events
+PANEL_ID = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+def configure_panels(specs):
+    """Register (id, serial port) pairs; the first one becomes the default
+    panel, served on the unprefixed routes as well as under /panels/<id>/."""
+    global SERIAL_PORT
+    for panel_id, _ in specs:
+        if not PANEL_ID.fullmatch(panel_id) or panel_id == 'events':
+            raise ValueError(f'invalid panel id: {panel_id!r}')
+    if len({panel_id for panel_id, _ in specs}) != len(specs):
+        raise ValueError('panel ids must be unique')
+    (default_panel.id, SERIAL_PORT), rest = specs[0], specs[1:]
+    panels.clear()
+    panels[default_panel.id] = default_panel
+    for panel_id, port in rest:
+        panels[panel_id] = PanelContext(panel_id, port)
+
+def find_panel(path):
+    """(PanelContext, route) for a request path.
+
+    /panels/<id>/state/all is /state/all on panel <id>; any other path
+    belongs to the default panel. The context is None for an unknown id.
+    """
+    if path.startswith('/panels/'):
+        panel_id, sep, rest = path[len('/panels/'):].partition('/')
+        if sep:
+            return panels.get(panel_id), '/' + rest
+    return default_panel, path
+
+def _latest_change():
+    return default_panel.latest()
+
+def _catch_up(last_seen, delta, fields=None):
+    return default_panel.catch_up(last_seen, delta, fields)
+
 def on_data_changed(p):
-    """Callback from AquaLogic when any data changes."""
-    global current_state, state_version
-    new_state = build_state(p)
-    with state_lock:
-        current_state = new_state
-        state_version += 1
-    log.debug('State updated: air=%s pool=%s spa=%s',
-              new_state.get('airTemp'), new_state.get('poolTemp'),
-              new_state.get('spaTemp'))
+    """Callback from AquaLogic for the default panel."""
+    default_panel.on_data_changed(p)
+
+def _panel_snapshot(fields=None):
+    """Full /panels/events frames for every panel that has a state, and the
+    version each one was sent at."""
+    frames, seen = [], {}
+    for ctx in list(panels.values()):
+        with ctx.state_lock:
+            if ctx.state_version:
+                change = ctx.latest()
+                frames.append(change.frame('panel', fields))
+                seen[ctx.id] = change.version
+    return b''.join(frames), seen
+
+def _panel_frames(changes, sub, delta, seen):
+    """Bytes to send one /panels/events client for a batch of changes.
+
+    Changes from different panels interleave, so a full frame only
+    supersedes earlier ones for the same panel, and a client that lost
+    frames to an overflow gets a fresh snapshot of every panel. `seen`
+    (panel id -> version sent) is updated in place.
+    """
+    if sub.gap:
+        frames, versions = _panel_snapshot(sub.fields)
+        seen.update(versions)
+        return frames
+    fresh = [c for c in changes if c.version > seen.get(c.panel_id, 0)]
+    for c in fresh:
+        seen[c.panel_id] = c.version
+    if delta and (not sub.slow or len(fresh) <= 1):
+        return b''.join(c.frame('panel_delta', sub.fields) for c in fresh)
+    if delta:
+        sse_slow.inc()
+    latest = {c.panel_id: c for c in fresh}
+    return b''.join(c.frame('panel', sub.fields) for c in latest.values())
+
+# ─── Panel writes ─────────────────────────────────────────────────
+class Command:
+    """One requested circuit change and, once finished, its outcome.
+
+    status: queued → running → done | skipped | superseded | failed
+    """
+
+    def __init__(self, cmd_id, circuit, state):
+        self.id = cmd_id
+        self.circuit = circuit
+        self.state = state
+        self.status = 'queued'
+        self.ok = None
+        self.error = None
+        self.superseded_by = None
+        self.submitted = time.monotonic()
+        self.finished = None
+        self.done = threading.Event()
+
+    def finish(self, status, ok=None, error=None):
+        self.status, self.ok, self.error = status, ok, error
+        self.finished = time.monotonic()
+        self.done.set()
+
+    def as_dict(self):
+        d = {'id': self.id, 'circuit': self.circuit, 'state': self.state,
+             'status': self.status}
+        if self.done.is_set():
+            d['ok'] = self.ok
+            d['latencyMs'] = round((self.finished - self.submitted) * 1000, 1)
+        if self.error:
+            d['error'] = self.error
+        if self.superseded_by:
+            d['supersededBy'] = self.superseded_by
+        return d
+
+class CommandQueue:
+    """Owns every write to the panel, on a single worker thread.
+
+    A newer command for a circuit that is still queued replaces the older
+    one (which finishes as 'superseded'), a command that already matches
+    current_state is answered without touching the panel, and after a
+    keypress a circuit isn't written again until the panel shows the new
+    state (or COMMAND_SETTLE passes). The worker starts on first use.
+    There is one queue per panel; `ctx` is its PanelContext (default: the
+    default panel).
+    """
+
+    def __init__(self, history=COMMAND_HISTORY, ctx=None):
+        self._ctx = ctx
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()   # circuit -> Command, in arrival order
+        self._settling = {}             # circuit -> (desired, deadline)
+        self._commands = OrderedDict()  # id -> Command, bounded by history
+        self._history = history
+        self._ids = itertools.count(1)
+        self._worker = None
+        self._latencies = deque(maxlen=100)
+        self.counts = {'submitted': 0, 'executed': 0, 'skipped': 0,
+                       'superseded': 0, 'failed': 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def ctx(self):
+        return self._ctx or default_panel
+
+    def submit(self, circuit, state):
+        with self._cond:
+            cmd = Command(str(next(self._ids)), circuit, state)
+            self.counts['submitted'] += 1
+            older = self._pending.pop(circuit, None)
+            if older is not None:
+                older.superseded_by = cmd.id
+                self._finish(older, 'superseded', ok=True)
+            self._pending[circuit] = cmd
+            self._commands[cmd.id] = cmd
+            while len(self._commands) > self._history:
+                self._commands.popitem(last=False)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run,
+                                                name='panel-writer', daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return cmd
+
+    def get(self, cmd_id):
+        with self._cond:
+            return self._commands.get(cmd_id)
+
+    def wake(self):
+        """Re-check settling circuits (called when the panel state changes)."""
+        with self._cond:
+            self._cond.notify()
+
+    def metrics(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+        return dict(self.counts, depth=len(self._pending),
+                    latencyMs={'p50': _pct(latencies, 50), 'max': _pct(latencies, 100)})
+
+    def _finish(self, cmd, status, ok=None, error=None):
+        cmd.finish(status, ok, error)
+        self.counts[status if status != 'done' else 'executed'] += 1
+        self._latencies.append((cmd.finished - cmd.submitted) * 1000)
+
+    def _next_runnable(self):
+        """Oldest pending command whose circuit isn't still settling."""
+        now = time.monotonic()
+        ctx = self.ctx
+        with ctx.state_lock:
+            circuits = ctx.circuits()
+            for circuit, (desired, deadline) in list(self._settling.items()):
+                if circuits.get(circuit) == desired or now >= deadline:
+                    del self._settling[circuit]
+        for circuit in self._pending:
+            if circuit not in self._settling:
+                return self._pending.pop(circuit)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                cmd = self._next_runnable()
+                while cmd is None:
+                    self._cond.wait(timeout=0.1 if self._settling else None)
+                    cmd = self._next_runnable()
+                cmd.status = 'running'
+            self._execute(cmd)
+
+    def _execute(self, cmd):
+        ctx = self.ctx
+        p = ctx.panel
+        if p is None and ctx.supervisor.accepting_writes():
+            # Reconnecting: hold the write for a moment rather than fail it
+            grace = cmd.submitted + WRITE_GRACE - time.monotonic()
+            if grace > 0 and ctx.supervisor.connected.wait(grace):
+                p = ctx.panel
+        with ctx.state_lock:
+            current = ctx.circuits().get(cmd.circuit)
+        with self._cond:
+            if current == cmd.state:
+                self._finish(cmd, 'skipped', ok=True)
+                return
+            if p is None:
+                self._finish(cmd, 'failed', error='Not connected to controller')
+                return
+        start = time.perf_counter()
+        try:
+            result = p.set_state(CIRCUIT_MAP[cmd.circuit], cmd.state)
+        except Exception as e:
+            set_state_errors.inc()
+            log.error('set_state error: %s', e)
+            with self._cond:
+                self._finish(cmd, 'failed', error=str(e))
+            return
+        finally:
+            set_state_seconds.observe(time.perf_counter() - start)
+        with self._cond:
+            if current is not None:  # only wait for a state we can observe
+                self._settling[cmd.circuit] = (cmd.state, time.monotonic() + COMMAND_SETTLE)
+            self._finish(cmd, 'done', ok=result)
+
+# Order for applying several circuits at once: valves before the pump,
+# the pump before the heater, then lights and aux. Circuits being turned
+# off go first, in reverse, so the heater stops before the pump does.
+BATCH_ORDER = (
+    'POOL', 'SPA', 'SPILLOVER', 'VALVE_3', 'VALVE_4',
+    'FILTER', 'FILTER_LOW_SPEED',
+    'HEATER_AUTO_MODE', 'HEATER_1', 'SUPER_CHLORINATE',
+    'LIGHTS', 'AUX_1', 'AUX_2', 'AUX_3', 'AUX_4', 'AUX_5', 'AUX_6',
+)
+
+def batch_order(changes):
+    """Sort a {circuit: bool} map into panel-friendly (circuit, bool) pairs."""
+    rank = {name: i for i, name in enumerate(BATCH_ORDER)}
+    offs = sorted((c for c, on in changes.items() if not on),
+                  key=lambda c: rank.get(c, len(rank)), reverse=True)
+    ons = sorted((c for c, on in changes.items() if on),
+                 key=lambda c: rank.get(c, len(rank)))
+    return [(c, False) for c in offs] + [(c, True) for c in ons]
+
+def _pct(ordered, pct):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, len(ordered) * pct // 100)], 1)
+
+commands = CommandQueue()
+
+# ─── Rules ────────────────────────────────────────────────────────
+# A rule sets circuits when all of its conditions become true:
+#   {"when": [{"field": "poolTemp", "op": ">=", "value": 84}], "set": {"HEATER_1": false}}
+#   {"when": [{"time": ["08:00", "16:00"]}], "set": {"FILTER": true, "FILTER_LOW_SPEED": true}}
+# Rules fire on the edge, not while the condition holds, so a circuit
+# someone switches by hand stays that way until the condition goes false
+# and true again.
+
+RULE_OPS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+            '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+RULE_ID = re.compile(r'[A-Za-z0-9_.-]{1,64}')
+HHMM = re.compile(r'([01]?\d|2[0-3]):([0-5]\d)')
+
+def _field_getter(field):
+    if field.startswith('circuits.'):
+        name = field[len('circuits.'):]
+        return lambda state: state.get('circuits', {}).get(name)
+    return lambda state: state.get(field)
+
+def _minutes(hhmm):
+    match = HHMM.fullmatch(str(hhmm))
+    if not match:
+        raise ValueError(f'time must be "HH:MM", not {hhmm!r}')
+    return int(match[1]) * 60 + int(match[2])
+
+class Rule:
+    """A validated rule: its conditions compiled to (field, test) pairs.
+
+    A test takes (state, minute of the local day). Raises ValueError for
+    anything malformed, with a message fit for a 400.
+    """
+
+    def __init__(self, rule_id, spec):
+        if not RULE_ID.fullmatch(rule_id):
+            raise ValueError('rule id must be 1-64 letters, digits, ".", "_" or "-"')
+        if not isinstance(spec, dict):
+            raise ValueError('rule must be a JSON object')
+        when, wanted = spec.get('when'), spec.get('set')
+        if not isinstance(when, list) or not when:
+            raise ValueError('"when" must be a non-empty list of conditions')
+        if not isinstance(wanted, dict) or not wanted:
+            raise ValueError('"set" must be a map of circuit → boolean')
+        self.set = {}
+        for name, on in wanted.items():
+            name = str(name).upper()
+            if name not in CIRCUIT_MAP:
+                raise ValueError(f'Unknown circuit: {name}')
+            if not isinstance(on, bool):
+                raise ValueError('circuit states must be booleans (true/false)')
+            self.set[name] = on
+        self.conditions = [self._compile(cond) for cond in when]
+        self.fields = {field for field, _ in self.conditions}
+        self.id = rule_id
+        self.enabled = spec.get('enabled', True) is not False
+        self.spec = {'when': when, 'set': self.set, 'enabled': self.enabled}
+        self.active = False      # all conditions held at the last evaluation
+        self.fired = 0
+        self.last_fired = None
+
+    @staticmethod
+    def _compile(cond):
+        if not isinstance(cond, dict):
+            raise ValueError('each condition must be a JSON object')
+        if 'time' in cond:
+            window = cond['time']
+            if not isinstance(window, list) or len(window) != 2:
+                raise ValueError('"time" must be ["HH:MM", "HH:MM"]')
+            start, end = _minutes(window[0]), _minutes(window[1])
+            if start <= end:
+                return 'time', lambda state, minute: start <= minute < end
+            return 'time', lambda state, minute: minute >= start or minute < end
+        field, op, value = cond.get('field'), cond.get('op', '=='), cond.get('value')
+        if field not in event_fields() or field in ('circuits', 'staleSince'):
+            raise ValueError(f'Unknown field: {field}')
+        if op not in RULE_OPS:
+            raise ValueError(f'op must be one of {", ".join(RULE_OPS)}')
+        if isinstance(value, (dict, list)):
+            raise ValueError('"value" must be a number, string, boolean or null')
+        get, compare = _field_getter(field), RULE_OPS[op]
+
+        def test(state, minute):
+            try:
+                return compare(get(state), value)
+            except TypeError:    # e.g. None < 84 before the first reading
+                return False
+        return field, test
+
+    def holds(self, state, minute):
+        return all(test(state, minute) for _, test in self.conditions)
+
+    def as_dict(self):
+        return dict(self.spec, id=self.id, active=self.active, fired=self.fired,
+                    lastFired=self.last_fired)
+
+class RuleEngine:
+    """A panel's rules, checked against its state as it changes.
+
+    Rules are indexed by the fields their conditions read, so a change
+    only re-checks the rules that depend on something it touched; rules
+    with a time window are also re-checked every RULE_TICK seconds.
+    Nothing is evaluated until the panel has been read (a state from the
+    snapshot may be out of date). Matching rules act through the panel's
+    CommandQueue, like any other write.
+    """
+
+    def __init__(self, ctx=None):
+        self._ctx = ctx
+        self._lock = threading.Lock()
+        self._rules = OrderedDict()   # id -> Rule
+        self._by_field = {}           # field -> [Rule], enabled rules only
+        self._primed = False          # every rule checked once against live state
+
+    def __len__(self):
+        return len(self._rules)
+
+    @property
+    def ctx(self):
+        return self._ctx or default_panel
+
+    def list(self):
+        with self._lock:
+            return [rule.as_dict() for rule in self._rules.values()]
+
+    def get(self, rule_id):
+        with self._lock:
+            rule = self._rules.get(rule_id)
+            return rule and rule.as_dict()
+
+    def specs(self):
+        """{id: spec} for saving."""
+        with self._lock:
+            return {rule.id: rule.spec for rule in self._rules.values()}
+
+    def put(self, rule):
+        """Add or replace a rule; returns True if it is new. The rule is
+        checked straight away, so one whose conditions already hold fires."""
+        with self._lock:
+            created = rule.id not in self._rules
+            self._rules[rule.id] = rule
+            self._reindex()
+        self._check([rule])
+        return created
+
+    def delete(self, rule_id):
+        with self._lock:
+            if self._rules.pop(rule_id, None) is None:
+                return False
+            self._reindex()
+            return True
+
+    def _reindex(self):
+        index = {}
+        for rule in self._rules.values():
+            if rule.enabled:
+                for field in rule.fields:
+                    index.setdefault(field, []).append(rule)
+        self._by_field = index
+
+    def evaluate(self, change=None):
+        """Re-check the rules a StateChange could affect, or with no change
+        (the clock tick), those with a time window."""
+        if change is not None and not self._primed:
+            with self._lock:
+                candidates = list(self._rules.values())
+            self._primed = self._check(candidates)
+            return
+        index = self._by_field
+        if not index:
+            return
+        if change is None:
+            candidates = index.get('time', ())
+        else:
+            touched = [key for key in change.patch if key != 'circuits']
+            touched += ['circuits.' + name for name in change.patch.get('circuits', ())]
+            candidates = {id(rule): rule for field in touched
+                          for rule in index.get(field, ())}.values()
+        self._check(candidates)
+
+    def _check(self, candidates):
+        """Fire the candidates whose conditions have just started to hold.
+        Returns False (checking nothing) if the panel hasn't been read yet."""
+        ctx = self.ctx
+        with ctx.state_lock:
+            if ctx.last_reading is None:
+                return False
+            state = ctx.current_state
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        wanted = {}
+        with self._lock:
+            for rule in candidates:
+                holds = rule.enabled and rule.holds(state, minute)
+                if holds and not rule.active:
+                    rule.fired += 1
+                    rule.last_fired = int(time.time())
+                    rules_fired.inc()
+                    log.info('Rule %s (%s): setting %s', rule.id, ctx.id, rule.set)
+                    wanted.update(rule.set)
+                rule.active = holds
+        for circuit, on in batch_order(wanted):
+            ctx.commands.submit(circuit, on)
+        return True
+
+rules = RuleEngine()
+_rules_file_lock = threading.Lock()
+
+def save_rules(path=None):
+    """Write every panel's rules to RULES_PATH (readable, for hand edits)."""
+    path = path or RULES_PATH
+    with _rules_file_lock:
+        saved = {ctx.id: ctx.rules.specs() for ctx in list(panels.values())}
+        _write_atomic(path, json.dumps({'format': 1, 'panels': saved}, indent=1))
+
+def load_rules(path=None):
+    """Load saved rules into their panels; returns how many were loaded."""
+    path = path or RULES_PATH
+    try:
+        with open(path) as f:
+            saved = json.load(f)['panels']
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning('Ignoring rules file %s: %s', path, e)
+        return 0
+    loaded = 0
+    for ctx in list(panels.values()):
+        for rule_id, spec in (saved.get(ctx.id) or {}).items():
+            try:
+                ctx.rules.put(Rule(rule_id, spec))
+                loaded += 1
+            except ValueError as e:
+                log.warning('Skipping rule %s: %s', rule_id, e)
+    return loaded
+
+def run_rule_clock(stop=None):
+    """Re-check time-of-day rules on every panel every RULE_TICK seconds."""
+    stop = stop or threading.Event()
+    while not stop.wait(RULE_TICK):
+        for ctx in list(panels.values()):
+            try:
+                ctx.rules.evaluate()
+            except Exception:
+                log.exception('Rule check failed for %s', ctx.id)
+
+# ─── History ──────────────────────────────────────────────────────
+HISTORY_FIELDS = ('airTemp', 'poolTemp', 'spaTemp', 'saltLevel',
+                  'pumpSpeed', 'pumpPower')
+HISTORY_RECORD = struct.Struct('<If')  # unix time, value — 8 bytes per sample
+
+def is_history_field(field):
+    """True for recorded fields: HISTORY_FIELDS or 'circuits.<NAME>'."""
+    return field in HISTORY_FIELDS or (
+        field.startswith('circuits.') and field[len('circuits.'):] in CIRCUIT_MAP)
+
+class HistoryStore:
+    """Append-only time series of readings and circuit transitions.
+
+    Each field gets a directory of per-day (UTC) files of fixed 8-byte
+    records, so a query only reads the field it asks for. Samples are
+    buffered in memory and appended every HISTORY_FLUSH seconds to spare
+    the SD card, and each day file starts with a checkpoint of the last
+    known value so it can be read on its own. Once a day, raw files older
+    than HISTORY_RAW_DAYS are rolled up into hourly means and rollups
+    older than HISTORY_KEEP_DAYS are deleted.
+    """
+
+    def __init__(self, directory, flush_every=HISTORY_FLUSH):
+        self.directory = directory
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._buffers = {}  # field -> bytearray of records not yet on disk
+        self._buffer_day = None
+        self._last_flush = time.monotonic()
+        self._last = {}     # field -> last value recorded (for checkpoints)
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, field, day, kind='raw'):
+        return os.path.join(self.directory, field, f'{day}.{kind}')
+
+    @staticmethod
+    def _day_of(ts):
+        return time.strftime('%Y%m%d', time.gmtime(ts))
+
+    @staticmethod
+    def _values(state):
+        values = {key: state[key] for key in HISTORY_FIELDS
+                  if isinstance(state.get(key), (int, float))}
+        for name, on in (state.get('circuits') or {}).items():
+            values[f'circuits.{name}'] = 1.0 if on else 0.0
+        return values
+
+    def record(self, change, now=None, full=False):
+        """Buffer the recorded fields a StateChange touched, or with `full`
+        every field of its state (the first live reading after a warm
+        start is diffed against the snapshot, so its patch leaves out
+        readings that didn't change while the bridge was down)."""
+        now = time.time() if now is None else now
+        values = self._values(change.state if full else change.patch)
+        if not values:
+            return
+        with self._lock:
+            self._last.update(values)
+            day = self._day_of(now)
+            if day != self._buffer_day:
+                self._flush_locked()
+                self._buffer_day = day
+                # Checkpoint at the top of each day
+                values = dict(self._last, **self._values(change.state))
+                self._start_maintenance(now)
+            for field, value in values.items():
+                buf = self._buffers.setdefault(field, bytearray())
+                buf += HISTORY_RECORD.pack(int(now), value)
+            if time.monotonic() - self._last_flush >= self.flush_every:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        for field, buf in self._buffers.items():
+            if buf:
+                os.makedirs(os.path.join(self.directory, field), exist_ok=True)
+                with open(self._path(field, self._buffer_day), 'ab') as f:
+                    f.write(buf)
+                buf.clear()
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % HISTORY_RECORD.size  # torn last write
+        return HISTORY_RECORD.iter_unpack(data[:usable])
+
+    def query(self, field, start, end, step):
+        """Downsample one field into [bucket_start, value] pairs.
+
+        Numbers average within a bucket; circuits report their last state.
+        Empty buckets carry the previous value forward.
+        """
+        is_circuit = field.startswith('circuits.')
+        nbuckets = max(1, math.ceil((end - start) / step))
+        sums, counts, lasts = [0.0] * nbuckets, [0] * nbuckets, [None] * nbuckets
+        carry = None
+        records = []
+        day = start - start % 86400
+        while day <= end:
+            d = self._day_of(day)
+            for kind in ('hourly', 'raw'):
+                records.extend(self._read(self._path(field, d, kind)))
+            day += 86400
+        with self._lock:
+            records.extend(HISTORY_RECORD.iter_unpack(bytes(self._buffers.get(field, b''))))
+        for ts, value in records:
+            if ts > end:
+                continue
+            if ts < start:
+                carry = value
+                continue
+            i = min(nbuckets - 1, int((ts - start) // step))
+            sums[i] += value
+            counts[i] += 1
+            lasts[i] = value
+        points = []
+        for i in range(nbuckets):
+            if counts[i]:
+                carry = lasts[i] if is_circuit else sums[i] / counts[i]
+            if carry is None:
+                value = None
+            else:
+                value = bool(carry) if is_circuit else round(carry, 1)
+            points.append([start + i * step, value])
+        return points
+
+    def _start_maintenance(self, now):
+        threading.Thread(target=self._maintain, args=(now,), name='history-rollup',
+                         daemon=True).start()
+
+    def _maintain(self, now):
+        """Roll old raw days into hourly means; drop expired rollups."""
+        raw_cutoff = self._day_of(now - HISTORY_RAW_DAYS * 86400)
+        keep_cutoff = self._day_of(now - HISTORY_KEEP_DAYS * 86400)
+        try:
+            fields = os.listdir(self.directory)
+        except OSError:
+            return
+        for field in fields:
+            folder = os.path.join(self.directory, field)
+            try:
+                for name in sorted(os.listdir(folder)):
+                    day, _, kind = name.partition('.')
+                    path = os.path.join(folder, name)
+                    if kind == 'raw' and day < raw_cutoff:
+                        self._rollup(path, self._path(field, day, 'hourly'),
+                                     is_circuit=field.startswith('circuits.'))
+                        os.remove(path)
+                    elif kind == 'hourly' and day < keep_cutoff:
+                        os.remove(path)
+            except OSError as e:
+                log.warning('History maintenance failed for %s: %s', field, e)
+
+    def _rollup(self, raw_path, hourly_path, is_circuit):
+        hours = {}
+        for ts, value in self._read(raw_path):
+            hour = ts - ts % 3600
+            if is_circuit:
+                hours[hour] = (value, 1)    # circuits keep their last state
+            else:
+                total, n = hours.get(hour, (0.0, 0))
+                hours[hour] = (total + value, n + 1)
+        out = bytearray()
+        for hour, (total, n) in sorted(hours.items()):
+            out += HISTORY_RECORD.pack(hour, total / n)
+        tmp = hourly_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(out)
+        os.replace(tmp, hourly_path)
+
+history = None        # HistoryStore, created in main()
+snapshots = None      # SnapshotWriter, created in main()
+
+# ─── Snapshot ─────────────────────────────────────────────────────
+# {"format": 1, "panels": {"<id>": {"savedAt": <unix time>, "state": {...}}}}
+# A state served from the snapshot carries "staleSince": savedAt until the
+# panel is read again.
+
+def _write_atomic(path, text):
+    """Replace the file at path with text: all of it or, after a power cut,
+    none of it."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def save_snapshot(path=None):
+    """Write each panel's last known state to SNAPSHOT_PATH.
+
+    The file is replaced atomically, so a power cut leaves the old
+    snapshot or the new one, never half of either. A panel not read since
+    startup keeps the time its state was originally saved.
+    """
+    path = path or SNAPSHOT_PATH
+    now = int(time.time())
+    saved = {}
+    for ctx in list(panels.values()):
+        with ctx.state_lock:
+            if not ctx.state_version:
+                continue
+            state = dict(ctx.current_state)
+        saved[ctx.id] = {'savedAt': state.pop('staleSince', now), 'state': state}
+    if not saved:
+        return
+    _write_atomic(path, _encode({'format': SNAPSHOT_FORMAT, 'panels': saved}))
+    snapshot_writes.inc()
+
+def load_snapshot(path=None):
+    """Serve the states the last run saved until the panels are read.
+
+    Each panel with a saved state starts at version 1 with it, marked
+    with staleSince, so REST and stream clients get something to show
+    straight away; the first reading from the panel replaces it as an
+    ordinary change. Returns how many panels were loaded.
+    """
+    path = path or SNAPSHOT_PATH
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        log.warning('Ignoring snapshot %s: %s', path, e)
+        return 0
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        log.warning('Ignoring snapshot %s: not format %d', path, SNAPSHOT_FORMAT)
+        return 0
+    loaded = 0
+    for ctx in list(panels.values()):
+        saved = snapshot.get('panels', {}).get(ctx.id)
+        try:
+            state = dict(saved['state'], staleSince=int(saved['savedAt']))
+        except (KeyError, TypeError, ValueError):
+            continue
+        with ctx.state_lock:
+            if not ctx.state_version:
+                ctx.current_state = state
+                ctx.state_version = 1
+                loaded += 1
+    return loaded
+
+class SnapshotWriter:
+    """Keeps the snapshot close to the live state without wearing out the SD card.
+
+    Every change calls note(); a background thread writes at most once
+    every SNAPSHOT_EVERY seconds, and only if something changed since the
+    last write. A burst of changes costs one write, a quiet pool none, and
+    the last change before a quiet spell is still written.
+    """
+
+    def __init__(self, path=None, every=SNAPSHOT_EVERY):
+        self.path = path or SNAPSHOT_PATH
+        self.every = every
+        self._dirty = threading.Event()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name='snapshot', daemon=True).start()
+        return self
+
+    def note(self):
+        self._dirty.set()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            if self._closed.is_set():
+                return
+            self.write()
+            if self._closed.wait(self.every):
+                return
+
+    def write(self):
+        with self._lock:
+            self._dirty.clear()
+            try:
+                save_snapshot(self.path)
+            except OSError as e:
+                log.warning('Could not save snapshot: %s', e)
+
+    def close(self):
+        """Stop the thread and write the final state."""
+        self._closed.set()
+        self._dirty.set()
+        self.write()
+
+# ─── Replication (--replicate) ────────────────────────────────────
+# A replica serves another bridge's state to its own clients. It holds one
+# delta-mode /events stream to the primary and republishes every change,
+# so /state/*, /events and /health are answered locally however many
+# viewers there are. Writes, /commands, /history and /rules belong to the
+# primary and are forwarded to it.
+REPLICA_FORWARDED = ('/commands/', '/history', '/rules')   # GETs the primary answers
+
+_SCHEMA_KEYS = frozenset(key for key, _ in STATE_FIELDS)
+
+def apply_patch(state, patch):
+    """A copy of state with a delta-mode patch merged in (the inverse of
+    diff_state): circuits merge one by one, and None removes a key unless
+    it is a panel reading, which stays in the state as null."""
+    new = dict(state)
+    for key, value in patch.items():
+        if value is None and key not in _SCHEMA_KEYS:
+            new.pop(key, None)
+        elif key == 'circuits' and isinstance(new.get(key), dict):
+            new[key] = {**new[key], **value}
+        else:
+            new[key] = value
+    return new
+
+def read_sse(lines):
+    """(event, id, data) for each event in an iterable of SSE lines (bytes).
+    Comments (the primary's pings) yield nothing."""
+    event, event_id, data = 'message', None, []
+    for line in lines:
+        line = line.decode().rstrip('\r\n')
+        if not line:
+            if data:
+                yield event, event_id, '\n'.join(data)
+            event, data = 'message', []
+        elif not line.startswith(':'):
+            key, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if key == 'event':
+                event = value
+            elif key == 'id':
+                event_id = value
+            elif key == 'data':
+                data.append(value)
+
+class Replica:
+    """Follows a primary bridge and republishes its state on a panel here.
+
+    The stream resumes from the last event id seen, so a short outage costs
+    only the patches missed; a restarted primary (whose old ids no longer
+    match) sends its full state instead. Changes get this bridge's own
+    versions, so local clients never see a version go backwards when the
+    primary restarts. While the primary is unreachable the state carries
+    staleSince, as a snapshot does after a cold start. `ctx` is the panel
+    to publish on (default: the default panel).
+    """
+
+    def __init__(self, url, ctx=None):
+        parts = urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise ValueError(f'primary must be an http:// URL, not {url!r}')
+        self.url = url
+        self.address = (parts.hostname, parts.port or 80)
+        self.base = parts.path.rstrip('/')   # '' or /panels/<id>
+        self._ctx = ctx
+        self.connected = threading.Event()
+        self.primary = None    # the primary's state as last received
+        self.last_id = None    # its event id
+        self._failures = 0
+        self._local = threading.local()   # per-thread connection for forward()
+
+    @property
+    def ctx(self):
+        return self._ctx or default_panel
+
+    def status(self):
+        return {'primary': self.url, 'connected': self.connected.is_set(),
+                'lastEventId': self.last_id}
+
+    def apply(self, event, event_id, data):
+        """Merge one event into the primary's state and republish it if
+        anything changed. False for a patch with no state to apply it to."""
+        replica_events.inc()
+        if event == 'patch':
+            if self.primary is None:
+                return False
+            self.primary = apply_patch(self.primary, data)
+        else:
+            self.primary = data
+        self.last_id = event_id
+        self._publish(self.primary, event_id)
+        return True
+
+    def _publish(self, state, reading):
+        ctx = self.ctx
+        with ctx.state_lock:
+            if ctx.state_version and not diff_state(ctx.current_state, state):
+                ctx.last_reading = reading   # e.g. a full state after a resync
+                return
+        state_changes.inc()
+        ctx.changes.inc()
+        ctx.publish(state, reading)
+
+    def mark_stale(self):
+        """Flag the state as last known while the primary is unreachable."""
+        with self.ctx.state_lock:
+            state = self.ctx.current_state
+        if self.primary is not None and 'staleSince' not in state:
+            self._publish(dict(state, staleSince=int(time.time())), None)
+
+    def backoff(self):
+        delay = min(RECONNECT_MAX, RECONNECT_MIN * 2 ** self._failures)
+        self._failures += 1
+        return random.uniform(delay / 2, delay)
+
+    def follow(self):
+        """One stream from the primary; returns why it ended."""
+        conn = http.client.HTTPConnection(*self.address, timeout=REPLICA_STALL)
+        headers = {'Accept': 'text/event-stream'}
+        if self.last_id is not None:
+            headers['Last-Event-ID'] = self.last_id
+        try:
+            conn.request('GET', self.base + '/events?mode=delta', headers=headers)
+            resp = conn.getresponse()
+            if resp.status != 200:
+                log.warning('Primary %s answered %d', self.url, resp.status)
+                return 'status'
+            self.connected.set()
+            log.info('Replicating %s', self.url)
+            if self.primary is not None:
+                # Resumed with nothing missed: no event comes, so drop staleSince now
+                self._publish(self.primary, self.last_id)
+            for event, event_id, data in read_sse(resp):
+                if not self.apply(event, event_id, json.loads(data)):
+                    self.last_id = None
+                    return 'resync'
+                self._failures = 0   # it delivered; retry fast next time
+            log.warning('Primary %s closed the stream', self.url)
+            return 'eof'
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            log.warning('Lost primary %s: %s', self.url, e)
+            return 'error'
+        finally:
+            self.connected.clear()
+            conn.close()
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if self.follow() == 'resync':
+                continue
+            replica_disconnects.inc()
+            self.mark_stale()
+            delay = self.backoff()
+            log.info('Reconnecting to primary in %.2f seconds...', delay)
+            stop.wait(delay)
+
+    def localize(self, body):
+        """The primary's JSON answer with its `location` (a /commands/<id>
+        under the primary's panel prefix) moved under this panel's, so a
+        client of the mirror can follow it here."""
+        local = '' if self.ctx is default_panel else f'/panels/{self.ctx.id}'
+        if self.base == local or b'"location"' not in body:
+            return body
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return body
+        location = data.get('location') if isinstance(data, dict) else None
+        if not isinstance(location, str) or not location.startswith(self.base + '/'):
+            return body
+        data['location'] = local + location[len(self.base):]
+        return json.dumps(data).encode()
+
+    def forward(self, method, target, body=b'', content_type=None, client=None):
+        """Send one request to the primary over this thread's persistent
+        connection, on behalf of `client` (an address, sent as X-Real-IP);
+        returns (status, content type, body).
+
+        A reused connection the primary has since closed is retried once on
+        a new one; any other failure raises OSError or HTTPException.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(
+                *self.address, timeout=FORWARD_TIMEOUT)
+        headers = {'Content-Type': content_type} if content_type else {}
+        if client:
+            headers['X-Real-IP'] = client
+        while True:
+            reused = conn.sock is not None
+            try:
+                conn.request(method, self.base + target, body=body or None,
+                             headers=headers)
+                resp = conn.getresponse()
+                return (resp.status, resp.getheader('Content-Type', 'application/json'),
+                        resp.read())
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+
+replica = None   # Replica, created in main() with --replicate
+
+# ─── Rate limits ──────────────────────────────────────────────────
+class RateLimiter:
+    """Token buckets per client address.
+
+    Each client may make `burst` requests at once, refilled at `rate` per
+    second. Only the RATE_CLIENTS most recently seen clients are tracked,
+    so a scan from many addresses can't grow the table.
+    """
+
+    def __init__(self, rate, burst, clients=RATE_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.clients = clients
+        self._buckets = OrderedDict()   # address -> (tokens, monotonic time)
+        self._lock = threading.Lock()
+
+    def take(self, client, now=None):
+        """Spend one of client's tokens. Returns 0 if the request may go
+        ahead, else the seconds until a token is available."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[client] = (tokens - 1 if not wait else tokens, now)
+            if len(self._buckets) > self.clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+read_limits = RateLimiter(*RATE_READS) if RATE_READS else None
+write_limits = RateLimiter(*RATE_WRITES) if RATE_WRITES else None
+
+def client_of(peer, real_ip=None, forwarded_for=None):
+    """Who a request is for: the peer's address or, behind a TRUSTED_PROXIES
+    address (nginx, a mirror), the client it names in X-Real-IP or the last
+    X-Forwarded-For entry. None for a request made on the Pi itself."""
+    if peer not in TRUSTED_PROXIES:
+        return peer
+    return real_ip or (forwarded_for or '').rpartition(',')[2].strip() or None
+
+def throttle(method, client):
+    """Seconds client must wait before this request is allowed (0: go
+    ahead). Requests made on the Pi itself are never limited."""
+    kind, limits = (('read', read_limits) if method in ('GET', 'HEAD')
+                    else ('write', write_limits))
+    if client is None or limits is None:
+        return 0
+    wait = limits.take(client)
+    if wait:
+        rate_limited.labels(kind).inc()
+    return wait
+
+# ─── Profiling (/debug/profile) ───────────────────────────────────
+def _thread_cpu(native_id):
+    """CPU ticks a thread has used, from /proc; None where unavailable."""
+    try:
+        with open(f'/proc/self/task/{native_id}/stat', 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return int(fields[11]) + int(fields[12])
+
+class StackSampler:
+    """Samples every thread's Python stack for a while and counts the
+    stacks in collapsed (flamegraph) form.
+
+    The thread that asks for a capture does the sampling, so nothing runs
+    between captures. Unless `idle` is set, a thread's stack only counts
+    when /proc shows it used CPU since the previous sample, so workers
+    waiting on a queue or a socket don't bury the busy ones.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._busy = threading.Lock()   # one capture at a time
+        self._labels = {}               # code object -> frame label
+
+    def capture(self, seconds, idle=False):
+        """({collapsed stack: samples}, sampling passes), or None if another
+        capture is already running."""
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(seconds, idle)
+        finally:
+            self._busy.release()
+
+    def _sample(self, seconds, idle):
+        me = threading.get_ident()
+        stacks, cpu, passes = {}, {}, 0
+        deadline = time.monotonic() + seconds
+        while True:
+            threads = {t.ident: t for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if ident == me or thread is None:
+                    continue
+                if not idle:
+                    used = _thread_cpu(thread.native_id)
+                    before = cpu.get(ident)
+                    cpu[ident] = used
+                    if used is not None and (before is None or used == before):
+                        continue
+                stack = self._collapse(thread.name, frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            passes += 1
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return stacks, passes
+            time.sleep(min(self.interval, left))
+
+    def _collapse(self, thread_name, frame):
+        # Worker pools share a root: http-3 and http-17 are both 'http'
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = (f'{getattr(code, "co_qualname", code.co_name)} '
+                                              f'({os.path.basename(code.co_filename)})')
+            parts.append(label)
+            frame = frame.f_back
+        parts.append(re.sub(r'[-_]\d+$', '', thread_name))
+        return ';'.join(reversed(parts))
+
+def render_collapsed(stacks):
+    """Brendan Gregg's collapsed format: 'root;...;leaf count' per line."""
+    return ''.join(f'{stack} {n}\n' for stack, n in sorted(stacks.items()))
+
+def _profile_token():
+    """The /debug/profile token, or None while profiling is disabled."""
+    if not PROFILE_TOKEN_PATH:
+        return None
+    try:
+        with open(PROFILE_TOKEN_PATH) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+profiler = StackSampler()
 
 # ─── HTTP Server (runs in its own thread) ─────────────────────────
+# Route label for per-route metrics; anything else is counted as 'other'
+# so a scanner can't grow the label set.
+# Per-panel routes are labelled without the /panels/<id> prefix.
+METRIC_ROUTES = ('/state/all', '/state/circuits', '/state/schema',
+                 '/state/circuit/setState', '/commands', '/history', '/rules',
+                 '/health', '/metrics', '/panels', '/debug/profile')
+
+def route_label(path):
+    _, route = find_panel(urlsplit(path).path)
+    if route.startswith('/commands/'):
+        return '/commands'
+    if route.startswith('/rules/'):
+        return '/rules'
+    return route if route in METRIC_ROUTES else 'other'
+
 class PoolHandler(BaseHTTPRequestHandler):
-    """Minimal REST API handler."""
+    """Minimal REST API handler.
+
+    Connections are persistent (HTTP/1.1): a client can send up to
+    KEEPALIVE_MAX requests on one, as long as it is never idle for more
+    than KEEPALIVE_TIMEOUT and no other connection is waiting for a
+    worker. Event streams end their connection.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT   # socket timeout: idle time between requests
+    # Headers and body go out in separate writes; with Nagle on, the body of
+    # every reused-connection response would wait ~40 ms for a delayed ACK
+    disable_nagle_algorithm = True
+    _requests = 0                 # responses sent on this connection
 
     def log_message(self, format, *args):
         log.debug('HTTP %s', format % args)
 
+    def parse_request(self):
+        # Timed only once the request line parsed: a malformed one has no path
+        started = time.perf_counter()
+        if not super().parse_request():
+            return False
+        self._started = started
+        self._timed = True
+        # Only PUT reads a body; a request that leaves one unread can't be
+        # followed by another on the same connection.
+        if self.headers.get('Transfer-Encoding') or (
+                self.command != 'PUT' and self.headers.get('Content-Length', '0') != '0'):
+            self.close_connection = True
+        if self.command != 'OPTIONS':
+            wait = throttle(self.command, self._client())
+            if wait:
+                if self.command == 'PUT':
+                    self.close_connection = True   # its body goes unread
+                self._json_response({'error': 'rate limited',
+                                     'retryAfter': round(wait, 1)}, 429,
+                                    {'Retry-After': str(math.ceil(wait))})
+                return False
+        return True
+
+    def _client(self):
+        return client_of(self.client_address[0], self.headers.get('X-Real-IP'),
+                         self.headers.get('X-Forwarded-For'))
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._await_request():
+            self.handle_one_request()
+
+    def _await_request(self):
+        """Wait for the next request on an idle persistent connection.
+
+        False once the client has been idle for `timeout`, or as soon as
+        other connections are waiting with no idle worker to take them: an
+        idle connection parked in readline() would otherwise hold its
+        worker that long.
+        """
+        server = self.server
+        sock = self.connection
+        sock.settimeout(0)
+        try:
+            if self.rfile.peek(1):   # already sent (or pipelined)
+                return True
+        except OSError:
+            return True   # let handle_one_request() see the error
+        finally:
+            sock.settimeout(self.timeout)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            if select.select([sock], [], [], min(KEEPALIVE_POLL, left))[0]:
+                return True
+            if server.starved():
+                return False
+
+    def handle_one_request(self):
+        self._started = None
+        super().handle_one_request()
+        if self._started is not None and self._timed:
+            http_seconds.labels(route_label(self.path)).observe(
+                time.perf_counter() - self._started)
+
+    def send_response(self, code, message=None):
+        http_responses.labels(int(code)).inc()
+        super().send_response(code, message)
+        self._requests += 1
+        if self._keep_alive():
+            self.send_header('Keep-Alive', f'timeout={KEEPALIVE_TIMEOUT}, '
+                                           f'max={KEEPALIVE_MAX - self._requests}')
+        else:
+            self.send_header('Connection', 'close')
+
+    def _keep_alive(self):
+        """Whether the connection may carry another request after this one."""
+        if getattr(self, 'close_connection', True) or self._requests >= KEEPALIVE_MAX:
+            return False
+        # An idle persistent connection pins a worker thread; give it up
+        # when other connections are left waiting for one.
+        starved = getattr(getattr(self, 'server', None), 'starved', None)
+        return starved is None or not starved()
+
     def _cors(self):
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, PUT, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, PUT, POST, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
 
-    def _json_response(self, data, code=200):
+    def _json_response(self, data, code=200, headers=None):
         body = json.dumps(data).encode()
         self.send_response(code)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self._cors()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _state_response(self, change, part):
+        """Serve a pre-encoded state body with a strong ETag.
+
+        The ETag changes with state_version, so a client that already has
+        the current version gets a bodiless 304. /state/all is sent in the
+        binary encoding to clients that Accept it.
+        """
+        binary = part == 'all' and wants_binary(self.headers.get('Accept'))
+        if binary:
+            part, etag = 'binary', change.etag[:-1] + '-bin"'
+        else:
+            etag = change.etag
+        if_none_match = self.headers.get('If-None-Match', '')
+        if etag in if_none_match or if_none_match.strip() == '*':
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self._cors()
+            self.end_headers()
+            return
+
+        body = change.body(part)
+        compressed = (len(body) >= GZIP_MIN_BYTES
+                      and 'gzip' in self.headers.get('Accept-Encoding', ''))
+        if compressed:
+            body = change.body(part, compressed=True)
+        self.send_response(200)
+        self.send_header('Content-Type', BINARY_TYPE if binary else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
         self._cors()
         self.end_headers()
         self.wfile.write(body)
 
     def do_OPTIONS(self):
         self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.send_header('Access-Control-Max-Age', str(CORS_MAX_AGE))
         self._cors()
         self.end_headers()
 
     def do_GET(self):
-        if self.path == '/state/all':
-            with state_lock:
-                data = dict(current_state)
-            self._json_response(data)
-
-        elif self.path == '/state/circuits':
-            with state_lock:
-                data = current_state.get('circuits', {})
-            self._json_response(data)
-
-        elif self.path.startswith('/ws') or self.path == '/events':
-            # Server-Sent Events stream (simple alternative to WebSocket)
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        ctx, route = find_panel(url.path)
+
+        if ctx is None:
+            self._json_response({'error': 'unknown panel', 'panels': list(panels)}, 404)
+
+        elif (replica is not None and ctx is replica.ctx
+              and route.startswith(REPLICA_FORWARDED)):
+            self._forward(route, url.query)
+
+        elif route in ('/state/all', '/state/circuits'):
+            with ctx.state_lock:
+                change = ctx.latest()
+            self._state_response(change, route.rsplit('/', 1)[1])
+
+        elif route == '/state/schema':
+            self._json_response(binary_schema())
+
+        elif route.startswith('/ws') or route in ('/events', '/panels/events'):
+            try:
+                fields = parse_fields(params.get('fields', [None])[0])
+            except ValueError as e:
+                self._json_response({'error': str(e), 'validFields': event_fields()}, 400)
+                return
+            # Each stream pins a worker thread, so cap them and leave the
+            # rest of the pool free for REST calls.
+            if not sse_slots.acquire(blocking=False):
+                self._json_response({'error': 'too many event streams'}, 503)
+                return
+            # EventSource resends the last id it saw when it reconnects;
+            # ?lastEventId= covers clients that open a fresh EventSource.
+            last_id = (self.headers.get('Last-Event-ID')
+                       or params.get('lastEventId', [None])[0])
+            self._timed = False  # a stream's lifetime isn't request latency
+            delta = params.get('mode') == ['delta']
+            try:
+                if route == '/panels/events':
+                    self._stream_all_panels(delta, fields)
+                elif wants_binary(self.headers.get('Accept')):
+                    self._stream_binary(ctx, fields)
+                else:
+                    self._stream_events(ctx, delta, parse_event_id(last_id), fields)
+            finally:
+                sse_slots.release()
+
+        elif route.startswith('/commands/'):
+            cmd = ctx.commands.get(route[len('/commands/'):])
+            if cmd is None:
+                self._json_response({'error': 'unknown command'}, 404)
+            else:
+                self._command_response(ctx, cmd, self._wait_param(params, 0))
+
+        elif route == '/history':
+            self._history_response(ctx, params)
+
+        elif route == '/rules':
+            self._json_response({'rules': ctx.rules.list()})
+
+        elif route.startswith('/rules/'):
+            rule = ctx.rules.get(route[len('/rules/'):])
+            if rule is None:
+                self._json_response({'error': 'unknown rule'}, 404)
+            else:
+                self._json_response(rule)
+
+        elif route == '/panels':
+            self._json_response({'panels': [{
+                'id': c.id, 'port': c.port, 'connected': c.panel is not None,
+                'version': c.state_version, 'default': c is default_panel,
+            } for c in list(panels.values())]})
+
+        elif route == '/metrics':
+            body = metrics.render().encode()
             self.send_response(200)
-            self.send_header('Content-Type', 'text/event-stream')
-            self.send_header('Cache-Control', 'no-cache')
-            self._cors()
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            last_version = 0
-            try:
-                while True:
-                    if state_version != last_version:
-                        with state_lock:
-                            data = json.dumps(current_state)
-                        last_version = state_version
-                        self.wfile.write(f'data: {data}\n\n'.encode())
-                        self.wfile.flush()
-                    time.sleep(0.5)
-            except (BrokenPipeError, ConnectionResetError, OSError):
-                pass
-
-        elif self.path == '/health':
-            self._json_response({'ok': True, 'connected': panel is not None})
+            self.wfile.write(body)
+
+        elif route == '/debug/profile':
+            self._profile_response(params)
+
+        elif route == '/health':
+            health = {
+                'ok': True,
+                'panel': ctx.id,
+                'connected': ctx.panel is not None,
+                'live': ctx.last_reading is not None,
+                'callbacks': ctx.callbacks.value,
+                'changes': ctx.changes.value,
+                'commands': ctx.commands.metrics(),
+            }
+            if replica is not None and ctx is replica.ctx:
+                health['connected'] = replica.connected.is_set()
+                health['replica'] = replica.status()
+            stale_since = ctx.current_state.get('staleSince')
+            if stale_since is not None:   # still serving the snapshot
+                health['staleAge'] = max(0, int(time.time()) - stale_since)
+            self._json_response(health)
 
         else:
             self._json_response({'error': 'not found'}, 404)
 
+    def _stream_events(self, ctx, delta=False, last_seen=None, fields=None):
+        """Server-Sent Events stream (simple alternative to WebSocket).
+
+        Every event carries the state_version as its id. In delta mode the
+        first event is the full state and later ones are 'patch' events
+        holding only the changed keys. A client resuming from last_seen
+        only gets what it missed (see PanelContext.catch_up). With a
+        ?fields= selection, events carry only those fields and changes
+        that touch none of them are never sent.
+        """
+        self._start_stream()
+        with ctx.state_lock:
+            sub = ctx.broadcaster.subscribe(fields=fields)
+            initial = ctx.catch_up(last_seen, delta, fields)
+            resync = not ctx.state_version
+        try:
+            if initial:
+                self._send(sub, initial)
+            while True:
+                changes = sub.pop_all(timeout=SSE_KEEPALIVE)
+                if not changes:
+                    frames = b': ping\n\n'
+                else:
+                    frames = _frames_for(changes, sub, delta, resync)
+                    resync = False
+                self._send(sub, frames)
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            ctx.broadcaster.unsubscribe(sub)
+
+    def _stream_binary(self, ctx, fields=None):
+        """/events for clients that Accept the binary encoding: the whole
+        state as a length-prefixed record on every change (that touches
+        ?fields=, if given), and an empty record as the keep-alive."""
+        self._start_stream(BINARY_STREAM_TYPE)
+        with ctx.state_lock:
+            sub = ctx.broadcaster.subscribe(fields=fields)
+            initial = ctx.latest().frame('binary') if ctx.state_version else b''
+        try:
+            if initial:
+                self._send(sub, initial)
+            while True:
+                changes = sub.pop_all(timeout=SSE_KEEPALIVE)
+                self._send(sub, changes[-1].frame('binary') if changes else BINARY_PING)
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            ctx.broadcaster.unsubscribe(sub)
+
+    def _stream_all_panels(self, delta=False, fields=None):
+        """/panels/events: every panel's changes on one stream.
+
+        Events carry {"panel": id, "version": n} next to the state (or the
+        patch, in delta mode). There are no event ids to resume from; a
+        reconnecting client starts again from a snapshot of every panel.
+        """
+        self._start_stream()
+        sub = all_panels.subscribe(fields=fields)
+        initial, seen = _panel_snapshot(fields)
+        try:
+            if initial:
+                self._send(sub, initial)
+            while True:
+                changes = sub.pop_all(timeout=SSE_KEEPALIVE)
+                frames = (_panel_frames(changes, sub, delta, seen) if changes
+                          else b': ping\n\n')
+                if frames:
+                    self._send(sub, frames)
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            all_panels.unsubscribe(sub)
+
+    def _send(self, sub, data):
+        """Write to a stream, timing it: a client whose writes back up is
+        marked slow, and one that blocks for SSE_WRITE_TIMEOUT is dropped."""
+        start = time.perf_counter()
+        try:
+            self.wfile.write(data)
+            self.wfile.flush()
+        except TimeoutError:
+            sse_write_timeouts.inc()
+            log.info('Dropping stream to %s: blocked for %d s',
+                     self.client_address[0], SSE_WRITE_TIMEOUT)
+            raise
+        sub.slow = time.perf_counter() - start > SSE_SLOW_WRITE
+        sse_bytes.inc(len(data))
+
+    def _start_stream(self, content_type='text/event-stream'):
+        # A stream has no length; it ends when the connection does, and
+        # may go quiet for longer than an idle keep-alive connection. Only
+        # writes are timed out, and the kernel may only hold a little.
+        self.close_connection = True
+        if hasattr(self, 'connection'):
+            self.connection.settimeout(SSE_WRITE_TIMEOUT)
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                       SSE_SEND_BUFFER)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self._cors()
+        self.end_headers()
+
+    def _profile_response(self, params):
+        """Sample every thread for ?seconds= (default 30) and answer with the
+        stacks in collapsed form, ready for flamegraph.pl or speedscope.
+        Needs 'Authorization: Bearer <token>' matching PROFILE_TOKEN_PATH."""
+        token = _profile_token()
+        if token is None:
+            self._json_response({'error': 'not found'}, 404)
+            return
+        supplied = self.headers.get('Authorization', '').encode()
+        if not hmac.compare_digest(supplied, f'Bearer {token}'.encode()):
+            self._json_response({'error': 'unauthorized'}, 401,
+                                {'WWW-Authenticate': 'Bearer'})
+            return
+        try:
+            seconds = float(params.get('seconds', ['30'])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            self._json_response({'error': f'seconds must be in (0, {PROFILE_MAX_SECONDS}]'},
+                                400)
+            return
+        self._timed = False   # its length is whatever was asked for
+        result = profiler.capture(seconds, idle=params.get('idle') == ['1'])
+        if result is None:
+            self._json_response({'error': 'a profile is already being taken'}, 409)
+            return
+        stacks, passes = result
+        body = render_collapsed(stacks).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Disposition', 'attachment; filename='
+                         f'"pool-bridge-{time.strftime("%Y%m%d-%H%M%S")}.folded"')
+        self.send_header('X-Profile-Samples', str(passes))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _history_response(self, ctx, params):
+        """GET /history?field=poolTemp&from=<unix>&to=<unix>&step=<seconds>"""
+        history = ctx.history
+        if history is None:
+            self._json_response({'error': 'history is disabled'}, 404)
+            return
+        field = params.get('field', [''])[0]
+        if not is_history_field(field):
+            self._json_response({
+                'error': f'Unknown field: {field}',
+                'validFields': list(HISTORY_FIELDS) + [f'circuits.{c}' for c in CIRCUIT_MAP],
+            }, 400)
+            return
+        now = int(time.time())
+        try:
+            end = int(params.get('to', [now])[0])
+            start = int(params.get('from', [end - 86400])[0])
+            step = int(params.get('step', [0])[0])
+        except ValueError:
+            self._json_response({'error': 'from, to and step must be integers'}, 400)
+            return
+        if start >= end:
+            self._json_response({'error': 'from must be before to'}, 400)
+            return
+        # Nothing older than HISTORY_KEEP_DAYS or newer than now is kept, and
+        # every day in the range costs a couple of file opens
+        start = max(start, now - HISTORY_KEEP_DAYS * 86400)
+        end = min(end, now)
+        if start >= end:
+            self._json_response({'error': 'from/to are outside the kept history',
+                                 'keptFrom': now - HISTORY_KEEP_DAYS * 86400}, 400)
+            return
+        # The Pi does the downsampling; never ship more than HISTORY_MAX_POINTS
+        step = max(step, math.ceil((end - start) / HISTORY_MAX_POINTS), 1)
+        self._json_response({'field': field, 'from': start, 'to': end, 'step': step,
+                             'points': history.query(field, start, end, step)})
+
+    def _wait_param(self, params, default):
+        """?wait=<seconds>, clamped to 0..30."""
+        try:
+            return min(max(float(params['wait'][0]), 0), 30)
+        except (KeyError, ValueError):
+            return default
+
+    def _command_response(self, ctx, cmd, wait):
+        """Wait up to `wait` seconds for cmd; 202 with its id if still pending."""
+        if not cmd.done.wait(wait):
+            prefix = '' if ctx is default_panel else f'/panels/{ctx.id}'
+            self._json_response(dict(cmd.as_dict(), location=f'{prefix}/commands/{cmd.id}'), 202)
+        elif cmd.status == 'failed':
+            code = 503 if ctx.panel is None else 500
+            self._json_response(dict(cmd.as_dict(), error=cmd.error), code)
+        else:
+            self._json_response(cmd.as_dict())
+
     def do_PUT(self):
         # Validate Content-Length
         raw_len = self.headers.get('Content-Length', '0')
         try:
             content_len = int(raw_len)
         except (ValueError, TypeError):
+            self.close_connection = True
             self._json_response({'error': 'invalid Content-Length'}, 400)
             return
         if content_len < 0 or content_len > 4096:
+            self.close_connection = True   # the body is left unread
             self._json_response({'error': 'Content-Length out of range'}, 400)
             return
 
         body = self.rfile.read(content_len)
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        ctx, route = find_panel(url.path)
+        if replica is not None and ctx is replica.ctx:
+            self._forward(route, url.query, body)
+            return
+
         try:
             data = json.loads(body) if body else {}
         except json.JSONDecodeError:
             self._json_response({'error': 'invalid JSON'}, 400)
             return
 
-        if self.path == '/state/circuit/setState':
+        if ctx is None:
+            self._json_response({'error': 'unknown panel', 'panels': list(panels)}, 404)
+
+        elif route == '/state/circuit/setState':
             circuit_name = data.get('circuit', '').upper()
             desired = data.get('state', None)
 
@@ -192,55 +2607,828 @@ class PoolHandler(BaseHTTPRequestHandler):
                 }, 400)
                 return
 
-            if panel is None:
+            if not ctx.supervisor.accepting_writes():
                 self._json_response({'error': 'Not connected to controller'}, 503)
                 return
 
+            cmd = ctx.commands.submit(circuit_name, desired)
+            self._command_response(ctx, cmd, self._wait_param(params, COMMAND_TIMEOUT))
+
+        elif route == '/state/circuits':
+            self._set_circuits(ctx, data, self._wait_param(params, COMMAND_TIMEOUT))
+
+        elif route.startswith('/rules/'):
             try:
-                result = panel.set_state(CIRCUIT_MAP[circuit_name], desired)
-                self._json_response({'ok': result, 'circuit': circuit_name, 'state': desired})
-            except Exception as e:
-                log.error('set_state error: %s', e)
-                self._json_response({'error': str(e)}, 500)
+                rule = Rule(route[len('/rules/'):], data)
+            except ValueError as e:
+                self._json_response({'error': str(e)}, 400)
+                return
+            created = ctx.rules.put(rule)
+            self._save_rules()
+            self._json_response(rule.as_dict(), 201 if created else 200)
 
         else:
             self._json_response({'error': 'not found'}, 404)
 
+    def do_DELETE(self):
+        url = urlsplit(self.path)
+        ctx, route = find_panel(url.path)
+        if ctx is None:
+            self._json_response({'error': 'unknown panel', 'panels': list(panels)}, 404)
+        elif replica is not None and ctx is replica.ctx:
+            self._forward(route, url.query)
+        elif not route.startswith('/rules/'):
+            self._json_response({'error': 'not found'}, 404)
+        elif not ctx.rules.delete(route[len('/rules/'):]):
+            self._json_response({'error': 'unknown rule'}, 404)
+        else:
+            self._save_rules()
+            self._json_response({'ok': True})
+
+    def _forward(self, route, query, body=b''):
+        """Answer with the primary's response to this request (replicas only)."""
+        target = route + (f'?{query}' if query else '')
+        try:
+            status, content_type, data = replica.forward(
+                self.command, target, body, self.headers.get('Content-Type'),
+                self._client())
+        except (OSError, http.client.HTTPException) as e:
+            log.warning('Could not forward %s %s to %s: %s', self.command, target,
+                        replica.url, e)
+            forwarded_requests.labels(502).inc()
+            self._json_response({'error': 'primary unreachable'}, 502)
+            return
+        forwarded_requests.labels(status).inc()
+        if content_type.startswith('application/json'):
+            data = replica.localize(data)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self._cors()
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def _save_rules():
+        if RULES_PATH:
+            try:
+                save_rules()
+            except OSError as e:
+                log.warning('Could not save rules: %s', e)
+
+    def _set_circuits(self, ctx, data, wait):
+        """Batch update: {"FILTER": true, "SPA": true, ...} in one request.
+
+        Everything is validated before anything is queued; circuits that
+        already match are reported 'unchanged' and never reach the panel.
+        """
+        if not isinstance(data, dict) or not data:
+            self._json_response({'error': 'body must be a map of circuit → boolean'}, 400)
+            return
+        wanted, errors = {}, {}
+        for name, desired in data.items():
+            name = str(name).upper()
+            if name not in CIRCUIT_MAP:
+                errors[name] = 'unknown circuit'
+            elif not isinstance(desired, bool):
+                errors[name] = 'state must be a boolean (true/false)'
+            else:
+                wanted[name] = desired
+        if errors:
+            self._json_response({'error': 'invalid circuits', 'circuits': errors,
+                                 'validCircuits': list(CIRCUIT_MAP.keys())}, 400)
+            return
+
+        if not ctx.supervisor.accepting_writes():
+            self._json_response({'error': 'Not connected to controller'}, 503)
+            return
+
+        with ctx.state_lock:
+            current = dict(ctx.circuits())
+        results = {name: {'state': desired, 'status': 'unchanged', 'ok': True}
+                   for name, desired in wanted.items() if current.get(name) == desired}
+        submitted = [ctx.commands.submit(name, desired) for name, desired
+                     in batch_order({n: d for n, d in wanted.items() if n not in results})]
+
+        deadline = time.monotonic() + wait
+        for cmd in submitted:
+            cmd.done.wait(max(0, deadline - time.monotonic()))
+            results[cmd.circuit] = cmd.as_dict()
+
+        if any(cmd.status == 'failed' for cmd in submitted):
+            code = 503 if ctx.panel is None else 500
+        elif all(cmd.done.is_set() for cmd in submitted):
+            code = 200
+        else:
+            code = 202
+        self._json_response({'ok': all(r.get('ok') for r in results.values()),
+                             'circuits': results}, code)
+
+class PoolHTTPServer(HTTPServer):
+    """HTTPServer that hands connections to a fixed pool of worker threads.
+
+    A plain HTTPServer serves one request at a time, so a single open
+    /events stream would block every other client. Workers are daemon
+    threads so open streams never hold up shutdown.
+    """
+
+    def __init__(self, server_address, handler_class, workers=HTTP_WORKERS,
+                 backlog=HTTP_BACKLOG):
+        super().__init__(server_address, handler_class)
+        self._pending = queue.Queue(maxsize=backlog)
+        self._idle = 0   # workers waiting on _pending
+        self._idle_lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'http-{i}',
+                             daemon=True).start()
+
+    def process_request(self, request, client_address):
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            log.warning('HTTP backlog full, dropping connection from %s',
+                        client_address[0])
+            self.shutdown_request(request)
+
+    def starved(self):
+        """Whether accepted connections are waiting with no idle worker to
+        take them. A connection queued for an instant while workers are
+        free doesn't count."""
+        return self._pending.qsize() > self._idle
+
+    def _worker(self):
+        while True:
+            with self._idle_lock:
+                self._idle += 1
+            request, client_address = self._pending.get()
+            with self._idle_lock:
+                self._idle -= 1
+            try:
+                self.finish_request(request, client_address)
+            except ConnectionError:
+                pass   # the client dropped the connection, e.g. while it sat idle
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
 def run_http_server():
-    server = HTTPServer(('0.0.0.0', HTTP_PORT), PoolHandler)
-    server.timeout = 1
-    log.info('HTTP server listening on port %d', HTTP_PORT)
-    while True:
-        server.handle_request()
+    server = PoolHTTPServer(('0.0.0.0', HTTP_PORT), PoolHandler)
+    log.info('HTTP server listening on port %d (%d workers, max %d event streams)',
+             HTTP_PORT, HTTP_WORKERS, MAX_SSE_CLIENTS)
+    server.serve_forever()
+
+# ─── Asyncio runtime (optional, --asyncio) ────────────────────────
+# One event loop serves HTTP and holds every SSE stream, so clients cost
+# a coroutine instead of a thread. REST routes still go through
+# PoolHandler (run on an in-memory request), so the API is identical.
+ASYNC_REST_WORKERS = 4   # threads for REST calls that may block (PUT, /history)
+ASYNC_INLINE_ROUTES = ('/state/all', '/state/circuits', '/state/schema', '/health',
+                       '/metrics', '/panels')
+MAX_REQUEST_HEAD = 8192
+
+def _deadline(writer, seconds):
+    """Abort writer's connection in `seconds` unless the returned timer is
+    cancelled first, failing whatever read or drain is waiting on it.
+
+    Used instead of wait_for(), which on Python 3.11 can swallow a cancel
+    that lands just as the awaited call finishes; the cancelled stream
+    then runs on for another keep-alive period.
+    """
+    return asyncio.get_running_loop().call_later(seconds, writer.transport.abort)
+
+def handle_buffered(raw, client_address, served=0):
+    """Run PoolHandler on a complete in-memory request.
+
+    `served` is how many requests the connection has already carried.
+    Returns the response bytes and whether the connection can stay open.
+    """
+    handler = PoolHandler.__new__(PoolHandler)
+    handler.client_address = client_address
+    handler.rfile = io.BytesIO(raw)
+    handler.wfile = io.BytesIO()
+    handler._requests = served
+    handler.handle_one_request()
+    return handler.wfile.getvalue(), not handler.close_connection
+
+def _parse_head(head):
+    """(method, target, {lowercased header: value}) from a raw request head."""
+    lines = head.decode('latin-1').split('\r\n')
+    method, target = (lines[0].split(' ') + ['', ''])[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+class AsyncBridgeServer:
+    """asyncio HTTP/1.1 server with the same routes as PoolHandler."""
+
+    def __init__(self, rest_workers=ASYNC_REST_WORKERS):
+        self._rest = ThreadPoolExecutor(rest_workers, thread_name_prefix='rest')
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self._connection, host, port,
+                                                 limit=MAX_REQUEST_HEAD)
+        return self.server
+
+    async def _connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername') or ('', 0)
+        served = 0
+        try:
+            while True:   # one request per pass while the connection stays open
+                idle = KEEPALIVE_TIMEOUT if served else 30
+                timer = _deadline(writer, idle)
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                finally:
+                    timer.cancel()
+                method, target, headers = _parse_head(head)
+                url = urlsplit(target)
+                ctx, route = find_panel(url.path)
+                params = parse_qs(url.query)
+                if (method == 'GET' and ctx is not None
+                        and (route in ('/events', '/panels/events')
+                             or route.startswith('/ws'))):
+                    try:
+                        fields = parse_fields(params.get('fields', [None])[0])
+                    except ValueError:
+                        pass  # PoolHandler answers with a 400
+                    else:
+                        await self._stream_events(writer, ctx, route == '/panels/events',
+                                                  fields, params, headers)
+                        return
+                body = b''
+                try:
+                    length = int(headers.get('content-length', '0'))
+                except ValueError:
+                    length = -1
+                if 0 < length <= 4096:   # do_PUT rejects anything else unread
+                    timer = _deadline(writer, 30)
+                    try:
+                        body = await reader.readexactly(length)
+                    finally:
+                        timer.cancel()
+                raw = head + body
+                if method in ('GET', 'OPTIONS') and route in ASYNC_INLINE_ROUTES:
+                    response, keep_alive = handle_buffered(raw, client_address, served)
+                else:
+                    loop = asyncio.get_running_loop()
+                    response, keep_alive = await loop.run_in_executor(
+                        self._rest, handle_buffered, raw, client_address, served)
+                served += 1
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        except asyncio.CancelledError:
+            # Shutdown. Nothing awaits a connection task, and on 3.11 the
+            # stream callback logs one that ends cancelled as unhandled.
+            pass
+        finally:
+            writer.close()
+
+    async def _stream_events(self, writer, ctx, aggregate, fields, params, headers):
+        peer = (writer.get_extra_info('peername') or ('',))[0]
+        wait = throttle('GET', client_of(peer, headers.get('x-real-ip'),
+                                         headers.get('x-forwarded-for')))
+        if wait:
+            await self._refuse(writer, b'429 Too Many Requests',
+                               {'error': 'rate limited', 'retryAfter': round(wait, 1)},
+                               b'Retry-After: %d\r\n' % math.ceil(wait))
+            return
+        if not sse_slots.acquire(blocking=False):
+            await self._refuse(writer, b'503 Service Unavailable',
+                               {'error': 'too many event streams'})
+            return
+        delta = params.get('mode') == ['delta']
+        binary = not aggregate and wants_binary(headers.get('accept'))
+        last_seen = parse_event_id(headers.get('last-event-id')
+                                   or params.get('lastEventId', [None])[0])
+        loop = asyncio.get_running_loop()
+        if aggregate:
+            source = all_panels
+            sub = all_panels.subscribe(loop=loop, fields=fields)
+            initial, seen = _panel_snapshot(fields)
+        else:
+            source = ctx.broadcaster
+            with ctx.state_lock:
+                sub = ctx.broadcaster.subscribe(loop=loop, fields=fields)
+                if binary:
+                    initial = ctx.latest().frame('binary') if ctx.state_version else b''
+                else:
+                    initial = ctx.catch_up(last_seen, delta, fields)
+                resync = not ctx.state_version
+        content_type = BINARY_STREAM_TYPE if binary else 'text/event-stream'
+        try:
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SSE_SEND_BUFFER)
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: %s\r\n'
+                         b'Cache-Control: no-cache\r\n'
+                         b'Connection: close\r\n'
+                         b'Access-Control-Allow-Origin: *\r\n\r\n'
+                         % content_type.encode() + initial)
+            await self._drain(writer, sub)
+            sse_bytes.inc(len(initial))
+            while True:
+                changes = await sub.next_batch(SSE_KEEPALIVE)
+                if not changes:
+                    frames = BINARY_PING if binary else b': ping\n\n'
+                elif binary:
+                    frames = changes[-1].frame('binary')
+                elif aggregate:
+                    frames = _panel_frames(changes, sub, delta, seen)
+                else:
+                    frames = _frames_for(changes, sub, delta, resync)
+                    resync = False
+                writer.write(frames)
+                await self._drain(writer, sub)
+                sse_bytes.inc(len(frames))
+        finally:
+            source.unsubscribe(sub)
+            sse_slots.release()
+
+    @staticmethod
+    async def _drain(writer, sub):
+        """drain(), timed like PoolHandler._send: slow clients are marked,
+        and one that blocks for SSE_WRITE_TIMEOUT is dropped."""
+        start = time.perf_counter()
+        timer = _deadline(writer, SSE_WRITE_TIMEOUT)   # aborts: nothing left to flush
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass   # raised below
+        finally:
+            timer.cancel()
+        # An aborted transport lets a waiting drain() return normally
+        if writer.transport.is_closing():
+            if asyncio.get_running_loop().time() >= timer.when():
+                sse_write_timeouts.inc()
+                log.info('Dropping stream to %s: blocked for %d s',
+                         (writer.get_extra_info('peername') or ('?',))[0], SSE_WRITE_TIMEOUT)
+            raise ConnectionResetError('stream closed')
+        sub.slow = time.perf_counter() - start > SSE_SLOW_WRITE
+
+    @staticmethod
+    async def _refuse(writer, status, data, headers=b''):
+        body = _encode(data).encode()
+        writer.write(b'HTTP/1.1 %s\r\n'
+                     b'Content-Type: application/json\r\n'
+                     b'Access-Control-Allow-Origin: *\r\n'
+                     b'Connection: close\r\n%s'
+                     b'Content-Length: %d\r\n\r\n%s' % (status, headers, len(body), body))
+        await writer.drain()
+
+async def _run_asyncio():
+    loop = asyncio.get_running_loop()
+    server = await AsyncBridgeServer().start('0.0.0.0', HTTP_PORT)
+    log.info('HTTP server (asyncio) listening on port %d (max %d event streams)',
+             HTTP_PORT, MAX_SSE_CLIENTS)
+    # The AquaLogic reader is blocking serial I/O; it gets its own thread
+    # and reaches the loop through the broadcaster's call_soon_threadsafe.
+    # A daemon thread, not an executor: it never returns, and an executor's
+    # thread is joined at exit, so SIGTERM would hang until SIGKILL.
+    reader_done = loop.create_future()
+
+    def read():
+        try:
+            run_aqualogic()
+        except BaseException as e:
+            loop.call_soon_threadsafe(reader_done.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(reader_done.set_result, None)
+    threading.Thread(target=read, name='aqualogic', daemon=True).start()
+    # SIGTERM through signal.signal raises SystemExit inside whichever
+    # task happens to be running; stop from the loop instead.
+    stopping = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, lambda: stopping.done() or stopping.set_result(None))
+    async with server:
+        serving = asyncio.ensure_future(server.serve_forever())
+        await asyncio.wait([serving, reader_done, stopping],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if reader_done.done():
+            reader_done.result()
+        log.info('Stopping HTTP server (asyncio)')
+        # Open streams never finish on their own, and wait_closed() on the
+        # way out of the server waits for every connection.
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def run_asyncio():
+    asyncio.run(_run_asyncio())
+
+# ─── Serial capture / replay ──────────────────────────────────────
+# Capture file: CAPTURE_MAGIC, then records of CAPTURE_RECORD
+# (seconds since capture start, byte count) followed by the raw bytes.
+CAPTURE_MAGIC = b'POOLCAP1'
+CAPTURE_RECORD = struct.Struct('<dH')
+
+class SerialRecorder:
+    """Tees the bytes AquaLogic reads from the serial port into a capture file.
+
+    Bytes arriving less than CAPTURE_GAP apart are stored as one record, so
+    a frame burst costs one 10-byte header rather than one per byte.
+    """
+
+    def __init__(self, path, gap=CAPTURE_GAP):
+        self.gap = gap
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._chunk = bytearray()
+        self._chunk_at = self._last = 0.0
+
+    def wrap(self, read):
+        """Wrap a serial read(size) so everything it returns is recorded."""
+        def recording_read(size=1):
+            data = read(size)
+            if data:
+                self.feed(data)
+            return data
+        return recording_read
+
+    def feed(self, data, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._chunk and (now - self._last > self.gap or
+                                len(self._chunk) + len(data) > 0xffff):
+                self._write_chunk()
+            if not self._chunk:
+                self._chunk_at = now - self._start
+            self._chunk += data
+            self._last = now
+
+    def _write_chunk(self):
+        self._file.write(CAPTURE_RECORD.pack(self._chunk_at, len(self._chunk)))
+        self._file.write(self._chunk)
+        self._chunk.clear()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._chunk:
+                self._write_chunk()
+            self._file.close()
+
+def read_capture(path):
+    """Load a capture file as a list of (offset_seconds, bytes)."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError(f'{path} is not a pool_bridge capture')
+    records, pos = [], len(CAPTURE_MAGIC)
+    while pos + CAPTURE_RECORD.size <= len(data):
+        offset, size = CAPTURE_RECORD.unpack_from(data, pos)
+        pos += CAPTURE_RECORD.size
+        records.append((offset, data[pos:pos + size]))
+        pos += size
+    return records
+
+class SerialReplay:
+    """Plays a capture into a pseudo-terminal.
+
+    `port` is the terminal's device path, so AquaLogic.connect_serial()
+    reads the recording exactly as it would /dev/ttyAMA0. speed=1 keeps
+    the recorded timing, 10 plays ten times faster, 0 as fast as the reader
+    keeps up. Anything the bridge writes (key presses) is read and dropped.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.records = read_capture(path)
+        self.size = sum(len(data) for _, data in self.records)
+        self.speed = speed
+        self.loop = loop
+        self.done = threading.Event()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._playing = False
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    def start(self):
+        self._playing = True
+        threading.Thread(target=self._play, daemon=True, name='replay').start()
+        return self
+
+    def _play(self):
+        try:
+            while True:
+                start = time.monotonic()
+                for offset, data in self.records:
+                    if self.speed:
+                        delay = start + offset / self.speed - time.monotonic()
+                        if delay > 0:
+                            self._closed.wait(delay)
+                    if self._closed.is_set():
+                        return
+                    self._write(data)
+                if not self.loop:
+                    break
+        except OSError:
+            pass  # the reader hung up
+        finally:
+            # The master fd is only closed here or after playing stops, so
+            # a recycled fd number can never be written to by mistake.
+            with self._lock:
+                self._playing = False
+                self.done.set()
+                if self._closed.is_set():
+                    os.close(self._master)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view and not self._closed.is_set():
+            readable, writable, _ = select.select([self._master], [self._master], [], 0.5)
+            if readable:
+                os.read(self._master, 4096)
+            if writable:
+                view = view[os.write(self._master, view):]
+
+    def pending(self):
+        """Bytes written but not yet read by the bridge."""
+        buf = bytearray(4)
+        fcntl.ioctl(self._slave, termios.FIONREAD, buf)
+        return int.from_bytes(buf, sys.byteorder)
+
+    def close(self):
+        """Hang up: the reader's next read fails once the master is gone."""
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            if not self._playing:
+                os.close(self._master)
+            os.close(self._slave)
+
+capture = None         # SerialRecorder, created in main() with --capture
 
 # ─── AquaLogic process loop (runs in main thread) ─────────────────
-def run_aqualogic():
-    global panel
-    while True:
+FRAME_DLE, FRAME_STX = 0x10, 0x02
+
+def new_panel():
+    global AquaLogic
+    if AquaLogic is None:
+        from aqualogic.core import AquaLogic
+    try:
+        return AquaLogic(web_port=0)  # disable built-in web server
+    except TypeError:  # aqualogic 3.x has no web server to disable
+        return AquaLogic()
+
+class PanelSupervisor:
+    """Keeps the AquaLogic connection up.
+
+    Failed attempts are retried after RECONNECT_MIN, doubling up to
+    RECONNECT_MAX with jitter; a connection that delivered frames resets
+    the backoff. Each attempt first checks the port can be opened at all,
+    which is cheap enough to repeat every PROBE_INTERVAL while the device
+    is missing (an unplugged USB adapter). A watchdog drops a connection
+    that goes STALL_TIMEOUT without a frame start instead of waiting for
+    process() to give up on its own. Each panel has its own supervisor;
+    `ctx` is its PanelContext (default: the default panel).
+    """
+
+    def __init__(self, ctx=None):
+        self._ctx = ctx
+        self.connected = threading.Event()
+        self.disconnected_at = None   # monotonic time the panel was lost
+        self.last_frame = 0.0
+        self._failures = 0
+        self._stalled = False
+        self._port_missing = False
+
+    @property
+    def ctx(self):
+        return self._ctx or default_panel
+
+    def accepting_writes(self):
+        """Connected, or lost recently enough that writes should wait for it."""
+        if self.ctx.panel is not None:
+            return True
+        lost = self.disconnected_at
+        return lost is not None and time.monotonic() - lost < WRITE_GRACE
+
+    def backoff(self):
+        delay = min(RECONNECT_MAX, RECONNECT_MIN * 2 ** self._failures)
+        self._failures += 1
+        return random.uniform(delay / 2, delay)
+
+    def probe(self, port):
+        try:
+            os.close(os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK))
+        except OSError as e:
+            if not self._port_missing:
+                log.warning('Serial port %s unavailable: %s', port, e.strerror)
+            self._port_missing = True
+            return False
+        self._port_missing = False
+        return True
+
+    def _tap(self, serial_port):
+        """Watch the bytes process() reads for frame starts (DLE STX;
+        stuffing makes that pair unambiguous) and feed --capture."""
+        read = serial_port.read
+        if self.ctx.capture is not None:
+            read = self.ctx.capture.wrap(read)
+        prev = 0
+
+        def watched_read(size=1):
+            nonlocal prev
+            data = read(size)
+            for byte in data:
+                if prev == FRAME_DLE and byte == FRAME_STX:
+                    self.last_frame = time.monotonic()
+                    serial_frames.inc()
+                prev = byte
+            return data
+        serial_port.read = watched_read
+
+    def _watchdog(self, p, serial_port):
+        while self.ctx.panel is p:
+            quiet = time.monotonic() - self.last_frame
+            if quiet > STALL_TIMEOUT:
+                log.warning('No frames on %s for %.0f s, reconnecting',
+                            self.ctx.port, quiet)
+                self._stalled = True
+                serial_port.cancel_read()   # process() sees a timeout and returns
+                return
+            time.sleep(min(1.0, STALL_TIMEOUT / 4))
+
+    def connect(self):
+        """One attempt; returns the disconnect reason, or None if the port
+        wasn't there."""
+        ctx = self.ctx
+        port = ctx.port
+        if not self.probe(port):
+            return None
+        log.info('Connecting to AquaLogic on %s...', port)
+        p = serial_port = None
+        connected_at = time.monotonic()
+        self._stalled = False
         try:
-            log.info('Connecting to AquaLogic on %s...', SERIAL_PORT)
-            panel = AquaLogic(web_port=0)  # disable built-in web server
-            panel.connect_serial(SERIAL_PORT)
+            p = new_panel()
+            p.connect_serial(port)
+            serial_port = p._serial
+            self._tap(serial_port)
+            self.last_frame = connected_at
+            ctx.panel = p
+            self.connected.set()
+            threading.Thread(target=self._watchdog, args=(p, serial_port),
+                             daemon=True, name='serial-watchdog').start()
             log.info('Connected. Processing RS-485 data...')
-            panel.process(on_data_changed)
-            log.warning('AquaLogic process() returned (serial timeout or EOF)')
+            p.process(ctx.on_data_changed)
+            reason = 'stall' if self._stalled else 'eof'
+            if reason == 'eof':
+                log.warning('AquaLogic process() returned (serial timeout or EOF)')
         except Exception as e:
             log.error('AquaLogic error: %s', e)
-        panel = None
-        log.info('Reconnecting in 5 seconds...')
-        time.sleep(5)
+            reason = 'error'
+        finally:
+            if ctx.panel is p and p is not None:
+                self.disconnected_at = time.monotonic()
+            ctx.panel = None
+            self.connected.clear()
+            if serial_port is not None:
+                try:
+                    serial_port.close()
+                except Exception:
+                    pass
+        if self.last_frame > connected_at:
+            self._failures = 0   # it worked for a while; retry fast
+        panel_disconnects.labels(reason).inc()
+        return reason
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if self.connect() is None:
+                delay = PROBE_INTERVAL
+            else:
+                delay = self.backoff()
+                log.info('Reconnecting in %.2f seconds...', delay)
+            stop.wait(delay)
+
+supervisor = PanelSupervisor()
+
+def run_aqualogic():
+    """Read every panel: one thread per extra panel, the default in this one.
+    A replica follows its primary instead."""
+    if replica is not None:
+        replica.run()
+        return
+    for ctx in list(panels.values()):
+        if ctx is not default_panel:
+            threading.Thread(target=ctx.supervisor.run, name=f'panel-{ctx.id}',
+                             daemon=True).start()
+    supervisor.run()
 
 # ─── Main ──────────────────────────────────────────────────────────
 def main():
+    global history, snapshots, capture, replica, HTTP_PORT, SERIAL_PORT
+    parser = argparse.ArgumentParser(description='AquaLogic RS-485 → REST API + SSE')
+    parser.add_argument('--port', type=int, default=HTTP_PORT, help='HTTP port')
+    parser.add_argument('--serial', default=SERIAL_PORT, help='RS-485 serial device')
+    parser.add_argument('--panel', action='append', default=[], metavar='ID=DEVICE',
+                        help='serve a panel as /panels/ID/...; repeat for several '
+                             '(the first also answers the unprefixed routes)')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve HTTP/SSE from one asyncio event loop')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='record raw RS-485 bytes with timestamps to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='read a --capture recording (looped) instead of the serial port')
+    parser.add_argument('--replay-speed', type=float, default=1.0, metavar='X',
+                        help='replay speed multiplier; 0 = as fast as possible')
+    parser.add_argument('--replicate', metavar='URL',
+                        help='mirror another bridge (e.g. http://pool-pi:4200) instead '
+                             'of reading a panel; writes are forwarded to it')
+    args = parser.parse_args()
+    HTTP_PORT, SERIAL_PORT = args.port, args.serial
+    if args.replicate:
+        if args.panel or args.capture or args.replay:
+            parser.error('--replicate reads no panel: drop --panel, --capture and --replay')
+        try:
+            replica = Replica(args.replicate)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.panel:
+        specs = [spec.partition('=')[::2] for spec in args.panel]
+        try:
+            configure_panels(specs)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.replay:
+        replay = SerialReplay(args.replay, speed=args.replay_speed, loop=True).start()
+        SERIAL_PORT = replay.port
+        log.info('Replaying %s (%d bytes) at %gx', args.replay, replay.size,
+                 args.replay_speed)
+    if args.capture:
+        capture = SerialRecorder(args.capture)
+        log.info('Capturing serial data to %s', args.capture)
+
     log.info('=== Pool Bridge starting ===')
-    log.info('Serial: %s  |  HTTP: %d', SERIAL_PORT, HTTP_PORT)
+    if replica is not None:
+        log.info('Replica of %s  |  HTTP: %d', replica.url, HTTP_PORT)
+    else:
+        log.info('Serial: %s  |  HTTP: %d', SERIAL_PORT, HTTP_PORT)
+    for ctx in panels.values():
+        if ctx is not default_panel:
+            log.info('Panel %s: %s', ctx.id, ctx.port)
+
+    # Serve the last known state while aqualogic loads and the panel connects
+    if SNAPSHOT_PATH:
+        if load_snapshot():
+            log.info('Serving last known state from %s until the panel is read',
+                     SNAPSHOT_PATH)
+        snapshots = SnapshotWriter().start()
+
+    # A replica's rules and history live on the primary
+    if replica is None:
+        if RULES_PATH:
+            loaded = load_rules()
+            if loaded:
+                log.info('Loaded %d automation rules from %s', loaded, RULES_PATH)
+        threading.Thread(target=run_rule_clock, name='rule-clock', daemon=True).start()
 
-    # Start HTTP server in background thread
-    http_thread = threading.Thread(target=run_http_server, daemon=True)
-    http_thread.start()
+    if HISTORY_DIR and replica is None:
+        history = HistoryStore(HISTORY_DIR)
+        for ctx in panels.values():
+            if ctx is not default_panel:
+                ctx.history = HistoryStore(os.path.join(HISTORY_DIR, 'panels', ctx.id))
+        log.info('Recording history to %s', HISTORY_DIR)
+
+    # systemd stops us with SIGTERM; exit cleanly so buffers get flushed
+    # (the asyncio runtime replaces this with a loop signal handler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if args.asyncio:
+            run_asyncio()
+        else:
+            # Start HTTP server in background thread
+            http_thread = threading.Thread(target=run_http_server, daemon=True)
+            http_thread.start()
 
-    # Run AquaLogic in main thread (blocking)
-    run_aqualogic()
+            # Run AquaLogic in main thread (blocking)
+            run_aqualogic()
+    finally:
+        for ctx in panels.values():
+            if ctx.history is not None:
+                ctx.history.flush()
+        if snapshots is not None:
+            snapshots.close()
+        if capture is not None:
+            capture.close()
 
 if __name__ == '__main__':
     main()
@@ -8,9 +8,19 @@ Covers the 4 disaster-prevention scenarios:
 4. SSE connection cleanup — OSError variants must be caught
 """
 
+import asyncio
 import json
+import gzip
+import http.client
 import io
+import os
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
 import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock, PropertyMock
 
@@ -81,6 +91,89 @@ def make_handler(method, path, body=None, headers=None):
     return handler
 
 
+def make_panel(**attrs):
+    """Create a fake AquaLogic panel with JSON-serializable readings."""
+    p = MagicMock()
+    p.air_temp, p.pool_temp, p.spa_temp = 85, 78, 92
+    p.salt_level, p.pool_chlorinator, p.spa_chlorinator = 3200, 50, 20
+    p.pump_speed, p.pump_power = 60, 1100
+    p.is_metric, p.is_heater_enabled, p.check_system_msg = False, False, None
+    p.get_state.return_value = False
+    for name, value in attrs.items():
+        setattr(p, name, value)
+    return p
+
+
+def start_server(test, workers=4):
+    """Run a real PoolHTTPServer on an ephemeral port for the test's duration."""
+    server = pool_bridge.PoolHTTPServer(('127.0.0.1', 0), PoolHandler,
+                                        workers=workers)
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05},
+                     daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server.server_address[1]
+
+
+def start_async_server(test):
+    """Run an AsyncBridgeServer on its own event loop thread for the test."""
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    box = {}
+
+    async def serve():
+        box['server'] = await pool_bridge.AsyncBridgeServer().start('127.0.0.1', 0)
+        ready.set()
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(serve(), loop)
+    ready.wait(2)
+
+    async def shutdown():
+        box['server'].close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result(2)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(2)
+        loop.close()
+    test.addCleanup(stop)
+    return box['server'].sockets[0].getsockname()[1]
+
+
+def http_request(port, method, path, body=None, headers=None):
+    """Make one request; returns (status, headers, body bytes)."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.headers, resp.read()
+    finally:
+        conn.close()
+
+
+def isolate_state(test):
+    """Give a test its own empty bridge state, restored afterwards."""
+    for name, value in [('current_state', {}), ('state_version', 0),
+                        ('latest_change', None), ('last_reading', None),
+                        ('panel_callbacks', pool_bridge.Counter()),
+                        ('state_changes', pool_bridge.Counter()),
+                        ('recent_changes', pool_bridge.deque(maxlen=pool_bridge.EVENT_HISTORY)),
+                        ('broadcaster', pool_bridge.Broadcaster())]:
+        p = patch.object(pool_bridge, name, value)
+        p.start()
+        test.addCleanup(p.stop)
+    for name in ('callbacks', 'changes'):
+        p = patch.object(pool_bridge.default_panel, name, pool_bridge.Counter())
+        p.start()
+        test.addCleanup(p.stop)
+
+
 class TestBooleanCoercion(unittest.TestCase):
     """CRITICAL GAP 1: String "false" must not be treated as True."""
 
@@ -257,6 +350,7 @@ class TestSSEErrorHandling(unittest.TestCase):
         handler.path = '/events'
         handler.command = 'GET'
         handler.request_version = 'HTTP/1.1'
+        handler.headers = {}
         handler._headers_buffer = []
 
         # Mock wfile that raises OSError on write
@@ -366,5 +460,1928 @@ class TestHealthEndpoint(unittest.TestCase):
         self.assertTrue(handler._response_body['connected'])
 
 
+class TestConcurrentServing(unittest.TestCase):
+    """An open /events stream must not block other requests."""
+
+    def setUp(self):
+        self.port = start_server(self)
+
+    def test_health_served_while_sse_open(self):
+        """GET /health must answer while another client holds /events."""
+        stream = socket.create_connection(('127.0.0.1', self.port))
+        stream.sendall(b'GET /events HTTP/1.1\r\nHost: test\r\n\r\n')
+        self.assertIn(b'200', stream.recv(1024))
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+            with patch.object(pool_bridge, 'panel', None):
+                conn.request('GET', '/health')
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, 200)
+                self.assertFalse(json.loads(resp.read())['connected'])
+            conn.close()
+        finally:
+            stream.close()
+
+    def test_sse_cap_returns_503(self):
+        """Streams beyond MAX_SSE_CLIENTS must be refused, not queued."""
+        handler = make_handler('GET', '/events')
+        with patch.object(pool_bridge, 'sse_slots', threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()
+            handler.do_GET()
+
+        self.assertEqual(handler._response_code, 503)
+
+
+class TestBroadcaster(unittest.TestCase):
+    """State changes must be pushed to subscribers, serialized once."""
+
+    def setUp(self):
+        isolate_state(self)
+
+    def test_change_reaches_subscriber(self):
+        """on_data_changed must push one frame to every subscriber."""
+        subs = [pool_bridge.broadcaster.subscribe() for _ in range(3)]
+        pool_bridge.on_data_changed(make_panel(pool_temp=81))
+
+        changes = [sub.pop_all(timeout=0) for sub in subs]
+        self.assertEqual(len(changes[0]), 1)
+        self.assertIn(b'"poolTemp":81', changes[0][0].full_frame)
+        # Every client gets the very same bytes object, not a re-encode
+        self.assertIs(changes[0][0].full_frame, changes[1][0].full_frame)
+        self.assertIs(changes[0][0].full_frame, changes[2][0].full_frame)
+
+    def test_queue_drops_oldest(self):
+        """A client that falls behind keeps only the newest frames."""
+        sub = pool_bridge.broadcaster.subscribe(maxlen=2)
+        for frame in (b'1', b'2', b'3'):
+            pool_bridge.broadcaster.publish(frame)
+
+        self.assertEqual(sub.pop_all(timeout=0), [b'2', b'3'])
+        self.assertEqual(sub.dropped, 1)
+        self.assertTrue(sub.gap)
+
+    def test_idle_subscriber_times_out_empty(self):
+        """With no changes, pop_all returns nothing after the timeout."""
+        sub = pool_bridge.broadcaster.subscribe()
+        self.assertEqual(sub.pop_all(timeout=0.01), [])
+
+    def test_unsubscribe_stops_delivery(self):
+        """Closed streams must not keep receiving frames."""
+        sub = pool_bridge.broadcaster.subscribe()
+        pool_bridge.broadcaster.unsubscribe(sub)
+        pool_bridge.broadcaster.publish(b'x')
+
+        self.assertEqual(len(pool_bridge.broadcaster), 0)
+        self.assertEqual(sub.pop_all(timeout=0), [])
+
+
+class RecordingWFile:
+    """wfile stand-in that records writes and disconnects on the `limit`-th."""
+
+    def __init__(self, limit):
+        self.writes = []
+        self.limit = limit
+
+    def write(self, data):
+        self.writes.append(data)
+        if len(self.writes) >= self.limit:
+            raise BrokenPipeError('client went away')
+
+    def flush(self):
+        pass
+
+
+def run_stream(path, publish, writes, headers=None):
+    """Run an SSE handler in a thread, call publish() once it subscribes,
+    and return the event frames written before the client 'disconnects'."""
+    handler = make_handler('GET', path, headers=headers)
+    handler.send_response = MagicMock()
+    handler.send_header = MagicMock()
+    handler.end_headers = MagicMock()
+    handler.wfile = RecordingWFile(writes)
+    thread = threading.Thread(target=handler.do_GET)
+    thread.start()
+    for _ in range(200):
+        if len(pool_bridge.broadcaster) or not thread.is_alive():
+            break
+        threading.Event().wait(0.005)
+    publish()
+    thread.join(timeout=2)
+    return handler.wfile.writes
+
+
+class TestDeltaEvents(unittest.TestCase):
+    """?mode=delta must send one snapshot, then only changed keys."""
+
+    def setUp(self):
+        isolate_state(self)
+        pool_bridge.on_data_changed(make_panel())
+
+    def test_diff_state_only_changed_keys(self):
+        """diff_state must report changed fields and individual circuits."""
+        old = {'poolTemp': 78, 'pumpPower': 1100,
+               'circuits': {'FILTER': True, 'SPA': False}}
+        new = {'poolTemp': 78, 'pumpPower': 1150,
+               'circuits': {'FILTER': True, 'SPA': True}}
+
+        self.assertEqual(pool_bridge.diff_state(old, new),
+                         {'pumpPower': 1150, 'circuits': {'SPA': True}})
+        self.assertEqual(pool_bridge.diff_state(new, new), {})
+
+    def test_delta_stream_sends_snapshot_then_patch(self):
+        """First event is the full state, the next only carries pumpPower."""
+        writes = run_stream('/events?mode=delta',
+                            lambda: pool_bridge.on_data_changed(make_panel(pump_power=1200)),
+                            writes=2)
+
+        boot = pool_bridge.BOOT_ID
+        self.assertIn(f'id: {boot}-1\ndata: {{'.encode(), writes[0])
+        self.assertIn(b'"circuits"', writes[0])
+        self.assertEqual(writes[1],
+                         f'id: {boot}-2\nevent: patch\ndata: {{"pumpPower":1200}}\n\n'.encode())
+
+    def test_full_stream_sends_full_state(self):
+        """Without mode=delta every event is the full state."""
+        writes = run_stream('/events',
+                            lambda: pool_bridge.on_data_changed(make_panel(pump_power=1200)),
+                            writes=2)
+
+        self.assertIn(f'id: {pool_bridge.BOOT_ID}-2\ndata: {{'.encode(), writes[1])
+        self.assertIn(b'"circuits"', writes[1])
+
+    def test_overflow_resyncs_with_snapshot(self):
+        """A delta client that lost patches must get a full snapshot."""
+        sub = pool_bridge.broadcaster.subscribe(maxlen=1)
+        pool_bridge.on_data_changed(make_panel(pump_power=1200))
+        pool_bridge.on_data_changed(make_panel(pump_power=1300))
+        sub.pop_all(timeout=0)
+
+        self.assertTrue(sub.gap)
+
+
+
+class TestFieldSubscriptions(unittest.TestCase):
+    """?fields= streams carry only the named fields, and only when they change."""
+
+    def setUp(self):
+        isolate_state(self)
+        pool_bridge.on_data_changed(make_panel())
+
+    def test_parse_fields(self):
+        """Circuit names are normalised, 'circuits' covers each circuit, typos are refused."""
+        self.assertEqual(pool_bridge.parse_fields('poolTemp, circuits.spa'),
+                         frozenset({'poolTemp', 'circuits.SPA'}))
+        self.assertEqual(pool_bridge.parse_fields('circuits.SPA,circuits'),
+                         frozenset({'circuits'}))
+        self.assertIsNone(pool_bridge.parse_fields(None))
+        for bad in ('pooltemp', 'circuits.JACUZZI', ','):
+            with self.assertRaises(ValueError):
+                pool_bridge.parse_fields(bad)
+
+    def test_only_matching_subscribers_woken(self):
+        """A change reaches only selections it touches; equal selections share a frame."""
+        spa_a = pool_bridge.broadcaster.subscribe(fields=pool_bridge.parse_fields('circuits.SPA'))
+        spa_b = pool_bridge.broadcaster.subscribe(fields=pool_bridge.parse_fields('circuits.spa'))
+        temp = pool_bridge.broadcaster.subscribe(fields=pool_bridge.parse_fields('poolTemp'))
+        pool_bridge.on_data_changed(make_panel(pump_power=1200))
+        self.assertEqual([s.pop_all(timeout=0) for s in (spa_a, spa_b, temp)], [[], [], []])
+
+        spa_on = make_panel(pump_power=1200)
+        spa_on.get_state.side_effect = lambda state: state == 'SPA'
+        pool_bridge.on_data_changed(spa_on)
+        self.assertEqual(temp.pop_all(timeout=0), [])
+        frames = [pool_bridge._frames_for(s.pop_all(timeout=0), s, True, False)
+                  for s in (spa_a, spa_b)]
+        self.assertIs(frames[0], frames[1])
+        self.assertEqual(frames[0], f'id: {pool_bridge.BOOT_ID}-3\nevent: patch\n'
+                                    f'data: {{"circuits":{{"SPA":true}}}}\n\n'.encode())
+
+    def test_stream_skips_untouched_changes(self):
+        """The snapshot holds only the fields; a pumpPower change sends nothing."""
+        def publish():
+            pool_bridge.on_data_changed(make_panel(pump_power=1200))
+            pool_bridge.on_data_changed(make_panel(pump_power=1200, pool_temp=80))
+
+        writes = run_stream('/events?mode=delta&fields=poolTemp,circuits.SPA', publish, writes=2)
+        boot = pool_bridge.BOOT_ID
+        self.assertEqual(writes, [
+            f'id: {boot}-1\ndata: {{"poolTemp":78,"circuits":{{"SPA":false}}}}\n\n'.encode(),
+            f'id: {boot}-3\nevent: patch\ndata: {{"poolTemp":80}}\n\n'.encode(),
+        ])
+
+    def test_unknown_field_rejected(self):
+        """A misspelt field is a 400 listing what can be subscribed to."""
+        handler = make_handler('GET', '/events?fields=pool_temp')
+        handler.do_GET()
+        self.assertEqual(handler._response_code, 400)
+        self.assertIn('circuits.SPA', handler._response_body['validFields'])
+
+class TestLastEventIdResume(unittest.TestCase):
+    """Reconnecting clients must only get what they missed."""
+
+    def setUp(self):
+        isolate_state(self)
+        for power in (1100, 1150, 1200):
+            pool_bridge.on_data_changed(make_panel(pump_power=power))
+        self.boot = pool_bridge.BOOT_ID
+
+    def test_missed_patches_replayed(self):
+        """Resuming from version 1 in delta mode sends patches 2 and 3 only."""
+        initial = pool_bridge._catch_up(1, delta=True)
+
+        self.assertEqual(initial,
+                         f'id: {self.boot}-2\nevent: patch\ndata: {{"pumpPower":1150}}\n\n'
+                         f'id: {self.boot}-3\nevent: patch\ndata: {{"pumpPower":1200}}\n\n'.encode())
+
+    def test_up_to_date_client_gets_nothing(self):
+        """A client that already saw the latest version gets no replay."""
+        self.assertEqual(pool_bridge._catch_up(3, delta=True), b'')
+        self.assertEqual(pool_bridge._catch_up(3, delta=False), b'')
+
+    def test_evicted_id_gets_snapshot(self):
+        """If the ring no longer reaches back far enough, send the full state."""
+        pool_bridge.recent_changes.popleft()
+        pool_bridge.recent_changes.popleft()
+
+        initial = pool_bridge._catch_up(1, delta=True)
+        self.assertTrue(initial.startswith(f'id: {self.boot}-3\ndata: {{'.encode()))
+
+    def test_full_mode_gets_latest_snapshot_only(self):
+        """Full-state clients only need the newest state, not each version."""
+        initial = pool_bridge._catch_up(1, delta=False)
+        self.assertEqual(initial.count(b'id: '), 1)
+        self.assertIn(b'"pumpPower":1200', initial)
+
+    def test_id_from_previous_boot_ignored(self):
+        """Versions restart with the bridge, so old-boot ids mean 'unknown'."""
+        self.assertIsNone(pool_bridge.parse_event_id('deadbeef-2'))
+        self.assertIsNone(pool_bridge.parse_event_id('garbage'))
+        self.assertIsNone(pool_bridge.parse_event_id(None))
+        self.assertEqual(pool_bridge.parse_event_id(f'{self.boot}-2'), 2)
+
+    def test_header_resume_over_stream(self):
+        """Last-Event-ID header on /events?mode=delta resumes the stream."""
+        writes = run_stream('/events?mode=delta', lambda: None, writes=1,
+                            headers={'Last-Event-ID': f'{self.boot}-2'})
+
+        self.assertEqual(writes[0],
+                         f'id: {self.boot}-3\nevent: patch\ndata: {{"pumpPower":1200}}\n\n'.encode())
+
+
+class TestChangeDetection(unittest.TestCase):
+    """Callbacks that change nothing must not bump the version or notify."""
+
+    def setUp(self):
+        isolate_state(self)
+
+    def test_identical_callback_is_ignored(self):
+        """A repeat callback with the same readings publishes nothing."""
+        pool_bridge.on_data_changed(make_panel())
+        sub = pool_bridge.broadcaster.subscribe()
+        pool_bridge.on_data_changed(make_panel())
+
+        self.assertEqual(pool_bridge.state_version, 1)
+        self.assertEqual(sub.pop_all(timeout=0), [])
+
+    def test_real_change_bumps_version(self):
+        """A changed reading or circuit is published as a new version."""
+        pool_bridge.on_data_changed(make_panel())
+        pool_bridge.on_data_changed(make_panel(pool_temp=79))
+        toggled = make_panel(pool_temp=79)
+        toggled.get_state.side_effect = lambda s: s == 'SPA'
+        pool_bridge.on_data_changed(toggled)
+
+        self.assertEqual(pool_bridge.state_version, 3)
+        self.assertTrue(pool_bridge.current_state['circuits']['SPA'])
+
+    def test_health_reports_counters(self):
+        """/health must expose callbacks received vs. real changes."""
+        for temp in (78, 78, 78, 79):
+            pool_bridge.on_data_changed(make_panel(pool_temp=temp))
+        handler = make_handler('GET', '/health')
+        handler.do_GET()
+
+        self.assertEqual(handler._response_body['callbacks'], 4)
+        self.assertEqual(handler._response_body['changes'], 2)
+
+    def test_build_state_shape_unchanged(self):
+        """build_state still returns every field plus all circuits."""
+        state = pool_bridge.build_state(make_panel())
+
+        self.assertEqual(state['poolTemp'], 78)
+        self.assertIsNone(state['checkSystemMsg'])
+        self.assertEqual(list(state['circuits']), list(pool_bridge.CIRCUIT_MAP))
+
+
+class TestStateCaching(unittest.TestCase):
+    """/state/all and /state/circuits are served pre-encoded with ETags."""
+
+    def setUp(self):
+        isolate_state(self)
+        pool_bridge.on_data_changed(make_panel())
+        self.port = start_server(self)
+
+    def test_state_all_has_etag(self):
+        """GET /state/all returns the full state and a strong ETag."""
+        status, headers, body = http_request(self.port, 'GET', '/state/all')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['ETag'], f'"{pool_bridge.BOOT_ID}-1"')
+        self.assertEqual(json.loads(body)['poolTemp'], 78)
+        self.assertEqual(int(headers['Content-Length']), len(body))
+
+    def test_if_none_match_returns_304(self):
+        """A client holding the current ETag gets 304 with no body."""
+        _, headers, _ = http_request(self.port, 'GET', '/state/circuits')
+        status, _, body = http_request(self.port, 'GET', '/state/circuits',
+                                       headers={'If-None-Match': headers['ETag']})
+
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_etag_changes_with_state(self):
+        """After a real change the old ETag no longer matches."""
+        _, headers, _ = http_request(self.port, 'GET', '/state/all')
+        pool_bridge.on_data_changed(make_panel(pool_temp=80))
+        status, _, body = http_request(self.port, 'GET', '/state/all',
+                                       headers={'If-None-Match': headers['ETag']})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['poolTemp'], 80)
+
+    def test_body_encoded_once_per_version(self):
+        """Repeated GETs reuse the same encoded bytes."""
+        with pool_bridge.state_lock:
+            change = pool_bridge._latest_change()
+        self.assertIs(change.body('all'), change.body('all'))
+
+    def test_gzip_when_accepted(self):
+        """Clients sending Accept-Encoding: gzip get a compressed body."""
+        status, headers, body = http_request(self.port, 'GET', '/state/all',
+                                             headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body))['spaTemp'], 92)
+
+
+class TestCommandQueue(unittest.TestCase):
+    """Panel writes are serialized, collapsed and skipped when redundant."""
+
+    def setUp(self):
+        isolate_state(self)
+        p = patch.object(pool_bridge, 'commands', pool_bridge.CommandQueue())
+        p.start()
+        self.addCleanup(p.stop)
+        self.panel = MagicMock()
+        self.panel.set_state.return_value = True
+        p = patch.object(pool_bridge, 'panel', self.panel)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_repeated_toggles_collapse(self):
+        """Queued toggles of one circuit collapse into the last one."""
+        release = threading.Event()
+        self.panel.set_state.side_effect = lambda s, v: release.wait(2) or True
+        busy = pool_bridge.commands.submit('LIGHTS', True)   # occupies the writer
+        first = pool_bridge.commands.submit('SPA', True)
+        second = pool_bridge.commands.submit('SPA', False)
+        third = pool_bridge.commands.submit('SPA', True)
+        release.set()
+        for cmd in (busy, first, second, third):
+            self.assertTrue(cmd.done.wait(2))
+
+        self.assertEqual(first.status, 'superseded')
+        self.assertEqual(second.status, 'superseded')
+        self.assertEqual(third.status, 'done')
+        self.assertEqual(self.panel.set_state.call_count, 2)   # LIGHTS + final SPA
+        self.assertEqual(pool_bridge.commands.metrics()['superseded'], 2)
+
+    def test_matching_state_skipped(self):
+        """A command that already matches current_state never hits the panel."""
+        pool_bridge.on_data_changed(make_panel())   # every circuit off
+        handler = make_handler('PUT', '/state/circuit/setState',
+                               body={'circuit': 'SPA', 'state': False})
+        handler.do_PUT()
+
+        self.assertEqual(handler._response_code, 200)
+        self.assertEqual(handler._response_body['status'], 'skipped')
+        self.panel.set_state.assert_not_called()
+
+    def test_wait_zero_returns_202_then_pollable(self):
+        """?wait=0 answers 202 with an id that GET /commands/<id> resolves."""
+        release = threading.Event()
+        self.panel.set_state.side_effect = lambda s, v: release.wait(2) or True
+        handler = make_handler('PUT', '/state/circuit/setState?wait=0',
+                               body={'circuit': 'FILTER', 'state': True})
+        handler.do_PUT()
+
+        self.assertEqual(handler._response_code, 202)
+        cmd_id = handler._response_body['id']
+        self.assertEqual(handler._response_body['location'], f'/commands/{cmd_id}')
+
+        release.set()
+        poll = make_handler('GET', f'/commands/{cmd_id}?wait=2')
+        poll.do_GET()
+        self.assertEqual(poll._response_code, 200)
+        self.assertEqual(poll._response_body['status'], 'done')
+        self.assertTrue(poll._response_body['ok'])
+
+    def test_unknown_command_404(self):
+        """Polling an id that was never issued returns 404."""
+        handler = make_handler('GET', '/commands/999')
+        handler.do_GET()
+
+        self.assertEqual(handler._response_code, 404)
+
+    def test_waits_for_panel_to_settle(self):
+        """A second write to a circuit waits until the panel shows the first."""
+        pool_bridge.on_data_changed(make_panel())   # SPA off
+        first = pool_bridge.commands.submit('SPA', True)
+        self.assertTrue(first.done.wait(2))
+        second = pool_bridge.commands.submit('SPA', False)
+        self.assertFalse(second.done.wait(0.2))
+
+        on = make_panel()
+        on.get_state.side_effect = lambda s: s == 'SPA'
+        pool_bridge.on_data_changed(on)             # panel now shows SPA on
+        self.assertTrue(second.done.wait(2))
+        self.assertEqual(second.status, 'done')
+
+    def test_health_reports_queue_metrics(self):
+        """/health exposes queue depth and command latency."""
+        self.assertTrue(pool_bridge.commands.submit('AUX_1', True).done.wait(2))
+        handler = make_handler('GET', '/health')
+        handler.do_GET()
+
+        metrics = handler._response_body['commands']
+        self.assertEqual(metrics['depth'], 0)
+        self.assertEqual(metrics['executed'], 1)
+        self.assertIsNotNone(metrics['latencyMs']['p50'])
+
+
+class TestBatchCircuits(unittest.TestCase):
+    """PUT /state/circuits applies a whole scene in one request."""
+
+    def setUp(self):
+        isolate_state(self)
+        p = patch.object(pool_bridge, 'commands', pool_bridge.CommandQueue())
+        p.start()
+        self.addCleanup(p.stop)
+        self.panel = MagicMock()
+        self.panel.set_state.return_value = True
+        p = patch.object(pool_bridge, 'panel', self.panel)
+        p.start()
+        self.addCleanup(p.stop)
+        # Start from: FILTER on, everything else off
+        start = make_panel()
+        start.get_state.side_effect = lambda s: s == 'FILTER'
+        pool_bridge.on_data_changed(start)
+
+    def test_spa_scene_only_sends_changes(self):
+        """Circuits already in the wanted state are reported, not pressed."""
+        handler = make_handler('PUT', '/state/circuits', body={
+            'FILTER': True, 'SPA': True, 'HEATER_1': True, 'LIGHTS': True})
+        handler.do_PUT()
+
+        self.assertEqual(handler._response_code, 200)
+        results = handler._response_body['circuits']
+        self.assertEqual(results['FILTER']['status'], 'unchanged')
+        for name in ('SPA', 'HEATER_1', 'LIGHTS'):
+            self.assertEqual(results[name]['status'], 'done')
+        self.assertTrue(handler._response_body['ok'])
+        self.assertEqual(self.panel.set_state.call_count, 3)
+
+    def test_panel_friendly_order(self):
+        """Valves before the heater on the way up; heater first on the way down."""
+        order = pool_bridge.batch_order({'LIGHTS': True, 'HEATER_1': True,
+                                         'SPA': True, 'FILTER': False,
+                                         'HEATER_AUTO_MODE': False})
+
+        self.assertEqual(order, [('HEATER_AUTO_MODE', False), ('FILTER', False),
+                                 ('SPA', True), ('HEATER_1', True), ('LIGHTS', True)])
+
+    def test_invalid_entry_rejects_whole_batch(self):
+        """One bad circuit or value means nothing is sent."""
+        handler = make_handler('PUT', '/state/circuits', body={
+            'SPA': True, 'JACUZZI': True, 'LIGHTS': 'true'})
+        handler.do_PUT()
+
+        self.assertEqual(handler._response_code, 400)
+        self.assertEqual(set(handler._response_body['circuits']), {'JACUZZI', 'LIGHTS'})
+        self.panel.set_state.assert_not_called()
+
+    def test_batch_when_disconnected(self):
+        """With no panel the batch is refused with 503."""
+        with patch.object(pool_bridge, 'panel', None):
+            handler = make_handler('PUT', '/state/circuits', body={'SPA': True})
+            handler.do_PUT()
+
+        self.assertEqual(handler._response_code, 503)
+
+
+class TestHistoryStore(unittest.TestCase):
+    """Readings are buffered to compact day files and downsampled on query."""
+
+    DAY = 1_700_006_400   # a UTC midnight
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.store = pool_bridge.HistoryStore(self.dir, flush_every=3600)
+        self.store._start_maintenance = lambda now: None
+
+    def record(self, ts, **patch):
+        self.store.record(pool_bridge.StateChange(0, {}, patch), now=ts)
+
+    def test_flush_writes_fixed_width_records(self):
+        """Samples stay in memory until flush, then 8 bytes each per field."""
+        self.record(self.DAY + 10, poolTemp=78, pumpPower=1100)
+        self.record(self.DAY + 20, poolTemp=79)
+        path = os.path.join(self.dir, 'poolTemp', '20231115.raw')
+        self.assertFalse(os.path.exists(path))
+
+        self.store.flush()
+        self.assertEqual(os.path.getsize(path), 2 * pool_bridge.HISTORY_RECORD.size)
+
+    def test_query_averages_and_carries_forward(self):
+        """Buckets average their samples; empty buckets repeat the last value."""
+        self.record(self.DAY + 0, poolTemp=78)
+        self.record(self.DAY + 30, poolTemp=80)
+        self.store.flush()
+        self.record(self.DAY + 70, poolTemp=82)   # still buffered
+
+        points = self.store.query('poolTemp', self.DAY, self.DAY + 180, 60)
+        self.assertEqual(points, [[self.DAY, 79.0], [self.DAY + 60, 82.0],
+                                  [self.DAY + 120, 82.0]])
+
+    def test_circuit_transitions(self):
+        """Circuit history reports the state at the end of each bucket."""
+        self.record(self.DAY + 5, circuits={'SPA': True})
+        self.record(self.DAY + 50, circuits={'SPA': False})
+
+        points = self.store.query('circuits.SPA', self.DAY, self.DAY + 120, 60)
+        self.assertEqual(points, [[self.DAY, False], [self.DAY + 60, False]])
+
+    def test_new_day_starts_with_checkpoint(self):
+        """The first write of a day repeats every last-known value."""
+        self.record(self.DAY + 10, poolTemp=78, airTemp=70)
+        self.record(self.DAY + 86400 + 10, pumpPower=900)
+        self.store.flush()
+
+        points = self.store.query('airTemp', self.DAY + 86400, self.DAY + 86460, 60)
+        self.assertEqual(points, [[self.DAY + 86400, 70.0]])
+
+    def test_checkpoint_includes_unrecorded_fields(self):
+        """A day's checkpoint has every reading in the state, including
+        ones that haven't changed since the bridge started."""
+        self.record(self.DAY + 10, pumpPower=1100)
+        self.store.record(pool_bridge.StateChange(0, {'poolTemp': 78, 'pumpPower': 900},
+                                                  {'pumpPower': 900}),
+                          now=self.DAY + 86400 + 10)
+        self.store.flush()
+
+        points = self.store.query('poolTemp', self.DAY + 86400, self.DAY + 86460, 60)
+        self.assertEqual(points, [[self.DAY + 86400, 78.0]])
+
+    def test_rollup_old_days_to_hourly(self):
+        """Raw days past HISTORY_RAW_DAYS become hourly means."""
+        self.record(self.DAY + 60, poolTemp=70)
+        self.record(self.DAY + 120, poolTemp=80)
+        self.store.flush()
+        self.store._maintain(self.DAY + (pool_bridge.HISTORY_RAW_DAYS + 2) * 86400)
+
+        folder = os.path.join(self.dir, 'poolTemp')
+        self.assertEqual(os.listdir(folder), ['20231115.hourly'])
+        points = self.store.query('poolTemp', self.DAY, self.DAY + 3600, 3600)
+        self.assertEqual(points, [[self.DAY, 75.0]])
+
+    def test_endpoint_validates_and_caps_points(self):
+        """/history rejects unknown fields and never returns raw rows."""
+        with patch.object(pool_bridge, 'history', self.store):
+            bad = make_handler('GET', '/history?field=bogus')
+            bad.do_GET()
+            self.assertEqual(bad._response_code, 400)
+
+            now = int(time.time())
+            handler = make_handler(
+                'GET', f'/history?field=poolTemp&from={now - 86400}&to={now}&step=1')
+            handler.do_GET()
+        self.assertEqual(handler._response_code, 200)
+        self.assertLessEqual(len(handler._response_body['points']),
+                             pool_bridge.HISTORY_MAX_POINTS)
+
+    def test_endpoint_bounds_range(self):
+        """from/to are trimmed to the kept history; a range outside it is a 400."""
+        now = int(time.time())
+        with patch.object(pool_bridge, 'history', self.store):
+            handler = make_handler('GET', '/history?field=poolTemp&from=-1000000000000000000'
+                                          '&to=20000000000')
+            handler.do_GET()
+            self.assertEqual(handler._response_code, 200)
+            body = handler._response_body
+            self.assertGreaterEqual(body['from'], now - pool_bridge.HISTORY_KEEP_DAYS * 86400)
+            self.assertLessEqual(body['to'], now + 1)
+            for query in ('from=-1000000000000000000&to=-999999999999999999',
+                          'from=20000000000&to=20000000001'):
+                handler = make_handler('GET', f'/history?field=poolTemp&{query}')
+                handler.do_GET()
+                self.assertEqual(handler._response_code, 400, query)
+
+    def test_endpoint_when_disabled(self):
+        """Without a history store /history answers 404."""
+        with patch.object(pool_bridge, 'history', None):
+            handler = make_handler('GET', '/history?field=poolTemp')
+            handler.do_GET()
+
+        self.assertEqual(handler._response_code, 404)
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    """The asyncio server exposes the same API as the threaded one."""
+
+    def setUp(self):
+        isolate_state(self)
+        pool_bridge.on_data_changed(make_panel())
+        p = patch.object(pool_bridge, 'commands', pool_bridge.CommandQueue())
+        p.start()
+        self.addCleanup(p.stop)
+        self.port = start_async_server(self)
+
+    def test_rest_routes(self):
+        """GET /state/all and /health answer exactly as in threaded mode."""
+        status, headers, body = http_request(self.port, 'GET', '/state/all')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['poolTemp'], 78)
+        self.assertEqual(headers['ETag'], f'"{pool_bridge.BOOT_ID}-1"')
+
+        status, _, body = http_request(self.port, 'GET', '/health')
+        self.assertEqual(status, 200)
+        self.assertIn('connected', json.loads(body))
+
+    def test_put_runs_off_the_loop(self):
+        """PUT goes through the command queue without blocking the loop."""
+        mock_panel = MagicMock()
+        mock_panel.set_state.return_value = True
+        with patch.object(pool_bridge, 'panel', mock_panel):
+            status, _, body = http_request(
+                self.port, 'PUT', '/state/circuit/setState',
+                body=json.dumps({'circuit': 'SPA', 'state': True}),
+                headers={'Content-Type': 'application/json'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['status'], 'done')
+        mock_panel.set_state.assert_called_once()
+
+    def test_put_validation_unchanged(self):
+        """String booleans are still rejected with 400."""
+        status, _, _ = http_request(
+            self.port, 'PUT', '/state/circuit/setState',
+            body=json.dumps({'circuit': 'SPA', 'state': 'true'}))
+        self.assertEqual(status, 400)
+
+    def test_sse_stream_pushes_changes(self):
+        """/events?mode=delta sends a snapshot, then patches from other threads."""
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=2)
+        self.addCleanup(sock.close)
+        sock.sendall(b'GET /events?mode=delta HTTP/1.1\r\nHost: t\r\n\r\n')
+        data = b''
+        while b'\n\n' not in data.partition(b'\r\n\r\n')[2]:
+            data += sock.recv(4096)
+        self.assertIn(b'200 OK', data)
+        self.assertIn(b'"circuits"', data)
+
+        pool_bridge.on_data_changed(make_panel(pool_temp=81))
+        data = b''
+        while b'event: patch' not in data:
+            data += sock.recv(4096)
+        self.assertIn(b'data: {"poolTemp":81}', data)
+
+    def test_sigterm_with_open_stream(self):
+        """SIGTERM stops the asyncio runtime quietly, even with a stream open."""
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        code = (
+            'import asyncio, sys, threading, types\n'
+            'states = types.ModuleType("aqualogic.states")\n'
+            'states.States = type("States", (), {"__getattr__": lambda self, n: n})()\n'
+            'sys.modules["aqualogic"] = types.ModuleType("aqualogic")\n'
+            'sys.modules["aqualogic.states"] = states\n'
+            'import pool_bridge\n'
+            f'pool_bridge.HTTP_PORT = {port}\n'
+            'pool_bridge.run_aqualogic = threading.Event().wait\n'
+            'asyncio.run(pool_bridge._run_asyncio())\n'
+            'print("stopped")\n')
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True,
+                                cwd=os.path.dirname(os.path.abspath(pool_bridge.__file__)))
+        self.addCleanup(proc.kill)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+                break
+            except ConnectionRefusedError:
+                self.assertLess(time.monotonic(), deadline, 'server never started')
+                time.sleep(0.05)
+        self.addCleanup(sock.close)
+        sock.sendall(b'GET /events HTTP/1.1\r\nHost: t\r\n\r\n')
+        self.assertIn(b'200 OK', sock.recv(4096))
+
+        proc.send_signal(signal.SIGTERM)
+        out, err = proc.communicate(timeout=5)
+        self.assertEqual((proc.returncode, out.strip()), (0, 'stopped'), err)
+        self.assertNotIn('Traceback', err)
+
+
+class TestSerialCapture(unittest.TestCase):
+    """--capture records the raw serial stream; SerialReplay plays it back."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'panel.cap')
+
+    def test_bursts_become_records(self):
+        """Bytes closer together than the gap share a record with its start time."""
+        rec = pool_bridge.SerialRecorder(self.path, gap=0.002)
+        start = rec._start
+        rec.feed(b'\x10', now=start + 1.0)
+        rec.feed(b'\x02', now=start + 1.001)
+        rec.feed(b'\x10', now=start + 2.0)
+        rec.close()
+        records = pool_bridge.read_capture(self.path)
+        self.assertEqual([data for _, data in records], [b'\x10\x02', b'\x10'])
+        self.assertAlmostEqual(records[0][0], 1.0)
+        self.assertAlmostEqual(records[1][0], 2.0)
+
+    def test_wrapped_read_passes_data_through(self):
+        """The tapped read returns what the port returned; timeouts record nothing."""
+        rec = pool_bridge.SerialRecorder(self.path)
+        reads = iter([b'a', b'', b'b'])
+        read = rec.wrap(lambda size=1: next(reads))
+        self.assertEqual([read(1), read(1), read(1)], [b'a', b'', b'b'])
+        rec.close()
+        rec.close()  # a second close is a no-op
+        self.assertEqual(b''.join(d for _, d in pool_bridge.read_capture(self.path)), b'ab')
+
+    def test_rejects_foreign_files(self):
+        """Replaying something that isn't a capture fails loudly."""
+        with open(self.path, 'wb') as f:
+            f.write(b'\x10\x02\x01\x01')
+        with self.assertRaises(ValueError):
+            pool_bridge.read_capture(self.path)
+
+    def _write_capture(self, records):
+        with open(self.path, 'wb') as f:
+            f.write(pool_bridge.CAPTURE_MAGIC)
+            for offset, data in records:
+                f.write(pool_bridge.CAPTURE_RECORD.pack(offset, len(data)) + data)
+
+    def _read_port(self, replay, size):
+        fd = os.open(replay.port, os.O_RDONLY | os.O_NOCTTY)
+        self.addCleanup(os.close, fd)
+        data = b''
+        while len(data) < size:
+            data += os.read(fd, size - len(data))
+        return data
+
+    def test_replay_through_pty(self):
+        """The reader sees the recorded bytes, in order, on the pty's device path."""
+        payload = [(0.0, bytes(range(256))), (0.5, b'\x10\x03' * 3000)]
+        self._write_capture(payload)
+        replay = pool_bridge.SerialReplay(self.path, speed=0).start()
+        self.addCleanup(replay.close)
+        self.assertEqual(self._read_port(replay, replay.size),
+                         b''.join(data for _, data in payload))
+        self.assertTrue(replay.done.wait(2))
+        self.assertEqual(replay.pending(), 0)
+
+    def test_replay_keeps_recorded_timing(self):
+        """At speed=1 records go out no sooner than their offsets."""
+        self._write_capture([(0.0, b'a'), (0.15, b'b')])
+        replay = pool_bridge.SerialReplay(self.path, speed=1)
+        self.addCleanup(replay.close)
+        start = time.monotonic()
+        replay.start()
+        self.assertEqual(self._read_port(replay, 2), b'ab')
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+class TestMetrics(unittest.TestCase):
+    """/metrics exposes lock-free counters and histograms in text format."""
+
+    def test_counter_exact_across_threads(self):
+        """Per-thread cells mean concurrent inc() never loses an update."""
+        counter = pool_bridge.Counter()
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(5000)])
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counter.value, 40000)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """A value equal to a bound lands in that bucket (Prometheus `le`)."""
+        hist = pool_bridge.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 7):
+            hist.observe(value)
+        counts, total = hist.snapshot()
+        self.assertEqual(counts, [2, 3, 4])
+        self.assertAlmostEqual(total, 7.65)
+
+    def test_render_format(self):
+        """Labels, histogram series and scrape-time gauges render as exposition text."""
+        reg = pool_bridge.MetricsRegistry()
+        reg.counter('x_total', 'Xs.', label='code').labels(200).inc(3)
+        reg.histogram('y_seconds', 'Ys.', buckets=(1.0,)).observe(0.5)
+        reg.gauge('z', 'Z.', lambda: True)
+        text = reg.render()
+        self.assertIn('# TYPE x_total counter\nx_total{code="200"} 3\n', text)
+        self.assertIn('y_seconds_bucket{le="1"} 1\ny_seconds_bucket{le="+Inf"} 1\n'
+                      'y_seconds_sum 0.5\ny_seconds_count 1\n', text)
+        self.assertIn('# TYPE z gauge\nz 1\n', text)
+
+    def test_route_labels_are_bounded(self):
+        """Command ids and unknown paths don't create new label values."""
+        self.assertEqual(pool_bridge.route_label('/commands/17?wait=1'), '/commands')
+        self.assertEqual(pool_bridge.route_label('/state/all'), '/state/all')
+        self.assertEqual(pool_bridge.route_label('/wp-login.php'), 'other')
+
+    def test_endpoint_reports_requests(self):
+        """A served request shows up in the latency histogram and status counts."""
+        isolate_state(self)
+        pool_bridge.on_data_changed(make_panel())
+        port = start_server(self)
+        before = pool_bridge.http_responses.labels(404).value
+        http_request(port, 'GET', '/state/all')
+        http_request(port, 'GET', '/nope')
+        status, headers, body = http_request(port, 'GET', '/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['Content-Type'].startswith('text/plain'))
+        text = body.decode()
+        self.assertIn('pool_bridge_http_request_seconds_count{route="/state/all"}', text)
+        self.assertIn('# TYPE pool_bridge_sse_clients gauge\npool_bridge_sse_clients 0\n', text)
+        self.assertEqual(pool_bridge.http_responses.labels(404).value, before + 1)
+
+    def test_set_state_errors_counted(self):
+        """A set_state() that raises is counted and timed."""
+        isolate_state(self)
+        panel = make_panel()
+        panel.set_state.side_effect = OSError('serial gone')
+        errors = pool_bridge.set_state_errors.value
+        queue = pool_bridge.CommandQueue()
+        with patch.object(pool_bridge, 'panel', panel):
+            cmd = queue.submit('LIGHTS', True)
+            self.assertTrue(cmd.done.wait(2))
+        self.assertEqual(pool_bridge.set_state_errors.value, errors + 1)
+
+
+class FakeSerial:
+    """pyserial stand-in: hands out `chunks`, then blocks until cancel_read()."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.cancelled = threading.Event()
+        self.closed = False
+
+    def read(self, size=1):
+        if self.chunks:
+            return self.chunks.pop(0)
+        self.cancelled.wait(5)
+        return b''
+
+    def cancel_read(self):
+        self.cancelled.set()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAquaLogic:
+    """Reads like AquaLogic.process(): byte by byte until a read times out."""
+    chunks = []
+
+    def __init__(self, web_port=None):
+        self._serial = None
+
+    def connect_serial(self, port):
+        self._serial = FakeSerial(self.chunks)
+
+    def process(self, callback):
+        while self._serial.read(1):
+            pass
+
+
+class TestReconnectSupervisor(unittest.TestCase):
+    """run_aqualogic retries fast, backs off, probes, and catches stalls."""
+
+    def setUp(self):
+        isolate_state(self)
+        self.sup = pool_bridge.PanelSupervisor()
+        for name, value in [('SERIAL_PORT', os.devnull), ('AquaLogic', FakeAquaLogic),
+                            ('STALL_TIMEOUT', 0.2), ('panel', None)]:
+            p = patch.object(pool_bridge, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_backoff_doubles_with_jitter_up_to_cap(self):
+        """Delays start at RECONNECT_MIN, double, stay within [d/2, d] and cap."""
+        delays = [self.sup.backoff() for _ in range(12)]
+        for i, delay in enumerate(delays):
+            cap = min(pool_bridge.RECONNECT_MAX, pool_bridge.RECONNECT_MIN * 2 ** i)
+            self.assertGreaterEqual(delay, cap / 2)
+            self.assertLessEqual(delay, cap)
+        self.assertGreater(delays[-1], pool_bridge.RECONNECT_MAX / 2 - 1e-9)
+
+    def test_missing_port_skips_connect(self):
+        """If the device can't be opened, no AquaLogic is built at all."""
+        with patch.object(pool_bridge, 'SERIAL_PORT', '/nonexistent/ttyAMA0'), \
+             patch.object(pool_bridge, 'AquaLogic') as aq:
+            self.assertIsNone(self.sup.connect())
+        aq.assert_not_called()
+
+    def test_stalled_line_is_dropped(self):
+        """Frames then silence: the watchdog ends process() and resets backoff."""
+        FakeAquaLogic.chunks = [b'\x10', b'\x02', b'\x01', b'\x10', b'\x02']
+        self.sup.backoff()
+        self.sup.backoff()
+        before = pool_bridge.serial_frames.value
+        start = time.monotonic()
+        self.assertEqual(self.sup.connect(), 'stall')
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertEqual(pool_bridge.serial_frames.value - before, 2)
+        self.assertIsNone(pool_bridge.panel)
+        self.assertFalse(self.sup.connected.is_set())
+        self.assertLessEqual(self.sup.backoff(), pool_bridge.RECONNECT_MIN)
+
+    def test_missing_port_polled_until_stopped(self):
+        """While the device is gone run() keeps probing, warning only once."""
+        stop = threading.Event()
+        with patch.object(pool_bridge, 'SERIAL_PORT', '/nonexistent/ttyAMA0'), \
+             patch.object(pool_bridge, 'PROBE_INTERVAL', 0.01), \
+             patch.object(self.sup, 'probe', wraps=self.sup.probe) as probe, \
+             self.assertLogs('pool_bridge', 'WARNING') as logs:
+            runner = threading.Thread(target=self.sup.run, args=(stop,))
+            runner.start()
+            time.sleep(0.1)
+            stop.set()
+            runner.join(1)
+        self.assertFalse(runner.is_alive())
+        self.assertGreater(probe.call_count, 3)
+        self.assertEqual(len(logs.output), 1)
+
+    def test_writes_wait_for_reconnect(self):
+        """A PUT during the grace period is queued and runs once reconnected."""
+        self.sup.disconnected_at = time.monotonic()
+        queue = pool_bridge.CommandQueue()
+        panel = make_panel()
+        with patch.object(pool_bridge, 'supervisor', self.sup), \
+             patch.object(pool_bridge, 'commands', queue):
+            handler = make_handler('PUT', '/state/circuit/setState?wait=0',
+                                   body={'circuit': 'LIGHTS', 'state': True})
+            handler.do_PUT()
+            self.assertEqual(handler._response_code, 202)
+            pool_bridge.panel = panel
+            self.sup.connected.set()
+            cmd = queue.get(handler._response_body['id'])
+            self.assertTrue(cmd.done.wait(2))
+        self.assertEqual(cmd.status, 'done')
+        panel.set_state.assert_called_once()
+
+    def test_writes_refused_after_grace(self):
+        """Once the grace period has passed, PUTs fail fast with 503."""
+        self.sup.disconnected_at = time.monotonic() - pool_bridge.WRITE_GRACE - 1
+        with patch.object(pool_bridge, 'supervisor', self.sup):
+            handler = make_handler('PUT', '/state/circuit/setState',
+                                   body={'circuit': 'LIGHTS', 'state': True})
+            handler.do_PUT()
+        self.assertEqual(handler._response_code, 503)
+
+
+
+class TestMultiPanel(unittest.TestCase):
+    """Several panels in one bridge: namespaced routes, isolation, one stream."""
+
+    def setUp(self):
+        isolate_state(self)
+        self.spa = pool_bridge.PanelContext('spa', os.devnull)
+        for target, name, value in [
+                (pool_bridge, 'panels', {'default': pool_bridge.default_panel,
+                                         'spa': self.spa}),
+                (pool_bridge, 'all_panels', pool_bridge.Broadcaster()),
+                (pool_bridge, 'commands', pool_bridge.CommandQueue()),
+                (pool_bridge, 'SERIAL_PORT', os.devnull),
+                (pool_bridge.default_panel, 'id', 'default')]:
+            p = patch.object(target, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        pool_bridge.on_data_changed(make_panel())
+        self.spa.on_data_changed(make_panel(pool_temp=101))
+
+    def test_namespaced_routes(self):
+        """/panels/<id>/ reaches that panel; unprefixed routes the default one."""
+        port = start_server(self)
+        for path, pool_temp in [('/state/all', 78), ('/panels/default/state/all', 78),
+                                ('/panels/spa/state/all', 101)]:
+            status, _, body = http_request(port, 'GET', path)
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['poolTemp'], pool_temp)
+        status, _, body = http_request(port, 'GET', '/panels/nope/state/all')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['panels'], ['default', 'spa'])
+        status, _, body = http_request(port, 'GET', '/panels')
+        self.assertEqual([p['id'] for p in json.loads(body)['panels']], ['default', 'spa'])
+
+    def test_health_counts_per_panel(self):
+        """/panels/<id>/health counts only that panel's callbacks and changes;
+        /metrics has the totals."""
+        for temp in (101, 101, 102):
+            self.spa.on_data_changed(make_panel(pool_temp=temp))
+        port = start_server(self)
+        counts = {}
+        for path in ('/health', '/panels/spa/health'):
+            status, _, body = http_request(port, 'GET', path)
+            health = json.loads(body)
+            counts[path] = (health['callbacks'], health['changes'])
+        self.assertEqual(counts, {'/health': (1, 1), '/panels/spa/health': (4, 2)})
+        self.assertEqual(pool_bridge.panel_callbacks.value, 5)
+
+    def test_slow_panel_does_not_stall_others(self):
+        """A write stuck on one panel and a held state lock don't delay another."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        stuck = make_panel()
+        stuck.set_state.side_effect = lambda *a: release.wait(5)
+        self.spa.panel = make_panel()
+        self.spa.panel.set_state.return_value = True
+        port = start_server(self)
+        with patch.object(pool_bridge, 'panel', stuck):
+            status, _, _ = http_request(port, 'PUT', '/state/circuit/setState?wait=0',
+                                        body=json.dumps({'circuit': 'SPA', 'state': True}))
+            self.assertEqual(status, 202)
+            with pool_bridge.state_lock:
+                start = time.monotonic()
+                status, _, body = http_request(
+                    port, 'PUT', '/panels/spa/state/circuit/setState',
+                    body=json.dumps({'circuit': 'SPA', 'state': True}))
+                self.assertEqual(status, 200)
+                self.assertEqual(json.loads(body)['status'], 'done')
+                status, _, _ = http_request(port, 'GET', '/panels/spa/state/all')
+                self.assertEqual(status, 200)
+                self.assertLess(time.monotonic() - start, 1)
+        self.spa.panel.set_state.assert_called_once()
+
+    def test_aggregated_stream(self):
+        """/panels/events opens with every panel, then tags each patch."""
+        port = start_server(self)
+        sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+        self.addCleanup(sock.close)
+        sock.sendall(b'GET /panels/events?mode=delta HTTP/1.1\r\nHost: t\r\n\r\n')
+        data = b''
+        while data.count(b'\n\n') < 2:
+            data += sock.recv(4096)
+        self.assertIn(b'data: {"panel":"default","version":1,"state":', data)
+        self.assertIn(b'data: {"panel":"spa","version":1,"state":', data)
+
+        self.spa.on_data_changed(make_panel(pool_temp=102))
+        data = b''
+        while not data.endswith(b'\n\n'):
+            data += sock.recv(4096)
+        self.assertEqual(data, b'event: patch\ndata: {"panel":"spa","version":2,'
+                               b'"patch":{"poolTemp":102}}\n\n')
+
+    def test_configure_panels(self):
+        """The first --panel becomes the default; bad or repeated ids are refused."""
+        pool_bridge.configure_panels([('pool', '/dev/ttyUSB0'), ('spa', '/dev/ttyUSB1')])
+        self.assertEqual(list(pool_bridge.panels), ['pool', 'spa'])
+        self.assertIs(pool_bridge.panels['pool'], pool_bridge.default_panel)
+        self.assertEqual(pool_bridge.SERIAL_PORT, '/dev/ttyUSB0')
+        self.assertEqual(pool_bridge.panels['spa'].port, '/dev/ttyUSB1')
+        for specs in ([('a/b', 'x')], [('events', 'x')], [('a', 'x'), ('a', 'y')]):
+            with self.assertRaises(ValueError):
+                pool_bridge.configure_panels(specs)
+
+
+class TestFastStart(unittest.TestCase):
+    """Warm-up: lazy imports, and the last known state served from a snapshot."""
+
+    def setUp(self):
+        isolate_state(self)
+        self.path = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        for name, value in [('panels', {'default': pool_bridge.default_panel}),
+                            ('commands', pool_bridge.CommandQueue())]:
+            p = patch.object(pool_bridge, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def restart(self):
+        """Forget the live state, as a fresh process would, and load the snapshot."""
+        pool_bridge.current_state, pool_bridge.state_version = {}, 0
+        pool_bridge.last_reading = pool_bridge.latest_change = None
+        pool_bridge.recent_changes.clear()
+        return pool_bridge.load_snapshot(self.path)
+
+    def test_import_leaves_heavy_modules_unloaded(self):
+        """Importing the bridge doesn't pull in asyncio or aqualogic.core."""
+        code = (
+            'import sys, types\n'
+            'states = types.ModuleType("aqualogic.states")\n'
+            'states.States = type("States", (), {"__getattr__": lambda self, n: n})()\n'
+            'sys.modules["aqualogic"] = types.ModuleType("aqualogic")\n'
+            'sys.modules["aqualogic.states"] = states\n'
+            'import pool_bridge\n'
+            'print(sorted({"asyncio.base_events", "aqualogic.core"} & set(sys.modules)))\n')
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(pool_bridge.__file__)))
+        self.assertEqual(out.stdout.strip(), '[]', out.stderr)
+
+    def test_snapshot_served_until_first_reading(self):
+        """A restart serves the saved state, marked stale, until the panel speaks."""
+        pool_bridge.on_data_changed(make_panel(pool_temp=80))
+        with patch.object(pool_bridge.time, 'time', return_value=1_700_000_000):
+            pool_bridge.save_snapshot(self.path)
+        self.assertEqual(self.restart(), 1)
+        port = start_server(self)
+        status, _, body = http_request(port, 'GET', '/state/all')
+        self.assertEqual(status, 200)
+        state = json.loads(body)
+        self.assertEqual((state['poolTemp'], state['staleSince']), (80, 1_700_000_000))
+        status, _, body = http_request(port, 'GET', '/health')
+        health = json.loads(body)
+        self.assertFalse(health['live'])
+        self.assertGreater(health['staleAge'], 0)
+
+        pool_bridge.on_data_changed(make_panel(pool_temp=81))
+        self.assertEqual(pool_bridge.state_version, 2)
+        self.assertEqual(pool_bridge.latest_change.patch,
+                         {'poolTemp': 81, 'staleSince': None})
+        status, _, body = http_request(port, 'GET', '/health')
+        self.assertTrue(json.loads(body)['live'])
+        self.assertNotIn('staleAge', json.loads(body))
+
+    def test_history_complete_after_warm_start(self):
+        """The first live reading records every field, not just the ones
+        that differ from the snapshot."""
+        pool_bridge.on_data_changed(make_panel(pool_temp=80))
+        pool_bridge.save_snapshot(self.path)
+        self.restart()
+        store = pool_bridge.HistoryStore(tempfile.mkdtemp(), flush_every=3600)
+        store._start_maintenance = lambda now: None
+        with patch.object(pool_bridge, 'history', store):
+            pool_bridge.on_data_changed(make_panel(pool_temp=80, pump_power=900))
+        self.assertEqual(pool_bridge.latest_change.patch,
+                         {'pumpPower': 900, 'staleSince': None})
+        now = time.time()
+        points = store.query('poolTemp', int(now) - 3600, int(now) + 60, 60)
+        self.assertEqual(points[-1][1], 80.0)
+        self.assertEqual(store.query('circuits.SPA', int(now), int(now) + 60, 60),
+                         [[int(now), False]])
+
+    def test_snapshot_never_skips_a_write(self):
+        """A circuit the snapshot shows on is still switched on when asked."""
+        p = make_panel()
+        p.get_state.side_effect = lambda circuit: circuit == 'SPA'
+        pool_bridge.on_data_changed(p)
+        pool_bridge.save_snapshot(self.path)
+        self.restart()
+        live = make_panel()
+        live.set_state.return_value = True
+        with patch.object(pool_bridge, 'panel', live):
+            port = start_server(self)
+            status, _, body = http_request(port, 'PUT', '/state/circuit/setState',
+                                           body=json.dumps({'circuit': 'SPA', 'state': True}))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['status'], 'done')
+        live.set_state.assert_called_once()
+
+    def test_bad_snapshot_ignored(self):
+        """A missing, corrupt or other-format snapshot just means starting empty."""
+        self.assertEqual(pool_bridge.load_snapshot(self.path), 0)
+        for text in ('{"format":1,"panels":{"default":{"sta',
+                     '{"format":99,"panels":{"default":{"savedAt":1,"state":{}}}}'):
+            with open(self.path, 'w') as f:
+                f.write(text)
+            with self.assertLogs('pool_bridge', 'WARNING'):
+                self.assertEqual(pool_bridge.load_snapshot(self.path), 0)
+        self.assertEqual(pool_bridge.state_version, 0)
+
+    def test_restart_before_reading_keeps_saved_time(self):
+        """Saving a state that came from the snapshot doesn't make it look fresh."""
+        pool_bridge.on_data_changed(make_panel())
+        with patch.object(pool_bridge.time, 'time', return_value=1_700_000_000):
+            pool_bridge.save_snapshot(self.path)
+        self.restart()
+        pool_bridge.save_snapshot(self.path)
+        with open(self.path) as f:
+            saved = json.load(f)['panels']['default']
+        self.assertEqual(saved['savedAt'], 1_700_000_000)
+        self.assertNotIn('staleSince', saved['state'])
+
+    def test_writer_coalesces_changes(self):
+        """A burst of changes costs one write now and one when the interval ends."""
+        writes = pool_bridge.Counter()
+        writer = pool_bridge.SnapshotWriter(self.path, every=0.5)
+        with patch.object(pool_bridge, 'snapshots', writer), \
+                patch.object(pool_bridge, 'snapshot_writes', writes):
+            writer.start()
+            self.addCleanup(writer.close)
+            for temp in range(70, 90):
+                pool_bridge.on_data_changed(make_panel(pool_temp=temp))
+                time.sleep(0.01)
+            self.assertEqual(writes.value, 1)
+            time.sleep(0.7)
+            self.assertEqual(writes.value, 2)
+            with open(self.path) as f:
+                self.assertEqual(json.load(f)['panels']['default']['state']['poolTemp'], 89)
+            time.sleep(0.6)   # nothing changed: no more writes
+            self.assertEqual(writes.value, 2)
+
+
+class TestRules(unittest.TestCase):
+    """In-process automation: edge-triggered rules, indexed by field."""
+
+    def setUp(self):
+        isolate_state(self)
+        self.path = os.path.join(tempfile.mkdtemp(), 'rules.json')
+        self.panel = make_panel()
+        self.panel.set_state.return_value = True
+        for name, value in [('panels', {'default': pool_bridge.default_panel}),
+                            ('commands', pool_bridge.CommandQueue()),
+                            ('rules', pool_bridge.RuleEngine()),
+                            ('panel', self.panel),
+                            ('RULES_PATH', self.path)]:
+            p = patch.object(pool_bridge, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def heater_rule(self):
+        return pool_bridge.Rule('too-hot', {
+            'when': [{'field': 'poolTemp', 'op': '>=', 'value': 84}],
+            'set': {'heater_1': False}})
+
+    def submitted(self):
+        return pool_bridge.commands.counts['submitted']
+
+    def test_fires_when_condition_starts_to_hold(self):
+        """A rule acts once per false → true edge, not on every change."""
+        pool_bridge.rules.put(self.heater_rule())
+        for temp, fired in [(80, 0), (85, 1), (86, 1), (83, 1), (84, 2)]:
+            pool_bridge.on_data_changed(make_panel(pool_temp=temp))
+            self.assertEqual(self.submitted(), fired, temp)
+        rule = pool_bridge.rules.get('too-hot')
+        self.assertEqual((rule['fired'], rule['active']), (2, True))
+        self.assertEqual(rule['set'], {'HEATER_1': False})
+
+    def test_only_dependent_rules_checked(self):
+        """A change re-checks the rules that read a field it touched."""
+        pool_bridge.on_data_changed(make_panel(pool_temp=80))
+        pool_bridge.rules.put(self.heater_rule())
+        pool_bridge.rules.put(pool_bridge.Rule('spa-on', {
+            'when': [{'field': 'circuits.SPA', 'value': True}],
+            'set': {'HEATER_1': True}}))
+        with patch.object(pool_bridge.Rule, 'holds', autospec=True,
+                          return_value=False) as holds:
+            pool_bridge.on_data_changed(make_panel(pool_temp=81))
+            self.assertEqual([call.args[0].id for call in holds.call_args_list],
+                             ['too-hot'])
+            pool_bridge.on_data_changed(make_panel(pool_temp=81, air_temp=60))
+            self.assertEqual(holds.call_count, 1)
+
+    def test_time_windows(self):
+        """Windows are [start, end) in local time and may span midnight."""
+        night = pool_bridge.Rule('night', {'when': [{'time': ['22:00', '6:00']}],
+                                           'set': {'FILTER': False}})
+        day = pool_bridge.Rule('day', {'when': [{'time': ['08:00', '16:00']}],
+                                       'set': {'FILTER': True}})
+        for minute, at_night, by_day in [(23 * 60, True, False), (5 * 60, True, False),
+                                         (8 * 60, False, True), (16 * 60, False, False)]:
+            self.assertEqual(night.holds({}, minute), at_night, minute)
+            self.assertEqual(day.holds({}, minute), by_day, minute)
+
+    def test_snapshot_state_never_fires(self):
+        """Until the panel is read, rules aren't checked against a stale state."""
+        pool_bridge.current_state, pool_bridge.state_version = {'poolTemp': 90}, 1
+        pool_bridge.rules.put(self.heater_rule())
+        pool_bridge.rules.evaluate()
+        self.assertEqual(self.submitted(), 0)
+        pool_bridge.on_data_changed(make_panel(pool_temp=90))
+        self.assertEqual(self.submitted(), 1)
+
+    def test_api_and_persistence(self):
+        """Rules are managed over HTTP, validated, and saved for the next start."""
+        port = start_server(self)
+        body = json.dumps({'when': [{'field': 'poolTemp', 'op': '>=', 'value': 84}],
+                           'set': {'HEATER_1': False}})
+        status, _, resp = http_request(port, 'PUT', '/rules/too-hot', body=body)
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(resp)['id'], 'too-hot')
+        status, _, _ = http_request(port, 'PUT', '/rules/too-hot', body=body)
+        self.assertEqual(status, 200)
+        for bad in ({'when': [], 'set': {'SPA': True}},
+                    {'when': [{'field': 'nope'}], 'set': {'SPA': True}},
+                    {'when': [{'time': ['8am', '4pm']}], 'set': {'SPA': True}},
+                    {'when': [{'field': 'poolTemp', 'op': '>', 'value': 1}], 'set': {'X': 1}}):
+            status, _, _ = http_request(port, 'PUT', '/rules/bad', body=json.dumps(bad))
+            self.assertEqual(status, 400, bad)
+        status, _, resp = http_request(port, 'GET', '/rules')
+        self.assertEqual([r['id'] for r in json.loads(resp)['rules']], ['too-hot'])
+
+        with patch.object(pool_bridge, 'rules', pool_bridge.RuleEngine()):
+            self.assertEqual(pool_bridge.load_rules(), 1)
+            self.assertEqual(pool_bridge.rules.get('too-hot')['set'], {'HEATER_1': False})
+        status, _, _ = http_request(port, 'DELETE', '/rules/too-hot')
+        self.assertEqual(status, 200)
+        status, _, _ = http_request(port, 'DELETE', '/rules/too-hot')
+        self.assertEqual(status, 404)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['panels'], {'default': {}})
+
+
+def decode_state(data):
+    """Read a binary state using nothing but /state/schema, as a display would."""
+    schema = pool_bridge.binary_schema()
+    codes = {'u8': 'B', 'u16': 'H', 'u32': 'I', 'i16': 'h', 'f32': 'f'}
+    raw = {}
+    for item in schema['layout']:
+        if item['type'] in codes:
+            raw[item['name']] = struct.unpack_from('<' + codes[item['type']], data,
+                                                   item['offset'])[0]
+        elif item['name'] == 'checkSystemMsg':
+            n = data[item['offset']]
+            raw[item['name']] = data[item['offset'] + 1:item['offset'] + 1 + n].decode()
+    layout = {item['name']: item for item in schema['layout']}
+    state = {key: raw[key] for i, key in enumerate(layout['present']['bits'])
+             if raw['present'] >> i & 1}
+    state.update({key: bool(raw['flags'] >> i & 1)
+                  for i, key in enumerate(layout['flags']['bits'])})
+    state['circuits'] = {name: bool(raw['circuits'] >> i & 1)
+                         for i, name in enumerate(layout['circuits']['bits'])}
+    state['checkSystemMsg'] = raw['checkSystemMsg'] or None
+    return raw['version'], state
+
+
+class TestBinaryEncoding(unittest.TestCase):
+    """Accept: application/x-pool-state — fixed layout for small displays."""
+
+    def setUp(self):
+        isolate_state(self)
+        p = make_panel(air_temp=None, salt_level=3.5, check_system_msg='Low Salt')
+        p.get_state.side_effect = lambda circuit: circuit in ('FILTER', 'AUX_4')
+        pool_bridge.on_data_changed(p)
+
+    def test_round_trip_through_schema(self):
+        """Every field survives the trip; missing readings stay missing."""
+        data = pool_bridge.encode_state(pool_bridge.current_state, 7)
+        self.assertEqual(len(data), pool_bridge.binary_schema()['fixedSize'] + len('Low Salt'))
+        version, state = decode_state(data)
+        self.assertEqual(version, 7)
+        self.assertNotIn('airTemp', state)
+        self.assertEqual((state['poolTemp'], state['saltLevel'], state['pumpPower']),
+                         (78, 3.5, 1100))
+        self.assertEqual(state['checkSystemMsg'], 'Low Salt')
+        self.assertEqual(state['circuits'], pool_bridge.current_state['circuits'])
+        self.assertFalse(state['staleSince'])
+
+    def test_out_of_range_reading_sent_as_missing(self):
+        """A value that doesn't fit its field is dropped, not an error."""
+        state = dict(pool_bridge.current_state, pumpPower=70000)
+        _, decoded = decode_state(pool_bridge.encode_state(state, 1))
+        self.assertNotIn('pumpPower', decoded)
+        self.assertEqual(decoded['poolTemp'], 78)
+
+    def test_state_all_negotiated(self):
+        """/state/all answers in the format asked for, each with its own ETag."""
+        port = start_server(self)
+        accept = {'Accept': 'application/x-pool-state'}
+        status, headers, body = http_request(port, 'GET', '/state/all', headers=accept)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'application/x-pool-state')
+        self.assertEqual(body, pool_bridge.encode_state(pool_bridge.current_state, 1))
+        etag = headers['ETag']
+        _, json_headers, json_body = http_request(port, 'GET', '/state/all')
+        self.assertEqual(json.loads(json_body)['poolTemp'], 78)
+        self.assertNotEqual(json_headers['ETag'], etag)
+        status, _, _ = http_request(port, 'GET', '/state/all',
+                                    headers=dict(accept, **{'If-None-Match': etag}))
+        self.assertEqual(status, 304)
+        status, _, body = http_request(port, 'GET', '/state/schema')
+        self.assertEqual(json.loads(body)['version'], pool_bridge.BINARY_VERSION)
+
+    def test_event_stream(self):
+        """Both runtimes stream length-prefixed states, with empty keep-alives."""
+        for port in (start_server(self), start_async_server(self)):
+            sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+            self.addCleanup(sock.close)
+            sock.sendall(b'GET /events HTTP/1.1\r\nHost: t\r\n'
+                         b'Accept: application/x-pool-state\r\n\r\n')
+            data = b''
+            while b'\r\n\r\n' not in data:
+                data += sock.recv(4096)
+            head, _, data = data.partition(b'\r\n\r\n')
+            self.assertIn(b'Content-Type: application/x-pool-state-stream', head)
+
+            def record():
+                nonlocal data
+                while len(data) < 2 or len(data) < 2 + int.from_bytes(data[:2], 'little'):
+                    data += sock.recv(4096)
+                n = int.from_bytes(data[:2], 'little')
+                rec, data = data[2:2 + n], data[2 + n:]
+                return decode_state(rec)
+
+            version, state = record()
+            self.assertEqual(state['poolTemp'], pool_bridge.current_state['poolTemp'])
+            pool_bridge.on_data_changed(make_panel(pool_temp=state['poolTemp'] + 1))
+            version2, state2 = record()
+            self.assertEqual((version2, state2['poolTemp']), (version + 1, state['poolTemp'] + 1))
+
+
+class TestKeepAlive(unittest.TestCase):
+    """HTTP/1.1 persistent connections, limits and preflight caching."""
+
+    def setUp(self):
+        isolate_state(self)
+        pool_bridge.on_data_changed(make_panel())
+
+    def test_requests_share_a_connection(self):
+        """GETs, 304s, preflights and errors all leave the connection usable."""
+        for port in (start_server(self), start_async_server(self)):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            self.addCleanup(conn.close)
+            conn.request('GET', '/state/all')
+            resp = conn.getresponse()
+            etag = resp.headers['ETag']
+            resp.read()
+            sock = conn.sock
+            for method, path, headers, status in [
+                    ('GET', '/state/all', {'If-None-Match': etag}, 304),
+                    ('OPTIONS', '/state/circuits', {}, 204),
+                    ('GET', '/nope', {}, 404),
+                    ('GET', '/health', {}, 200)]:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                self.assertEqual(resp.status, status, path)
+                self.assertIsNone(resp.headers['Connection'])
+                self.assertIs(conn.sock, sock, path)
+
+    def test_preflight_cached(self):
+        """OPTIONS answers let the browser skip preflights for a day."""
+        port = start_server(self)
+        status, headers, body = http_request(port, 'OPTIONS', '/state/circuit/setState')
+        self.assertEqual((status, body), (204, b''))
+        self.assertEqual(headers['Content-Length'], '0')
+        self.assertEqual(headers['Access-Control-Max-Age'], str(pool_bridge.CORS_MAX_AGE))
+        self.assertIn('PUT', headers['Access-Control-Allow-Methods'])
+
+    def test_connection_closed_at_request_limit(self):
+        """The last request a connection is allowed says Connection: close."""
+        port = start_server(self)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+        self.addCleanup(conn.close)
+        with patch.object(pool_bridge, 'KEEPALIVE_MAX', 3):
+            for n in range(1, 4):
+                conn.request('GET', '/health')
+                resp = conn.getresponse()
+                resp.read()
+                self.assertEqual(resp.headers['Keep-Alive'],
+                                 None if n == 3 else f'timeout=5, max={3 - n}')
+            self.assertEqual(resp.headers['Connection'], 'close')
+
+    def test_idle_and_unread_body_close(self):
+        """Idle connections time out; one with an unread body isn't reused."""
+        port = start_server(self)
+        with patch.object(PoolHandler, 'timeout', 0.2):
+            sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+            self.addCleanup(sock.close)
+            sock.sendall(b'GET /health HTTP/1.1\r\nHost: t\r\n\r\n')
+            data = b''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            self.assertIn(b'Keep-Alive:', data)   # stayed open, then timed out
+        status, headers, _ = http_request(port, 'GET', '/health', body=b'{"x": 1}')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Connection'], 'close')
+
+    def test_malformed_request_line(self):
+        """A garbled or unsupported request line gets an error response on
+        both runtimes, not a traceback and a dropped connection."""
+        with patch.object(pool_bridge.PoolHTTPServer, 'handle_error') as handle_error:
+            for port in (start_server(self), start_async_server(self)):
+                for line in (b'GARBAGE', b'GET / HTTP/9.9'):
+                    sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+                    self.addCleanup(sock.close)
+                    sock.sendall(line + b'\r\n\r\n')
+                    data = b''
+                    while chunk := sock.recv(4096):
+                        data += chunk
+                    # Without a version the answer is HTTP/0.9 style: just the body
+                    self.assertRegex(data, rb'^(HTTP/1\.[01] |<!DOCTYPE)', line)
+                    self.assertRegex(data, rb'Error code: (400|505)', line)
+        handle_error.assert_not_called()
+
+    def test_idle_connections_yield_to_waiting_clients(self):
+        """Idle kept-alive connections give up their workers when another
+        client is waiting, instead of holding them for the idle timeout."""
+        port = start_server(self, workers=4)
+        idle = []
+        for _ in range(4):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            self.addCleanup(conn.close)
+            conn.request('GET', '/health')
+            conn.getresponse().read()
+            idle.append(conn)
+        start = time.monotonic()
+        status, _, _ = http_request(port, 'GET', '/health')
+        self.assertEqual(status, 200)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_kept_alive_while_workers_are_free(self):
+        """New connections arriving while workers are idle don't close
+        other clients' persistent connections."""
+        port = start_server(self, workers=8)
+        stop = threading.Event()
+
+        def churn():
+            while not stop.is_set():
+                http_request(port, 'GET', '/health')
+        churner = threading.Thread(target=churn, daemon=True)
+        churner.start()
+        self.addCleanup(churner.join)   # before the server shuts down
+        self.addCleanup(stop.set)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        self.addCleanup(conn.close)
+        conn.request('GET', '/health')
+        conn.getresponse().read()
+        sock = conn.sock
+        for _ in range(15):
+            time.sleep(0.1)
+            conn.request('GET', '/health')
+            resp = conn.getresponse()
+            resp.read()
+            self.assertEqual(resp.status, 200)
+            self.assertIs(conn.sock, sock)
+
+
+class TestReplication(unittest.TestCase):
+    """--replicate: the default panel mirrors a primary served on this
+    bridge as /panels/primary, which stands in for another Pi."""
+
+    def setUp(self):
+        isolate_state(self)
+        self.primary = pool_bridge.PanelContext('primary', os.devnull)
+        self.primary.panel = make_panel()
+        self.primary.panel.set_state.return_value = True
+        for target, name, value in [
+                (pool_bridge, 'panels', {'default': pool_bridge.default_panel,
+                                         'primary': self.primary}),
+                (pool_bridge, 'all_panels', pool_bridge.Broadcaster()),
+                (pool_bridge, 'commands', pool_bridge.CommandQueue()),
+                (pool_bridge, 'rules', pool_bridge.RuleEngine()),
+                (pool_bridge, 'RULES_PATH', None),
+                (pool_bridge, 'REPLICA_STALL', 0.3),
+                (pool_bridge.default_panel, 'id', 'default')]:
+            p = patch.object(target, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        self.primary.on_data_changed(make_panel(pool_temp=80))
+        self.port = start_server(self)
+        self.replica = pool_bridge.Replica(
+            f'http://127.0.0.1:{self.port}/panels/primary')
+        p = patch.object(pool_bridge, 'replica', self.replica)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_follows_primary(self):
+        """The replica serves the primary's state and each change after it."""
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        threading.Thread(target=self.replica.run, args=(stop,), daemon=True).start()
+        self.assertTrue(self.replica.connected.wait(2))
+        for _ in range(100):
+            if pool_bridge.state_version:
+                break
+            time.sleep(0.01)
+        status, _, body = http_request(self.port, 'GET', '/state/all')
+        self.assertEqual(json.loads(body)['poolTemp'], 80)
+
+        on = make_panel(pool_temp=81)
+        on.get_state.side_effect = lambda state: state == 'SPA'
+        self.primary.on_data_changed(on)
+        for _ in range(100):
+            if pool_bridge.current_state.get('poolTemp') == 81:
+                break
+            time.sleep(0.01)
+        with self.primary.state_lock:
+            expected = dict(self.primary.current_state)
+        self.assertEqual(pool_bridge.current_state, expected)
+        self.assertEqual(pool_bridge.state_version, 2)
+        status, _, body = http_request(self.port, 'GET', '/health')
+        health = json.loads(body)
+        self.assertTrue(health['connected'] and health['live'])
+        self.assertEqual(health['replica']['lastEventId'], self.primary.latest().event_id)
+
+    def test_resume_and_stale(self):
+        """A dropped stream resumes with just the missed patches, and the
+        state is marked stale until the primary is back."""
+        self.assertEqual(self.replica.follow(), 'error')   # stalls after the full state
+        self.assertEqual(pool_bridge.current_state['poolTemp'], 80)
+        self.replica.mark_stale()
+        self.assertIn('staleSince', pool_bridge.current_state)
+        self.assertIsNone(pool_bridge.last_reading)
+
+        for temp in (81, 82):
+            self.primary.on_data_changed(make_panel(pool_temp=temp))
+        with patch.object(self.replica, 'apply', wraps=self.replica.apply) as apply:
+            self.replica.follow()
+        self.assertEqual([c.args[0] for c in apply.call_args_list], ['patch', 'patch'])
+        self.assertEqual(pool_bridge.current_state['poolTemp'], 82)
+        self.assertNotIn('staleSince', pool_bridge.current_state)
+
+        self.replica.mark_stale()
+        self.replica.follow()   # nothing missed, still no longer stale
+        self.assertNotIn('staleSince', pool_bridge.current_state)
+
+    def test_writes_forwarded(self):
+        """setState, /commands and /rules reach the primary; its answer is relayed."""
+        status, _, body = http_request(self.port, 'PUT', '/state/circuit/setState',
+                                       body=json.dumps({'circuit': 'SPA', 'state': True}))
+        self.assertEqual(status, 200)
+        cmd = json.loads(body)
+        self.primary.panel.set_state.assert_called_once_with('SPA', True)
+        self.assertIsNone(pool_bridge.commands.get(cmd['id']))
+        status, _, body = http_request(self.port, 'GET', f'/commands/{cmd["id"]}')
+        self.assertEqual((status, json.loads(body)['status']), (200, 'done'))
+
+        status, _, body = http_request(self.port, 'PUT', '/state/circuit/setState',
+                                       body=json.dumps({'circuit': 'NOPE', 'state': True}))
+        self.assertEqual(status, 400)
+        self.assertIn('validCircuits', json.loads(body))
+
+        rule = {'when': [{'field': 'poolTemp', 'op': '>=', 'value': 84}],
+                'set': {'HEATER_1': False}}
+        status, _, _ = http_request(self.port, 'PUT', '/rules/heat', body=json.dumps(rule))
+        self.assertEqual(status, 201)
+        self.assertEqual(len(self.primary.rules), 1)
+        self.assertEqual(len(pool_bridge.rules), 0)
+        status, _, _ = http_request(self.port, 'DELETE', '/rules/heat')
+        self.assertEqual((status, len(self.primary.rules)), (200, 0))
+
+    def test_queued_command_location(self):
+        """A 202 relayed from the primary points at a path on the mirror."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.primary.panel.set_state.side_effect = lambda *a: release.wait(2) or True
+        status, _, body = http_request(self.port, 'PUT', '/state/circuit/setState?wait=0',
+                                       body=json.dumps({'circuit': 'SPA', 'state': True}))
+        self.assertEqual(status, 202)
+        cmd = json.loads(body)
+        self.assertEqual(cmd['location'], f'/commands/{cmd["id"]}')
+        release.set()
+        status, _, body = http_request(self.port, 'GET', cmd['location'])
+        self.assertEqual((status, json.loads(body)['id']), (200, cmd['id']))
+
+    def test_primary_unreachable(self):
+        """Forwarded requests answer 502 while the primary is down."""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = sock.getsockname()[1]
+        sock.close()
+        replica = pool_bridge.Replica(f'http://127.0.0.1:{dead}')
+        with patch.object(pool_bridge, 'replica', replica):
+            status, _, body = http_request(self.port, 'PUT', '/state/circuits',
+                                           body=json.dumps({'SPA': True}))
+            self.assertEqual(status, 502)
+            self.assertEqual(replica.follow(), 'error')
+        with self.assertRaises(ValueError):
+            pool_bridge.Replica('ftp://pool-pi/')
+
+    def test_apply_patch_inverts_diff(self):
+        """Merging diff_state(old, new) into old gives new."""
+        old = {'poolTemp': 80, 'staleSince': 5,
+               'circuits': {'SPA': False, 'POOL': True}}
+        new = {'poolTemp': 81, 'circuits': {'SPA': True, 'POOL': True}}
+        patch_ = pool_bridge.diff_state(old, new)
+        self.assertEqual(pool_bridge.apply_patch(old, patch_), new)
+        # A reading that clears keeps its key, as null
+        old, new = {'checkSystemMsg': 'Check Salt'}, {'checkSystemMsg': None}
+        self.assertEqual(pool_bridge.apply_patch(old, pool_bridge.diff_state(old, new)), new)
+        self.assertEqual(list(pool_bridge.read_sse(
+            [b': ping\n', b'\n', b'id: a-1\n', b'event: patch\n', b'data: {}\n', b'\n'])),
+            [('patch', 'a-1', '{}')])
+
+
+
+def read_frames(sock, until, timeout=5):
+    """Read SSE frames from a raw stream socket until until(frames) holds."""
+    data = b''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        frames = [f for f in data.split(b'\r\n\r\n', 1)[-1].split(b'\n\n')[:-1]
+                  if f and not f.startswith(b':')]
+        if frames and until(frames):
+            return frames
+        data += sock.recv(1 << 20)
+    raise AssertionError('stream never produced the expected frames')
+
+
+class TestBackpressure(unittest.TestCase):
+    """Per-client rate limits, write timeouts and slow stream clients."""
+
+    def setUp(self):
+        isolate_state(self)
+        for name, value in [('read_limits', pool_bridge.RateLimiter(1, 2)),
+                            ('write_limits', pool_bridge.RateLimiter(1, 1)),
+                            ('rate_limited', pool_bridge.Family(pool_bridge.Counter)),
+                            ('sse_slow', pool_bridge.Counter()),
+                            ('sse_write_timeouts', pool_bridge.Counter()),
+                            ('SSE_SLOW_WRITE', 0.05),
+                            ('SSE_SEND_BUFFER', 4096)]:
+            p = patch.object(pool_bridge, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        pool_bridge.on_data_changed(make_panel())
+
+    def test_token_bucket(self):
+        """A burst is allowed, then requests wait for the refill."""
+        limits = pool_bridge.RateLimiter(2, 3, clients=2)
+        self.assertEqual([limits.take('a', now=0) for _ in range(4)], [0, 0, 0, 0.5])
+        self.assertEqual(limits.take('a', now=0.5), 0)
+        self.assertEqual(limits.take('a', now=0.5), 0.5)
+        limits.take('b', now=1)
+        limits.take('c', now=1)   # 'a' is forgotten and starts with a full bucket
+        self.assertEqual([limits.take('a', now=1) for _ in range(4)], [0, 0, 0, 0.5])
+
+    def test_client_address(self):
+        """Proxies name the client; requests made on the Pi itself aren't limited."""
+        client_of = pool_bridge.client_of
+        self.assertIsNone(client_of('127.0.0.1'))
+        self.assertEqual(client_of('127.0.0.1', '10.0.0.5'), '10.0.0.5')
+        self.assertEqual(client_of('::1', None, '1.2.3.4, 10.0.0.6'), '10.0.0.6')
+        self.assertEqual(client_of('10.0.0.7', '10.0.0.5'), '10.0.0.7')
+        self.assertEqual(pool_bridge.throttle('GET', None), 0)
+
+    def test_rate_limited_requests_get_429(self):
+        """Each client gets its own budget for reads and for writes, on both runtimes."""
+        for n, port in enumerate((start_server(self), start_async_server(self))):
+            phone = {'X-Real-IP': f'10.0.{n}.5'}
+            for expected in (200, 200, 429):
+                status, headers, body = http_request(port, 'GET', '/health', headers=phone)
+                self.assertEqual(status, expected)
+            self.assertEqual(headers['Retry-After'], '1')
+            self.assertEqual(json.loads(body)['error'], 'rate limited')
+            status, headers, _ = http_request(port, 'GET', '/events', headers=phone)
+            self.assertEqual((status, headers['Retry-After']), (429, '1'))
+            self.assertEqual(http_request(port, 'GET', '/health')[0], 200)
+            self.assertEqual(http_request(port, 'GET', '/health',
+                                          headers={'X-Real-IP': '10.9.9.9'})[0], 200)
+
+            put = json.dumps({'circuit': 'NOPE', 'state': True})
+            self.assertEqual(http_request(port, 'PUT', '/state/circuit/setState',
+                                          body=put, headers=phone)[0], 400)
+            status, headers, _ = http_request(port, 'PUT', '/state/circuit/setState',
+                                              body=put, headers=phone)
+            self.assertEqual((status, headers['Connection']), (429, 'close'))
+        self.assertEqual(pool_bridge.rate_limited.labels('read').value, 4)
+        self.assertEqual(pool_bridge.rate_limited.labels('write').value, 2)
+
+    def test_slow_client_skips_to_latest(self):
+        """A backlog behind a slow write is sent as one full state, not every patch."""
+        sub = pool_bridge.Subscriber()
+        changes = [pool_bridge.StateChange(v, {'poolTemp': v}, {'poolTemp': v})
+                   for v in (2, 3, 4)]
+        self.assertEqual(pool_bridge._frames_for(changes, sub, True, False).count(b'patch'), 3)
+        sub.slow = True
+        self.assertEqual(pool_bridge._frames_for(changes, sub, True, False),
+                         changes[-1].frame('full'))
+        self.assertEqual(pool_bridge._frames_for(changes[:1], sub, True, False),
+                         changes[0].frame('delta'))
+        self.assertEqual(pool_bridge.sse_slow.value, 1)
+
+    def stalled_stream(self, port):
+        """A delta stream whose reader has stopped reading, blocked on one big frame."""
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.settimeout(5)
+        sock.connect(('127.0.0.1', port))
+        self.addCleanup(sock.close)
+        sock.sendall(b'GET /events?mode=delta HTTP/1.1\r\nHost: t\r\n\r\n')
+        read_frames(sock, lambda frames: True)   # the initial state
+        pool_bridge.on_data_changed(make_panel(check_system_msg='x' * (1 << 20)))
+        time.sleep(0.3)
+        return sock
+
+    def test_slow_reader_harness(self):
+        """A reader that stalls and then catches up gets the latest state in
+        one frame, then patches again once its writes are quick."""
+        for port in (start_server(self), start_async_server(self)):
+            sock = self.stalled_stream(port)
+            slow = pool_bridge.sse_slow.value
+            for temp in (90, 91, 92):
+                pool_bridge.on_data_changed(make_panel(pool_temp=temp))
+            frames = read_frames(sock, lambda frames: b'"poolTemp":92' in frames[-1])
+            self.assertNotIn(b'event: patch', frames[-1])
+            self.assertEqual(sum(b'"poolTemp":9' in f for f in frames), 1)
+            self.assertEqual(pool_bridge.sse_slow.value, slow + 1)
+
+            pool_bridge.on_data_changed(make_panel(pool_temp=93))
+            frames = read_frames(sock, lambda frames: b'"poolTemp":93' in frames[-1])
+            self.assertTrue(frames[-1].startswith(b'id: '))
+            self.assertIn(b'event: patch', frames[-1])
+            pool_bridge.on_data_changed(make_panel())   # back to the start for the next runtime
+
+    def test_stalled_reader_dropped(self):
+        """A reader that stops for good is dropped after SSE_WRITE_TIMEOUT."""
+        with patch.object(pool_bridge, 'SSE_WRITE_TIMEOUT', 0.3):
+            for n, port in enumerate((start_server(self), start_async_server(self)), 1):
+                self.stalled_stream(port)
+                for _ in range(100):
+                    if len(pool_bridge.broadcaster) == 0:
+                        break
+                    time.sleep(0.02)
+                self.assertEqual(len(pool_bridge.broadcaster), 0)
+                self.assertEqual(pool_bridge.sse_write_timeouts.value, n)
+                pool_bridge.on_data_changed(make_panel())
+
+
+
+class TestProfiler(unittest.TestCase):
+    """/debug/profile: token-gated stack sampling in collapsed form."""
+
+    def setUp(self):
+        isolate_state(self)
+        self.token_path = os.path.join(tempfile.mkdtemp(), 'token')
+        for name, value in [('PROFILE_TOKEN_PATH', self.token_path),
+                            ('read_limits', None)]:
+            p = patch.object(pool_bridge, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        self.port = start_server(self)
+
+    def profile(self, query='seconds=0.3', token='s3cret'):
+        return http_request(self.port, 'GET', f'/debug/profile?{query}',
+                            headers={'Authorization': f'Bearer {token}'})
+
+    def busy_thread(self):
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+
+        def spin():
+            while not stop.is_set():
+                sum(range(1000))
+        threading.Thread(target=spin, name='busy-1', daemon=True).start()
+
+    def test_disabled_without_token_file(self):
+        """No token file, no endpoint."""
+        self.assertEqual(self.profile()[0], 404)
+
+    def test_requires_token(self):
+        """A missing or wrong token gets 401; bad durations get 400."""
+        with open(self.token_path, 'w') as f:
+            f.write('s3cret\n')
+        status, headers, _ = self.profile(token='guess')
+        self.assertEqual((status, headers['WWW-Authenticate']), (401, 'Bearer'))
+        self.assertEqual(http_request(self.port, 'GET', '/debug/profile')[0], 401)
+        for query in ('seconds=0', 'seconds=301', 'seconds=abc'):
+            self.assertEqual(self.profile(query)[0], 400, query)
+
+    def test_collapsed_stacks_of_busy_threads(self):
+        """Threads using CPU show up with their stacks; idle workers don't,
+        unless ?idle=1 asks for every thread."""
+        with open(self.token_path, 'w') as f:
+            f.write('s3cret')
+        self.busy_thread()
+        status, headers, body = self.profile()
+        self.assertEqual(status, 200)
+        self.assertIn('.folded', headers['Content-Disposition'])
+        self.assertGreater(int(headers['X-Profile-Samples']), 5)
+        lines = body.decode().splitlines()
+        busy = [line for line in lines if line.startswith('busy;')]
+        self.assertTrue(busy)
+        self.assertIn('spin (test_pool_bridge.py)', busy[0])
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+        self.assertFalse([line for line in lines if line.startswith('http;')])
+
+        _, _, body = self.profile('seconds=0.1&idle=1')
+        self.assertIn('\nhttp;', '\n' + body.decode())
+
+    def test_one_capture_at_a_time(self):
+        """A second capture while one runs is refused with 409."""
+        with open(self.token_path, 'w') as f:
+            f.write('s3cret')
+        running = threading.Thread(target=pool_bridge.profiler.capture, args=(0.5,))
+        running.start()
+        self.addCleanup(running.join)
+        time.sleep(0.05)
+        self.assertEqual(self.profile()[0], 409)
+
+
 if __name__ == '__main__':
     unittest.main()